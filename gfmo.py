@@ -3,7 +3,14 @@ import os
 from time import time
 
 from gfmo_args import parse_args
-from gfmo_experiments import evaluation, sampling, train_flow_matching, train_proxies
+from gfmo_experiments import (
+    evaluation,
+    export_bundle,
+    sampling,
+    train_flow_matching,
+    train_proxies,
+)
+from gfmo_service import serve
 
 
 def main(args):
@@ -24,6 +31,10 @@ def main(args):
         sampling(args)
     elif args.mode == "evaluation":
         evaluation(args)
+    elif args.mode == "export_bundle":
+        export_bundle(args)
+    elif args.mode == "serve":
+        serve(args)
     else:
         raise ValueError(f"Unknown mode: {args.mode}")
     print(f"Total time: {time() - start_time} seconds")
@@ -19,6 +19,16 @@ def str2bool(v):
     raise ArgumentTypeError("Boolean value expected.")
 
 
+def str2ints(v):
+    """
+    Convert a comma separated string, e.g., 0,1,2,3,4, to a list of integers.
+    """
+    try:
+        return [int(i) for i in v.split(",") if i.strip() != ""]
+    except ValueError:
+        raise ArgumentTypeError("Comma separated integers expected.")
+
+
 def parse_args():  # Parse command line arguments
     """
     Parse the command line arguments for the GFMO-Guided Flows in Multi-Objective
@@ -29,6 +39,13 @@ def parse_args():  # Parse command line arguments
     parser.add_argument(
         "--seed", default=0, type=int, help="The random seed for the experiment"
     )
+    parser.add_argument(
+        "--seeds",
+        default=None,
+        type=str2ints,
+        help="Comma separated seeds, e.g., 0,1,2,3,4. In sampling mode, the task and "
+        "the models are loaded once and the seeds are run back to back",
+    )
     parser.add_argument(
         "--task_name",
         required=True,
@@ -40,7 +57,14 @@ def parse_args():  # Parse command line arguments
         "--mode",
         type=str,
         required=True,
-        choices=["train_proxies", "train_flow_matching", "sampling", "evaluation"],
+        choices=[
+            "train_proxies",
+            "train_flow_matching",
+            "sampling",
+            "evaluation",
+            "export_bundle",
+            "serve",
+        ],
         help="True denotes we need to train the flow matching model",
     )
     parser.add_argument(
@@ -50,6 +74,14 @@ def parse_args():  # Parse command line arguments
         default=True,
         help="True denotes normalizing the inputs and outputs",
     )
+    parser.add_argument(
+        "--compile",
+        type=str2bool,
+        nargs="?",
+        default=False,
+        help="True denotes compiling the flow model and the proxies for sampling, "
+        "with torch.compile, or torch.jit.trace as a fallback",
+    )
     parser.add_argument(
         "--fm_adaptive",
         type=str2bool,
@@ -87,6 +119,33 @@ def parse_args():  # Parse command line arguments
         type=int,
         help="The number of sampling steps, i.e., T",
     )
+    parser.add_argument(
+        "--fm_solver",
+        default="euler",
+        choices=["euler", "heun", "midpoint", "rk4", "dopri5"],
+        type=str,
+        help="The ODE integrator used for sampling, dopri5 is the adaptive Dormand-Prince method",
+    )
+    parser.add_argument(
+        "--fm_rtol",
+        default=1e-3,
+        type=float,
+        help="The relative tolerance of the adaptive integrator",
+    )
+    parser.add_argument(
+        "--fm_atol",
+        default=1e-4,
+        type=float,
+        help="The absolute tolerance of the adaptive integrator",
+    )
+    parser.add_argument(
+        "--fm_batch_seeds",
+        type=str2bool,
+        nargs="?",
+        default=False,
+        help="True denotes sampling all the --seeds together as independent populations "
+        "stacked along the batch axis, each population draws its samples from its own seed",
+    )
     parser.add_argument(
         "--fm_epochs",
         default=1000,
@@ -105,6 +164,38 @@ def parse_args():  # Parse command line arguments
         type=int,
         help="Number of epochs to wait before early stopping",
     )
+    parser.add_argument(
+        "--fm_val_metric",
+        default="nll",
+        choices=["nll", "fm_loss"],
+        type=str,
+        help="The metric used for validation and early stopping of the flow matching model",
+    )
+    parser.add_argument(
+        "--fm_val_steps",
+        default=None,
+        type=int,
+        help="The number of integration steps of the validation nll, fm_sampling_steps if not set",
+    )
+    parser.add_argument(
+        "--fm_val_probe",
+        default="gaussian",
+        choices=["gaussian", "rademacher"],
+        type=str,
+        help="The probe of the Hutchinson trace estimator, rademacher uses a fixed probe",
+    )
+    parser.add_argument(
+        "--fm_val_seed",
+        default=0,
+        type=int,
+        help="The seed of the random times, noises and probes of every validation",
+    )
+    parser.add_argument(
+        "--fm_val_every",
+        default=1,
+        type=int,
+        help="Validate the flow matching model every N epochs",
+    )
     parser.add_argument(
         "--fm_O",
         default=5,
@@ -149,12 +240,57 @@ def parse_args():  # Parse command line arguments
         type=str,
         help="empty_init: initialize the PS with empty solutions, d_best: initialize the PS with the best solutions in the offline dataset",
     )
+    parser.add_argument(
+        "--fm_init_assignment",
+        default="greedy",
+        choices=["greedy", "hungarian"],
+        type=str,
+        help="greedy: each weight takes its best remaining solution in turn, hungarian: maximize the total scalarized score of the d_best initialization",
+    )
+    parser.add_argument(
+        "--hv_method",
+        default="exact",
+        choices=["exact", "mc", "auto"],
+        type=str,
+        help="exact: exact hypervolume, mc: quasi Monte-Carlo estimate with its standard error, auto: mc for tasks with 6 or more objectives",
+    )
+    parser.add_argument(
+        "--fm_hv_trace",
+        default=False,
+        type=str2bool,
+        nargs="?",
+        help="Monitor the hypervolume of the predicted objectives of the selected candidates at every guided step, saved as sampling/hv_trace",
+    )
     parser.add_argument(
         "--fm_store_path",
         default="flow_matching_models/",
         type=str,
         help="The folder to store the trained flow matching model",
     )
+    parser.add_argument(
+        "--bundle_path",
+        default=None,
+        type=str,
+        help="The inference bundle written by the export_bundle mode, sampling loads the models and the dataset statistics from it when given",
+    )
+    parser.add_argument(
+        "--serve_socket",
+        default=None,
+        type=str,
+        help="The Unix socket the serve mode listens on, the requests are read from stdin and answered on stdout if None",
+    )
+    parser.add_argument(
+        "--serve_max_batch",
+        default=8,
+        type=int,
+        help="Maximum number of compatible requests the serve mode samples together as independent populations",
+    )
+    parser.add_argument(
+        "--ckpt_keep",
+        default=1,
+        type=int,
+        help="Number of best checkpoints kept for each model, the older ones are renamed with a .1, .2, ... suffix",
+    )
     parser.add_argument(
         "--samples_store_path",
         default="generated_samples/",
@@ -173,6 +309,12 @@ def parse_args():  # Parse command line arguments
         type=str,
         help="The folder to store the log configurations",
     )
+    parser.add_argument(
+        "--data_cache_path",
+        default="data_cache/",
+        type=str,
+        help="The folder to cache the preprocessed data and normalization statistics",
+    )
     parser.add_argument(
         "--proxies_store_path",
         default="proxies_model/",
@@ -209,6 +351,20 @@ def parse_args():  # Parse command line arguments
         type=float,
         help="The ratio of the validation set",
     )
+    parser.add_argument(
+        "--proxies_eval_every",
+        default=1,
+        type=int,
+        help="Number of epochs between two evaluations of the proxies, the best checkpoint is chosen among the evaluated epochs",
+    )
+    parser.add_argument(
+        "--proxies_joint_training",
+        type=str2bool,
+        nargs="?",
+        default=False,
+        help="True denotes training the proxies of all the objectives together as one "
+        "packed ensemble over a shared split of the data",
+    )
 
     args = parser.parse_args()
     return args
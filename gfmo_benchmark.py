@@ -0,0 +1,107 @@
+"""Micro-benchmark of one guided sampling step, in eager mode and with --compile.
+
+The flow model and the proxies are randomly initialized on a synthetic task, so no
+trained model or dataset is needed, e.g.,
+python gfmo_benchmark.py --n_dim 30 --n_obj 3 --steps 50
+"""
+
+import copy
+from argparse import ArgumentParser
+from time import perf_counter
+
+import torch
+
+from gfmo_nets import FlowMatching, VectorFieldNet
+from gfmo_utils import PackedProxyEnsemble, compile_module
+
+# get the device
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def parse_args():
+    parser = ArgumentParser(description="Latency of one guided sampling step")
+    parser.add_argument("--n_dim", default=30, type=int, help="Dimension of x")
+    parser.add_argument("--n_obj", default=3, type=int, help="Number of objectives")
+    parser.add_argument(
+        "--fm_hidden_size", default=512, type=int, help="Width of the vector field"
+    )
+    parser.add_argument(
+        "--proxies_hidden_size", default=2048, type=int, help="Width of the proxies"
+    )
+    parser.add_argument(
+        "--fm_O", default=5, type=int, help="Number of offspring of each weight"
+    )
+    parser.add_argument(
+        "--num_solutions", default=256, type=int, help="Number of solutions to keep"
+    )
+    parser.add_argument("--steps", default=50, type=int, help="Number of timed steps")
+    parser.add_argument("--warmup", default=5, type=int, help="Number of untimed steps")
+    parser.add_argument(
+        "--backends",
+        default="compile,trace",
+        type=str,
+        help="Comma separated backends tried by compile_module",
+    )
+    return parser.parse_args()
+
+
+def time_steps(model, classifiers, weights, n_steps, O):
+    """
+    return: the mean latency of one guided step in milliseconds, i.e., one guided
+    vector field evaluation on the batch plus the scoring of its offspring
+    """
+    batch_size = weights.shape[0]
+    x_t = torch.randn(batch_size, model.D, device=device)
+    t = 0.9
+    start = perf_counter()
+    for _ in range(n_steps):
+        v = model.weighted_conditional_vnet(
+            x_t, t, classifiers, weights=weights, delta_t=0.01
+        )
+        offspring = (x_t + 0.01 * v).unsqueeze(1).repeat(1, O, 1)
+        offspring = offspring + 0.1 * torch.randn_like(offspring)
+        model.calculate_scores(batch_size, t, O, classifiers, offspring)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (perf_counter() - start) / n_steps * 1000
+
+
+def main(args):
+    torch.manual_seed(0)
+    net = VectorFieldNet(args.n_dim, args.fm_hidden_size)
+    model = FlowMatching(net, 0.0, args.n_dim, 1000).to(device).eval()
+    classifiers = PackedProxyEnsemble(
+        args.n_dim, [args.proxies_hidden_size] * 2, args.n_obj
+    )
+    classifiers = classifiers.to(device).eval()
+    weights, _ = FlowMatching.calculate_objectives_weights(
+        args.n_obj, args.num_solutions
+    )
+    weights = weights.to(device)
+    print(
+        f"Batch size: {weights.shape[0]}, offspring: {weights.shape[0] * args.fm_O}, "
+        f"device: {device}"
+    )
+
+    results = {}
+    for mode in ["eager", "compiled"]:
+        mode_model = copy.deepcopy(model)
+        mode_classifiers = copy.deepcopy(classifiers)
+        if mode == "compiled":
+            backends = tuple(args.backends.split(","))
+            example = torch.randn(64, args.n_dim, device=device)
+            compile_module(mode_model.vnet, example, backends)
+            compile_module(
+                mode_model.time_embedding, torch.rand(64, 1, device=device), backends
+            )
+            compile_module(mode_classifiers, example, backends)
+        time_steps(mode_model, mode_classifiers, weights, args.warmup, args.fm_O)
+        results[mode] = time_steps(
+            mode_model, mode_classifiers, weights, args.steps, args.fm_O
+        )
+        print(f"{mode}: {results[mode]:.3f} ms/step")
+    print(f"Speedup: {results['eager'] / results['compiled']:.2f}x")
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,281 @@
+"""This module contains the packed inference bundle of GFMO. A bundle is one file holding
+the flow matching model, the packed proxies, the normalization statistics of the dataset,
+the offline solutions of the d_best initialization and the task metadata, so that
+sampling neither preprocesses the dataset nor loads the training checkpoints.
+
+The file starts with a JSON header followed by the raw arrays, each one aligned on
+BUNDLE_ALIGNMENT bytes. The arrays are memory-mapped, so loading a bundle only reads the
+header and the pages of the weights are read from the disk when they are first used."""
+
+import json
+import os
+import struct
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from gfmo_nets import FlowMatching, VectorFieldNet
+from gfmo_utils import PackedProxyEnsemble, get_dataset_state, set_dataset_state
+
+BUNDLE_MAGIC = b"GFMOBNDL"
+BUNDLE_VERSION = 1
+BUNDLE_ALIGNMENT = 64
+
+
+def write_bundle(path, arrays, metadata):
+    """
+    path: the file to write
+    arrays: a dict of numpy arrays
+    metadata: a dict of JSON serializable values
+    """
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        offset = -(-offset // BUNDLE_ALIGNMENT) * BUNDLE_ALIGNMENT
+        layout[name] = {
+            "dtype": array.dtype.str,
+            "shape": list(array.shape),
+            "offset": offset,
+        }
+        offset += array.nbytes
+    header = json.dumps(
+        {"version": BUNDLE_VERSION, "metadata": metadata, "arrays": layout}
+    ).encode()
+    # The arrays start at the first aligned offset after the header
+    start = len(BUNDLE_MAGIC) + 8 + len(header)
+    start = -(-start // BUNDLE_ALIGNMENT) * BUNDLE_ALIGNMENT
+
+    # Write a temporary file first, so that readers never see a partial bundle
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "wb") as f:
+        f.write(BUNDLE_MAGIC)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(start + layout[name]["offset"])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(start + offset)
+    os.replace(temporary_path, path)
+
+
+def read_bundle(path):
+    """
+    path: a file written by write_bundle
+    return: the metadata and a dict of the arrays, memory-mapped as copy-on-write so
+    that they can back tensors without being read from the disk
+    """
+    with open(path, "rb") as f:
+        if f.read(len(BUNDLE_MAGIC)) != BUNDLE_MAGIC:
+            raise ValueError(f"{path} is not an inference bundle")
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size))
+    if header["version"] != BUNDLE_VERSION:
+        raise ValueError(
+            f"The bundle {path} has version {header['version']}, "
+            f"expected {BUNDLE_VERSION}"
+        )
+    start = len(BUNDLE_MAGIC) + 8 + header_size
+    start = -(-start // BUNDLE_ALIGNMENT) * BUNDLE_ALIGNMENT
+
+    arrays = {}
+    for name, layout in header["arrays"].items():
+        shape = tuple(layout["shape"])
+        if int(np.prod(shape)) == 0:
+            arrays[name] = np.zeros(shape, dtype=np.dtype(layout["dtype"]))
+            continue
+        arrays[name] = np.memmap(
+            path,
+            dtype=np.dtype(layout["dtype"]),
+            mode="c",
+            offset=start + layout["offset"],
+            shape=shape,
+        )
+    return header["metadata"], arrays
+
+
+def assign_state_dict(module, state_dict):
+    """
+    Replace the parameters and the buffers of module with the tensors of state_dict,
+    without copying them, the parameters do not require gradients
+    """
+    names = set(module.state_dict().keys())
+    missing = names - set(state_dict.keys())
+    unexpected = set(state_dict.keys()) - names
+    if missing or unexpected:
+        raise KeyError(
+            f"Error: The state dict does not match the module, missing: "
+            f"{sorted(missing)}, unexpected: {sorted(unexpected)}"
+        )
+    for name, tensor in state_dict.items():
+        *path, leaf = name.split(".")
+        owner = module.get_submodule(".".join(path))
+        if leaf in owner._parameters:
+            owner._parameters[leaf] = nn.Parameter(tensor, requires_grad=False)
+        else:
+            owner._buffers[leaf] = tensor
+
+
+class InferenceBundle:
+    """
+    The models and the dataset information needed to sample a task, see the module
+    docstring for the file format
+    """
+
+    def __init__(self, metadata, arrays):
+        self.metadata = metadata
+        self.arrays = arrays
+        self.model = None
+        self.classifiers = None
+
+    @property
+    def task_name(self):
+        return self.metadata["task_name"]
+
+    @property
+    def n_dim(self):
+        return self.metadata["n_dim"]
+
+    @property
+    def n_obj(self):
+        return self.metadata["n_obj"]
+
+    @property
+    def dataset_state(self):
+        """
+        return: the normalization statistics of the dataset, see get_dataset_state
+        """
+        state = {
+            name[len("dataset.") :]: np.array(array)
+            for name, array in self.arrays.items()
+            if name.startswith("dataset.")
+        }
+        state.update(self.metadata["dataset_methods"])
+        return state
+
+    def get_init_candidates(self):
+        """
+        return: the normalized offline solutions and scores of the d_best initialization,
+        shape: (batch_size, n_dim) and (batch_size, n_obj)
+        """
+        return np.array(self.arrays["init.x"]), np.array(self.arrays["init.y"])
+
+    @classmethod
+    def export(
+        cls,
+        path,
+        model,
+        classifiers,
+        task,
+        task_name,
+        normalization=True,
+        num_solutions=256,
+    ):
+        """
+        path: the file to write
+        model: the trained FlowMatching model
+        classifiers: the trained PackedProxyEnsemble
+        task: the task, its dataset statistics should be the ones used for training
+        normalization: whether the models were trained on normalized data
+        num_solutions: the number of solutions of the sampling, it does not change the
+        number of weights of the initialization
+        """
+        dataset_state = get_dataset_state(task)
+        metadata = {
+            "task_name": task_name,
+            "n_dim": model.D,
+            "n_obj": len(classifiers),
+            "normalization": normalization,
+            "flow": model.get_checkpoint()["config"],
+            "proxies": {"hidden_size": list(classifiers.hidden_size)},
+            "dataset_methods": {
+                key: value
+                for key, value in dataset_state.items()
+                if key.endswith("_normalize_method")
+            },
+        }
+
+        arrays = {}
+        for name, tensor in model.state_dict().items():
+            arrays[f"flow.{name}"] = tensor.detach().cpu().numpy()
+        for name, tensor in classifiers.state_dict().items():
+            arrays[f"proxies.{name}"] = tensor.detach().cpu().numpy()
+        for name, value in dataset_state.items():
+            if isinstance(value, np.ndarray):
+                arrays[f"dataset.{name}"] = value
+
+        # The offline solutions of the d_best initialization, the number of weights only
+        # depends on the number of objectives
+        _, batch_size = FlowMatching.calculate_objectives_weights(
+            len(classifiers), num_solutions
+        )
+        arrays["init.x"], arrays["init.y"] = FlowMatching.get_init_candidates(
+            task, batch_size
+        )
+        # The normalization could have updated the statistics, keep the exported ones
+        set_dataset_state(task, dataset_state)
+
+        write_bundle(path, arrays, metadata)
+
+    @classmethod
+    def load(cls, path, device=None, warm_start=True):
+        """
+        path: a file written by InferenceBundle.export
+        device: the device of the models, the weights are memory-mapped on the cpu and
+        copied once on another device
+        warm_start: whether to run the models once, so that the weights are read from
+        the disk and the kernels are initialized before the first sampling
+        return: the bundle with its models in evaluation mode
+        """
+        metadata, arrays = read_bundle(path)
+        bundle = cls(metadata, arrays)
+
+        def get_state_dict(prefix):
+            return {
+                name[len(prefix) :]: torch.from_numpy(array)
+                for name, array in arrays.items()
+                if name.startswith(prefix)
+            }
+
+        # The modules are built without initializing their weights, which are replaced
+        config = metadata["flow"]
+        with torch.device("meta"):
+            model = FlowMatching(
+                VectorFieldNet(config["D"], config["hidden_size"]),
+                config["sigma"],
+                config["D"],
+                config["T"],
+                stochastic_euler=config["stochastic_euler"],
+                prob_path=config["prob_path"],
+            )
+            classifiers = PackedProxyEnsemble(
+                metadata["n_dim"], metadata["proxies"]["hidden_size"], metadata["n_obj"]
+            )
+        assign_state_dict(model, get_state_dict("flow."))
+        assign_state_dict(classifiers, get_state_dict("proxies."))
+
+        bundle.model = model.to(device).eval() if device is not None else model.eval()
+        bundle.classifiers = (
+            classifiers.to(device).eval() if device is not None else classifiers.eval()
+        )
+        if warm_start:
+            bundle.warm_start()
+        return bundle
+
+    def warm_start(self):
+        """
+        Run the vector field, the time embedding and the proxies once on the offline
+        solutions of the initialization
+        """
+        device = next(self.classifiers.parameters()).device
+        x = torch.from_numpy(np.array(self.arrays["init.x"][:1])).float().to(device)
+        with torch.no_grad():
+            self.model.vnet(x)
+            self.model.time_embedding(torch.ones(1, 1, device=device))
+            self.classifiers(x)
+
+    def apply(self, task):
+        """
+        Restore the normalization statistics of the dataset into task
+        """
+        set_dataset_state(task, self.dataset_state)
@@ -1,5 +1,6 @@
 import json
 import os
+import sys
 
 import numpy as np
 import torch
@@ -7,23 +8,48 @@ from torch.utils.data import DataLoader
 
 import offline_moo.off_moo_bench as ob
 from gfmo_args import parse_args
+from gfmo_bundle import InferenceBundle
 from gfmo_nets import FlowMatching, VectorFieldNet
+from gfmo_solvers import get_solver
 from gfmo_utils import (
     ALLTASKSDICT,
     DesignDataset,
     MultipleModels,
-    SingleModel,
+    PackedProxyEnsemble,
+    PackedProxyTrainer,
     SingleModelBaseTrainer,
+    compile_module,
     get_dataloader,
+    get_dataset_state,
+    load_cached_task_data,
+    load_task_data,
+    set_dataset_state,
     tkwargs,
     training,
 )
-from offline_moo.off_moo_bench.evaluation.metrics import hv
-from offline_moo.utils import get_quantile_solutions, set_seed
+from offline_moo.off_moo_bench.evaluation.metrics import get_hv_results
+from offline_moo.utils import set_seed
 
 # get the device
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-print(f"Device: {device}")
+# stderr keeps stdout free for the responses of the sampling service
+print(f"Device: {device}", file=sys.stderr)
+
+
+def load_training_data(args, task_name):
+    """
+    return: the preprocessed X and y, the task is only built if they are not cached
+    """
+    cached = load_cached_task_data(
+        task_name, args.normalization, cache_dir=args.data_cache_path
+    )
+    if cached is not None:
+        X, y, _ = cached
+        return X, y
+    task = ob.make(task_name)
+    return load_task_data(
+        task, task_name, args.normalization, cache_dir=args.data_cache_path
+    )
 
 
 def train_proxies(args):
@@ -32,22 +58,7 @@ def train_proxies(args):
 
     set_seed(args.seed)
 
-    task = ob.make(task_name)
-
-    X = task.x.copy()
-    y = task.y.copy()
-
-    if task.is_discrete:
-        X = task.to_logits(X)
-        data_size, n_dim, n_classes = tuple(X.shape)
-        X = X.reshape(-1, n_dim * n_classes)
-    if task.is_sequence:
-        X = task.to_logits(X)
-
-    # For usual cases, we normalize the inputs and outputs with z-score normalization
-    if args.normalization:
-        X = task.normalize_x(X)
-        y = task.normalize_y(y)
+    X, y = load_training_data(args, task_name)
 
     n_obj = y.shape[1]
     data_size, n_dim = tuple(X.shape)
@@ -64,6 +75,25 @@ def train_proxies(args):
     )
     model.set_kwargs(**tkwargs)
 
+    if args.proxies_joint_training:
+        # All the objectives share one split of the data and one training loop
+        trainer = PackedProxyTrainer(
+            models=list(model.obj2model.values()),
+            args=args,
+        )
+
+        (train_loader, val_loader) = get_dataloader(
+            X,
+            y,
+            val_ratio=(
+                1 - args.proxies_val_ratio
+            ),  # means 0.9 for training and 0.1 for validation
+            batch_size=args.proxies_batch_size,
+        )
+
+        trainer.launch(train_loader, val_loader)
+        return
+
     trainer_func = SingleModelBaseTrainer
 
     for which_obj in range(n_obj):
@@ -94,24 +124,10 @@ def train_flow_matching(args):
 
     # Get the task
     task_name = ALLTASKSDICT[args.task_name]
-    task = ob.make(task_name)
     print(f"Task: {task_name}")
 
-    # Get the data
-    X = task.x.copy()
-    y = task.y.copy()
-
-    if task.is_discrete:
-        X = task.to_logits(X)
-        data_size, n_dim, n_classes = tuple(X.shape)
-        X = X.reshape(-1, n_dim * n_classes)
-    if task.is_sequence:
-        X = task.to_logits(X)
-
-    # For usual cases, we normalize the inputs and outputs with z-score normalization
-    if args.normalization:
-        X = task.normalize_x(X)
-        y = task.normalize_y(y)
+    # Get the data, the task is not built if it is cached
+    X, y = load_training_data(args, task_name)
 
     # Use a subset of the data
     if args.fm_validation_size is not None:
@@ -178,47 +194,18 @@ def train_flow_matching(args):
         optimizer=optimizer,
         training_loader=training_loader,
         val_loader=val_loader,
+        val_every=args.fm_val_every,
+        val_metric=args.fm_val_metric,
+        val_steps=args.fm_val_steps,
+        val_probe=args.fm_val_probe,
+        val_seed=args.fm_val_seed,
+        ckpt_keep=args.ckpt_keep,
     )
 
     return nll_val
 
 
-def sampling(args):
-    # Set the seed
-    set_seed(args.seed)
-
-    # Get the task
-    task_name = ALLTASKSDICT[args.task_name]
-    task = ob.make(task_name)
-    print(f"Task: {task_name}")
-
-    # Get the data
-    X = task.x.copy()
-    y = task.y.copy()
-
-    if task.is_discrete:
-        X = task.to_logits(X)
-        data_size, dim, n_classes = tuple(X.shape)
-        X = X.reshape(-1, dim * n_classes)
-    if task.is_sequence:
-        X = task.to_logits(X)
-
-    if args.normalization:
-        X = task.normalize_x(X)
-        y = task.normalize_y(y)
-
-    # Obtain the number of objectives
-    n_obj = y.shape[1]
-
-    # Set K to the number of objectives if args.K is 0
-    if args.fm_K == 0:
-        fm_K = n_obj + 1  # K = n_obj + 1
-    else:
-        fm_K = args.fm_K
-
-    # Obtain the number of data points and the number of dimensions
-    data_size, n_dim = tuple(X.shape)
-
+def get_sampling_name(args, task_name, seed):
     name = (
         args.fm_prob_path
         + "_"
@@ -226,7 +213,7 @@ def sampling(args):
         + "_"
         + task_name
         + "_"
-        + str(args.seed)
+        + str(seed)
         + f"_K={args.fm_K}"
         + "_"
         + f"O={args.fm_O}"
@@ -235,62 +222,276 @@ def sampling(args):
         + "_"
         + f"gamma={args.fm_gamma}"
     )
+    # Keep the names of the Euler runs with the greedy initialization unchanged
+    if args.fm_solver != "euler":
+        name += f"_solver={args.fm_solver}"
+    if args.fm_init_assignment != "greedy":
+        name += f"_init={args.fm_init_assignment}"
+    return name
+
+
+def load_trained_models(args, task_name, n_dim, n_obj):
+    """
+    return: the trained flow matching model and the trained proxies, packed into one
+    ensemble to predict all objectives at once
+    """
     model_name = args.fm_prob_path + "_" + str(1000) + "_" + task_name + "_" + str(0)
     model_store_dir = args.fm_store_path
 
     # Load the best model
-    net = VectorFieldNet(n_dim, args.fm_hidden_size)
-    net = net.to(device)
-    model_best = FlowMatching(
-        net, args.fm_sigma, n_dim, args.fm_sampling_steps, prob_path=args.fm_prob_path
+    model_best = FlowMatching.load(
+        model_store_dir + model_name + ".model", map_location=device
     )
     model_best = model_best.to(device)
-    model_best = torch.load(model_store_dir + model_name + ".model")
-    model_best = model_best.to(device)
     print(
         f"Succesfully loaded the model from {model_store_dir + model_name + '.model'}"
     )
 
     # Load the classifiers
-    list_of_classifiers = []
-    for i in range(n_obj):
-        classifier = SingleModel(
-            input_size=n_dim,
-            which_obj=i,
-            hidden_size=[2048, 2048],
-            save_dir=args.proxies_store_path,
-            save_prefix=f"MultipleModels-Vallina-{task_name}-{0}",
+    classifiers = PackedProxyEnsemble(
+        input_size=n_dim,
+        hidden_size=[2048, 2048],
+        n_obj=n_obj,
+        save_dir=args.proxies_store_path,
+        save_prefix=f"MultipleModels-Vallina-{task_name}-{0}",
+    )
+    classifiers.load()
+    classifiers = classifiers.to(device)
+    classifiers.eval()
+    print(f"Loaded {len(classifiers)} classifiers successfully.")
+
+    return model_best, classifiers
+
+
+def export_bundle(args):
+    # Set the seed
+    set_seed(args.seed)
+
+    # Get the task
+    task_name = ALLTASKSDICT[args.task_name]
+    task = ob.make(task_name)
+    print(f"Task: {task_name}")
+
+    # Get the data, which sets the normalization statistics of the dataset
+    X, y = load_task_data(
+        task, task_name, args.normalization, cache_dir=args.data_cache_path
+    )
+    model_best, classifiers = load_trained_models(
+        args, task_name, X.shape[1], y.shape[1]
+    )
+
+    assert args.bundle_path is not None, "Error: The bundle path should be provided"
+    bundle_dir = os.path.dirname(args.bundle_path)
+    if bundle_dir and not os.path.exists(bundle_dir):
+        os.makedirs(bundle_dir)
+    InferenceBundle.export(
+        args.bundle_path,
+        model_best,
+        classifiers,
+        task,
+        task_name,
+        normalization=args.normalization,
+        num_solutions=args.fm_num_solutions,
+    )
+    print(f"Exported the inference bundle to {args.bundle_path}")
+
+
+def load_sampling_models(args, task, task_name):
+    """
+    Load the models from the inference bundle if args.bundle_path is given, from the
+    checkpoints otherwise, and set the normalization statistics of the dataset of task
+    return: the flow matching model, the packed proxies and the offline solutions of the
+    d_best initialization, None if they should be taken from the task
+    """
+    init_candidates = None
+    if args.bundle_path is not None:
+        # The bundle holds the models and the normalization statistics of the dataset,
+        # so the dataset is not preprocessed again
+        bundle = InferenceBundle.load(args.bundle_path, device=device)
+        assert (
+            bundle.task_name == task_name
+        ), f"Error: The bundle was exported for {bundle.task_name}, not {task_name}"
+        assert (
+            bundle.metadata["normalization"] == args.normalization
+        ), "Error: The bundle was exported with another normalization"
+        bundle.apply(task)
+        model_best, classifiers = bundle.model, bundle.classifiers
+        init_candidates = bundle.get_init_candidates()
+        # The offline solutions of the bundle stand in for the data as examples
+        X = bundle.arrays["init.x"]
+        print(f"Loaded the inference bundle from {args.bundle_path}")
+    else:
+        # Get the data
+        X, y = load_task_data(
+            task, task_name, args.normalization, cache_dir=args.data_cache_path
+        )
+
+        # Obtain the number of objectives
+        n_obj = y.shape[1]
+
+        model_best, classifiers = load_trained_models(
+            args, task_name, X.shape[1], n_obj
         )
-        classifier.load()
-        classifier = classifier.to(device)
-        classifier.eval()
-        list_of_classifiers.append(classifier)
-    print(f"Loaded {len(list_of_classifiers)} classifiers successfully.")
+
+    # Compile the small static networks that are called at every sampling step
+    if args.compile:
+        example = torch.from_numpy(np.array(X[:64])).float().to(device)
+        compile_module(model_best.vnet, example)
+        compile_module(model_best.time_embedding, torch.rand(64, 1).to(device))
+        compile_module(classifiers, example)
+
+    return model_best, classifiers, init_candidates
+
+
+def get_fm_K(args, n_obj):
+    # Set K to the number of objectives if args.K is 0
+    if args.fm_K == 0:
+        return n_obj + 1  # K = n_obj + 1
+    return args.fm_K
+
+
+def sampling(args):
+    # Set the seed
+    set_seed(args.seed)
+
+    # Get the task
+    task_name = ALLTASKSDICT[args.task_name]
+    task = ob.make(task_name)
+    print(f"Task: {task_name}")
+
+    model_best, classifiers, init_candidates = load_sampling_models(
+        args, task, task_name
+    )
+    fm_K = get_fm_K(args, len(classifiers))
+
+    # The task and the models are loaded once and shared by all the seeds. The sampling
+    # updates the normalization statistics of the dataset, so every seed starts again
+    # from the statistics of the preprocessed data, as in a fresh process
+    dataset_state = get_dataset_state(task)
+    if args.seeds is not None and args.fm_batch_seeds:
+        # All the seeds are sampled together as independent populations
+        results = sampling_with_seeds(
+            args,
+            args.seeds,
+            task,
+            task_name,
+            model_best,
+            classifiers,
+            fm_K,
+            init_candidates=init_candidates,
+        )
+    else:
+        results = []
+        for seed in args.seeds if args.seeds is not None else [args.seed]:
+            set_dataset_state(task, dataset_state)
+            results += sampling_with_seeds(
+                args,
+                [seed],
+                task,
+                task_name,
+                model_best,
+                classifiers,
+                fm_K,
+                init_candidates=init_candidates,
+            )
+
+    # A single run returns its solutions, a sweep returns the solutions of every seed
+    if args.seeds is None:
+        return results[0]
+    return results
+
+
+def sampling_with_seeds(
+    args, seeds, task, task_name, model_best, classifiers, fm_K, init_candidates=None
+):
+    """
+    seeds: the seeds to sample, more than one seed are stacked as independent populations
+    in a single call of gfmo_sample, each one drawing its samples from its own seed
+    init_candidates: the offline solutions of the d_best initialization, see gfmo_sample
+    return: a list of the solutions and their scores, one for each seed
+    """
+    samples = sample_populations(
+        args,
+        seeds,
+        task,
+        task_name,
+        model_best,
+        classifiers,
+        fm_K,
+        init_candidates=init_candidates,
+    )
+    return [
+        save_sampling_results(args, seed, task, task_name, x_samples, hv_results)
+        for seed, (x_samples, hv_results) in zip(seeds, samples)
+    ]
+
+
+def sample_populations(
+    args,
+    seeds,
+    task,
+    task_name,
+    model_best,
+    classifiers,
+    fm_K,
+    init_candidates=None,
+    g_t=None,
+    gamma=None,
+):
+    """
+    seeds: see sampling_with_seeds
+    g_t, gamma: one value for all the populations or a list with one value per
+    population, args.fm_gt and args.fm_gamma if None
+    return: a list of the pareto sets and their hypervolume results, one for each seed
+    """
+    print(f"Seeds: {seeds}")
+
+    # Reset the seed right before sampling, the populations draw their samples from
+    # generators seeded with their own seeds, so that a seed gives the same samples
+    # whether it runs alone or in a sweep
+    set_seed(seeds[0])
 
     # Conditional sampling
-    x_samples, hv_results = model_best.gfmo_sample(
-        list_of_classifiers,
+    samples = model_best.gfmo_sample(
+        classifiers,
         T=args.fm_sampling_steps,
         O=args.fm_O,
         K=fm_K,
         num_solutions=args.fm_num_solutions,
         distance=args.fm_distance_metrics,
         init_method=args.fm_init_method,
-        g_t=args.fm_gt,
+        init_assignment=args.fm_init_assignment,
+        g_t=args.fm_gt if g_t is None else g_t,
         task=task,
         task_name=task_name,
         t_threshold=args.fm_threshold,
         adaptive=args.fm_adaptive,
-        gamma=args.fm_gamma,
+        gamma=args.fm_gamma if gamma is None else gamma,
+        solver=get_solver(args.fm_solver, rtol=args.fm_rtol, atol=args.fm_atol),
+        n_populations=len(seeds),
+        hv_method=args.hv_method,
+        init_candidates=init_candidates,
+        hv_trace=getattr(args, "fm_hv_trace", False),
+        seeds=seeds,
     )
+    if len(seeds) == 1:
+        samples = [samples]
+    return samples
+
 
+def get_sampling_results(args, task, x_samples):
+    """
+    x_samples: the pareto set returned by gfmo_sample
+    return: the solutions in the design space of the task and their scores
+    """
     # Denormalize the solutions
     res_x = x_samples
     if args.normalization:
         res_x = task.denormalize_x(res_x)
 
     if task.is_discrete:
-        res_x = res_x.reshape(-1, dim, n_classes)
+        dim = task.input_shape[0]
+        res_x = res_x.reshape(-1, dim, res_x.shape[1] // dim)
         res_x = task.to_integers(res_x)
     if task.is_sequence:
         res_x = task.to_integers(res_x)
@@ -303,6 +504,14 @@ def sampling(args):
     if res_y.shape[0] != res_x.shape[0]:
         res_y = res_y.T
 
+    return res_x, res_y
+
+
+def save_sampling_results(args, seed, task, task_name, x_samples, hv_results):
+    name = get_sampling_name(args, task_name, seed)
+
+    res_x, res_y = get_sampling_results(args, task, x_samples)
+
     # Store the results
     if not (os.path.exists(args.samples_store_path)):
         os.makedirs(args.samples_store_path)
@@ -334,22 +543,7 @@ def evaluation(args):
     #     task.map_normalize_y()
 
     # Get the data
-    name = (
-        args.fm_prob_path
-        + "_"
-        + str(args.fm_sampling_steps)
-        + "_"
-        + task_name
-        + "_"
-        + str(args.seed)
-        + f"_K={args.fm_K}"
-        + "_"
-        + f"O={args.fm_O}"
-        + "_"
-        + f"gt={args.fm_gt}"
-        + "_"
-        + f"gamma={args.fm_gamma}"
-    )
+    name = get_sampling_name(args, task_name, args.seed)
     res_x = np.load(args.samples_store_path + name + "_x.npy")
     res_y = np.load(args.samples_store_path + name + "_y.npy")
     print(f"Loaded the generated samples from {args.samples_store_path}")
@@ -360,41 +554,8 @@ def evaluation(args):
     res_x = res_x[np.where(visible_masks == 1)[0]]
     res_y = res_y[np.where(visible_masks == 1)[0]]
 
-    res_y_75_percent = get_quantile_solutions(res_y, 0.75)
-    res_y_50_percent = get_quantile_solutions(res_y, 0.50)
-
-    nadir_point = task.nadir_point
     # For calculating hypervolume, we use the min-max normalization
-    res_y = task.normalize_y(res_y, normalization_method="min-max")
-    nadir_point = task.normalize_y(nadir_point, normalization_method="min-max")
-    res_y_50_percent = task.normalize_y(
-        res_y_50_percent, normalization_method="min-max"
-    )
-    res_y_75_percent = task.normalize_y(
-        res_y_75_percent, normalization_method="min-max"
-    )
-
-    _, d_best = task.get_N_non_dominated_solutions(N=256, return_x=False, return_y=True)
-
-    d_best = task.normalize_y(d_best, normalization_method="min-max")
-
-    d_best_hv = hv(nadir_point, d_best, task_name)
-    hv_value = hv(nadir_point, res_y, task_name)
-    hv_value_50_percentile = hv(nadir_point, res_y_50_percent, task_name)
-    hv_value_75_percentile = hv(nadir_point, res_y_75_percent, task_name)
-
-    print(f"Hypervolume (100th): {hv_value:4f}")
-    print(f"Hypervolume (75th): {hv_value_75_percentile:4f}")
-    print(f"Hypervolume (50th): {hv_value_50_percentile:4f}")
-    print(f"Hypervolume (D(best)): {d_best_hv:4f}")
-
-    # Save the results
-    hv_results = {
-        "hypervolume/D(best)": d_best_hv,
-        "hypervolume/100th": hv_value,
-        "hypervolume/75th": hv_value_75_percentile,
-        "hypervolume/50th": hv_value_50_percentile,
-    }
+    hv_results = get_hv_results(task, task_name, res_y, method=args.hv_method)
 
     if not (os.path.exists(args.results_store_path)):
         os.makedirs(args.results_store_path)
@@ -1,20 +1,24 @@
 """This module contains the neural network for the GFMO-Guided Flows in
 Multi-Objective Optimization."""
 
+import copy
 import math
+from contextlib import contextmanager
 
 import numpy as np
 import torch
 import torch.nn as nn
-from pymoo.util.nds.non_dominated_sorting import NonDominatedSorting
+from scipy.optimize import linear_sum_assignment
 from tqdm import tqdm
 
-from gfmo_utils import get_reference_directions
-from offline_moo.off_moo_bench.evaluation.metrics import hv
+from gfmo_solvers import get_solver
+from gfmo_utils import PackedProxyEnsemble, get_reference_directions
+from offline_moo.off_moo_bench.evaluation.hypervolume import HypervolumeArchive
+from offline_moo.off_moo_bench.evaluation.metrics import get_hv_results
+from offline_moo.off_moo_bench.front_index import FrontIndex
 from offline_moo.off_moo_bench.problem.dtlz import DTLZ
 from offline_moo.off_moo_bench.problem.synthetic_func import SyntheticProblem
 from offline_moo.off_moo_bench.utils import get_N_nondominated_indices
-from offline_moo.utils import get_quantile_solutions
 
 # get the device
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -42,6 +46,9 @@ class VectorFieldNet(nn.Module):
 
 
 class FlowMatching(nn.Module):
+    # Neighborhoods of the reference directions, shared by all the sampling runs
+    _neighborhood_cache = {}
+
     def __init__(self, vnet, sigma, D, T, stochastic_euler=False, prob_path="icfm"):
         super(FlowMatching, self).__init__()
 
@@ -69,6 +76,44 @@ class FlowMatching(nn.Module):
 
         self.PI = torch.from_numpy(np.asarray(np.pi))
 
+    def get_checkpoint(self):
+        """
+        return: the hyperparameters and the weights of the model, torch.save of the
+        checkpoint does not pickle the classes, so it is read by FlowMatching.load
+        """
+        return {
+            "config": {
+                "D": self.D,
+                "hidden_size": self.vnet.M,
+                "sigma": self.sigma,
+                "T": self.T,
+                "stochastic_euler": self.stochastic_euler,
+                "prob_path": self.prob_path,
+            },
+            "state_dict": self.state_dict(),
+        }
+
+    @classmethod
+    def load(cls, path, map_location=None):
+        """
+        path: a checkpoint of get_checkpoint, or a pickled FlowMatching
+        return: the model on map_location
+        """
+        checkpoint = torch.load(path, map_location=map_location, weights_only=False)
+        if isinstance(checkpoint, nn.Module):
+            return checkpoint
+        config = checkpoint["config"]
+        model = cls(
+            VectorFieldNet(config["D"], config["hidden_size"]),
+            config["sigma"],
+            config["D"],
+            config["T"],
+            stochastic_euler=config["stochastic_euler"],
+            prob_path=config["prob_path"],
+        )
+        model.load_state_dict(checkpoint["state_dict"])
+        return model.to(map_location) if map_location is not None else model
+
     def log_p_base(self, x, reduction="sum", dim=1):
         log_p = -0.5 * torch.log(2.0 * self.PI) - 0.5 * x**2.0
         if reduction == "mean":
@@ -78,15 +123,40 @@ class FlowMatching(nn.Module):
         else:
             return log_p
 
-    def sample_base(self, x_1):
-        # Gaussian base distribution
-        if self.prob_path == "icfm":
-            return torch.randn_like(x_1)
-        elif self.prob_path == "fm":
-            return torch.randn_like(x_1)
+    def sample_base(self, x_1, generator=None):
+        # Gaussian base distribution, drawn from generator if given
+        if self.prob_path in ["icfm", "fm"]:
+            return FlowMatching.randn_like(x_1, generator=generator)
         else:
             return None
 
+    @classmethod
+    def randn_like(cls, x, generator=None):
+        """
+        generator: a torch.Generator on the device of x, the global generator if None
+        return: standard normal samples with the shape of x
+        """
+        if generator is None:
+            return torch.randn_like(x)
+        return torch.randn(x.shape, generator=generator, dtype=x.dtype, device=x.device)
+
+    @classmethod
+    def get_population_generators(cls, seeds, device):
+        """
+        seeds: one seed per population
+        return: a (base, noise) pair of generators per population. The base samples are
+        drawn on the cpu and the noise on device, as with the global generators seeded
+        by set_seed, so that a population gives the samples of a run with its seed
+        """
+        generators = []
+        for seed in seeds:
+            base = torch.Generator().manual_seed(seed)
+            noise = base
+            if torch.device(device).type != "cpu":
+                noise = torch.Generator(device=device).manual_seed(seed)
+            generators.append((base, noise))
+        return generators
+
     def sample_p_t(self, x_0, x_1, t):
         if self.prob_path == "icfm":
             mu_t = (1.0 - t) * x_0 + t * x_1
@@ -141,9 +211,75 @@ class FlowMatching(nn.Module):
 
         return loss
 
+    @contextmanager
+    def cached_time_embeddings(self, ts):
+        """
+        ts: the times at which the vector field will be evaluated, shape: (T)
+
+        The embeddings of the whole schedule are computed at once and stored as a
+        (T, D) table, embed_time then looks them up by step instead of running
+        the time embedding at every step. The cache is only valid while the weights
+        do not change, so it is dropped when the sampling or evaluation run exits.
+        """
+        previous_cache = getattr(self, "_time_embedding_cache", None)
+        time_device = self.time_embedding[0].weight.device
+        # Same float32 inputs as torch.Tensor([t]) in embed_time
+        ts = torch.as_tensor(ts, dtype=torch.float32).flatten().cpu()
+        with torch.no_grad():
+            # vmap evaluates the embedding of each time exactly as embed_time does, a
+            # plain batched call would round differently and change the samples
+            try:
+                # shape: (T, D)
+                table = torch.func.vmap(self.time_embedding)(
+                    ts.view(-1, 1).to(time_device)
+                )
+            except RuntimeError:
+                # e.g., time embeddings traced by compile_module
+                table = torch.stack(
+                    [self.time_embedding(t.view(1)) for t in ts.to(time_device)]
+                )
+        # The step of every time of the schedule, it is fixed for the whole run
+        steps = {t: step for step, t in enumerate(ts.tolist())}
+        self._time_embedding_cache = (steps, table)
+        try:
+            yield
+        finally:
+            self._time_embedding_cache = previous_cache
+
+    def embed_time(self, t, device=None):
+        """
+        t: the time, a float or a scalar tensor
+        return: the time embedding, shape: (1, D), to be broadcast over the batch
+        """
+        cache = getattr(self, "_time_embedding_cache", None)
+        # Only the times on the host are looked up, reading a time from the device
+        # would wait for it
+        if cache is not None and not (torch.is_tensor(t) and t.device.type != "cpu"):
+            steps, table = cache
+            step = steps.get(float(t))
+            if step is not None:
+                t_embedding = table[step].unsqueeze(0)
+                return t_embedding if device is None else t_embedding.to(device)
+        # Times outside the schedule, e.g., the intermediate stages of the integrators,
+        # are embedded directly and not stored
+        t_embedding = self.time_embedding(
+            torch.Tensor([t]).to(self.time_embedding[0].weight.device)
+        ).unsqueeze(0)
+        return t_embedding if device is None else t_embedding.to(device)
+
     # This is an unconditional sampling process
-    def sample(self, batch_size=64):
-        # Euler method
+    def sample(self, batch_size=64, solver="euler"):
+        """
+        batch_size: the number of samples we want to generate
+        solver: the name of the integrator, or an instance from gfmo_solvers
+        return: the generated samples, shape: (batch_size, D)
+        """
+        solver = get_solver(solver)
+
+        def vnet(x, t):
+            t_embedding = self.embed_time(t, x.device)
+            return self.vnet(x + t_embedding)
+
         # sample x_0 first
         x_t = self.sample_base(torch.empty(batch_size, self.D))
 
@@ -151,12 +287,12 @@ class FlowMatching(nn.Module):
         ts = torch.linspace(0.0, 1.0, self.T)
         delta_t = ts[1] - ts[0]
 
-        for t in ts[1:]:
-            t_embedding = self.time_embedding(torch.Tensor([t]))
-            x_t = x_t + self.vnet(x_t + t_embedding) * delta_t
-            # Stochastic Euler method
-            if self.stochastic_euler:
-                x_t = x_t + torch.randn_like(x_t) * delta_t
+        with self.cached_time_embeddings(ts[1:] - delta_t):
+            for t in ts[1:]:
+                x_t = solver.step(vnet, x_t, t - delta_t, delta_t)
+                # Stochastic Euler method
+                if self.stochastic_euler:
+                    x_t = x_t + torch.randn_like(x_t) * delta_t
 
         x_final = x_t
         return x_final
@@ -167,8 +303,8 @@ class FlowMatching(nn.Module):
         """
         x_t: the noise sample at time t
         t: the time
-        classifiers: a list of classifiers, each is a function that
-        takes x and returns the score on the i-th objective
+        classifiers: a PackedProxyEnsemble, or a list of classifiers, each is a
+        function that takes x and returns the score on the i-th objective
         weights: the weights for each objective
         return: the conditional vector field at time t
 
@@ -185,9 +321,7 @@ class FlowMatching(nn.Module):
             True
         )  # to calculate the gradients of x_t, start a new computation graph, shape: (batch_size, D)
         with torch.no_grad():
-            time_embedding = self.time_embedding(
-                torch.Tensor([t]).to(x_t_.device)
-            )  # shape: (batch_size, D)
+            time_embedding = self.embed_time(t, x_t_.device)  # shape: (1, D)
             x_t_with_time_embedding = (
                 x_t_.detach().data + time_embedding
             )  # shape: (batch_size, D)
@@ -201,11 +335,8 @@ class FlowMatching(nn.Module):
         )  # to use eq6 in the paper, x_1 is a function of x_t_, shape: (batch_size, D)
 
         # calculate the scores from the classifiers as eq 9 in the paper, don't need log here
-        scores = []  # shape: (batch_size, len(classifiers))
-        for classifier in classifiers:
-            scores.append(-1 * classifier(x_1))
         # shape: (batch_size, len(classifiers))
-        scores = torch.stack(scores, dim=1).squeeze()
+        scores = FlowMatching.predict_scores(classifiers, x_1)
         log_value = scores * weights  # shape: (batch_size, len(classifiers))
         log_value = torch.sum(log_value, dim=1)  # shape: (batch_size)
         log_value = torch.sum(
@@ -218,32 +349,33 @@ class FlowMatching(nn.Module):
         )  # align eq5 in the paper, shape: (batch_size, D)
 
     @classmethod
-    def get_neighborhood_indices(cls, weight, objectives_weights, K, distance="cosine"):
+    def predict_scores(cls, classifiers, x):
         """
-        weight: the weight for the objective
-        objectives_weights: the weights for each objective
-        K: the number of samples we want to include in the neighborhood
-        distance: the distance metric to calculate the distance
-        between the weight and the weights of the objectives. The default is cosine angle
-        distance, but can be changed to Euclidean distance
-        return: the indices of the neighborhood samples
+        classifiers: a PackedProxyEnsemble, or a list of classifiers, each is a function
+        that takes x and returns the score on the i-th objective
+        x: the samples to predict the scores, shape: (n, D)
+        return: the negated predictions of the classifiers, shape: (n, len(classifiers))
         """
-        if distance == "cosine":
-            # calculate the cosine similarity between the weight and the weights of
-            # the objectives
-            cos = nn.CosineSimilarity(dim=1)
-            cos_similarities = cos(objectives_weights, weight.unsqueeze(0))
-            # sort the cosine similarities and get the indices of the K nearest neighbors
-            _, indices = torch.topk(cos_similarities, K, largest=True)
-            return indices
+        # All the objectives are predicted in one forward pass with the packed ensemble
+        if isinstance(classifiers, PackedProxyEnsemble):
+            return -1 * classifiers(x)
+        return torch.cat([-1 * classifier(x) for classifier in classifiers], dim=1)
 
-        if distance == "euclidean":
-            # calculate the distance between the weight and the weights of
-            # the objectives based on the Euclidean distance
-            distances = torch.norm(objectives_weights - weight, dim=1)
-            # sort the distances and get the indices of the K nearest neighbors
-            _, indices = torch.topk(distances, K, largest=False)
-            return indices
+    @classmethod
+    def stack_population_values(cls, value, n_populations, population_size):
+        """
+        value: a scalar shared by all the populations, or a list with one value per population
+        n_populations: the number of populations
+        population_size: the number of samples in each population
+        return: the scalar, or the values repeated for each sample, shape: (n_populations * population_size, 1)
+        """
+        if not isinstance(value, (list, tuple)):
+            return value
+        assert (
+            len(value) == n_populations
+        ), "Error: One value per population should be provided"
+        value = torch.tensor(value, dtype=torch.float32, device=device)
+        return value.repeat_interleave(population_size).unsqueeze(1)
 
     # Get Objectives Weights and Number of Samples we want to generate
     @classmethod
@@ -326,21 +458,96 @@ class FlowMatching(nn.Module):
 
             return ts, delta_t
 
+    @classmethod
+    def assign_candidates(cls, scalarized_scores, assignment="greedy"):
+        """
+        scalarized_scores: the scalarized score of every candidate for every weight,
+        shape: (batch_size, N)
+        assignment: greedy: every weight in turn takes its best candidate that is
+        still available, hungarian: the assignment with the largest total score
+        return: the index of the candidate assigned to each weight, shape: (batch_size)
+        """
+        batch_size, N = scalarized_scores.shape
+        assert (
+            N >= batch_size
+        ), "Error: The number of candidates must be at least the batch size"
+        if assignment == "greedy":
+            # Only the bitmask of the available candidates is updated at each pick,
+            # so neither the candidates nor the scores are copied
+            available = torch.ones(N, dtype=torch.bool, device=scalarized_scores.device)
+            best_indices = torch.empty(
+                batch_size, dtype=torch.long, device=scalarized_scores.device
+            )
+            for i in range(batch_size):
+                best_index = torch.argmax(
+                    scalarized_scores[i].masked_fill(~available, float("-inf"))
+                )
+                best_indices[i] = best_index
+                available[best_index] = False
+            return best_indices
+        elif assignment == "hungarian":
+            _, best_indices = linear_sum_assignment(
+                scalarized_scores.cpu().numpy(), maximize=True
+            )
+            return torch.from_numpy(best_indices).to(scalarized_scores.device)
+        else:
+            raise ValueError("Invalid assignment for initializing the pareto set")
+
+    @classmethod
+    def get_init_candidates(cls, task, batch_size):
+        """
+        task: the task to get the offline solutions from
+        batch_size: the number of weights
+        return: the normalized non-dominated offline solutions and their scores that d_best
+        chooses from, shape: (batch_size, D) and (batch_size, len(classifiers))
+        """
+        # Get all solutions from the offline dataset
+        all_x, all_y = task.get_N_non_dominated_solutions(
+            N=batch_size, return_x=True, return_y=True
+        )
+
+        # Preprocess inputs
+        if task.is_discrete:
+            all_x = task.to_logits(all_x)
+            _, dim, n_classes = all_x.shape
+            all_x = all_x.reshape(-1, dim * n_classes)
+        if task.is_sequence:
+            all_x = task.to_logits(all_x)
+        all_x = task.normalize_x(all_x)
+        all_y = task.normalize_y(all_y)
+        return all_x, all_y
+
     def initialize_pareto_set(
-        self, batch_size, objectives_weights=None, task=None, methods="d_best"
+        self,
+        batch_size,
+        objectives_weights=None,
+        task=None,
+        methods="d_best",
+        assignment="greedy",
+        candidates=None,
     ):
         """
         batch_size: the number of samples we want to generate
-        return: the pareto set of the generated samples
+        assignment: how the candidates are assigned to the weights by d_best, greedy
+        or hungarian, see assign_candidates
+        candidates: the normalized offline solutions and scores d_best chooses from, the
+        non-dominated solutions of the task if None
+        return: the pareto set of the generated samples as a tuple of
+        (solutions, scores), shape: (batch_size, D) and (batch_size)
         """
 
         # Initialize the pareto set with empty values
         if methods == "empty_init":
-            pareto_set = [(torch.empty(self.D), float("-inf"))] * batch_size
-            return pareto_set
+            pareto_x = torch.empty(batch_size, self.D).to(device)
+            pareto_scores = torch.full(
+                (batch_size,), float("-inf"), dtype=torch.float64
+            ).to(device)
+            return pareto_x, pareto_scores
         # Initialize the pareto set with the existing best samples from the offline dataset
         elif methods == "d_best":
-            assert task is not None, "Error: The task should be provided"
+            assert (
+                task is not None or candidates is not None
+            ), "Error: The task or the candidates should be provided"
             assert (
                 objectives_weights is not None
             ), "Error: The objectives_weights_list should be provided"
@@ -348,95 +555,153 @@ class FlowMatching(nn.Module):
                 len(objectives_weights) == batch_size
             ), "Error: Length of objectives_weights_list must equal batch_size"
 
-            # Get all solutions from the offline dataset
-            all_x, all_y = task.get_N_non_dominated_solutions(
-                N=batch_size, return_x=True, return_y=True
-            )
-
-            # Preprocess inputs
-            if task.is_discrete:
-                all_x = task.to_logits(all_x)
-                _, dim, n_classes = all_x.shape
-                all_x = all_x.reshape(-1, dim * n_classes)
-            if task.is_sequence:
-                all_x = task.to_logits(all_x)
-            all_x = task.normalize_x(all_x)
-            all_y = task.normalize_y(all_y)
+            if candidates is None:
+                candidates = FlowMatching.get_init_candidates(task, batch_size)
+            all_x, all_y = candidates
 
             # Convert to tensors
             all_x = torch.tensor(all_x).to(device)
             all_y = torch.tensor(all_y).to(device)
 
-            # Initialize Pareto set
-            pareto_set = []
-            remaining_indices = torch.arange(all_x.size(0)).to(device)
+            # Compute the scalarized scores of all candidates for all weights at once
+            # shape: (batch_size, N)
+            scalarized_scores = torch.matmul(objectives_weights.to(device), all_y.T)
 
-            for i in range(batch_size):
-                weights = objectives_weights[i].to(
-                    device
-                )  # Weight vector for position i
+            # Select a different candidate for each weight
+            # shape: (batch_size)
+            best_indices = FlowMatching.assign_candidates(
+                scalarized_scores, assignment=assignment
+            )
 
-                # Compute scalarized scores
-                scalarized_scores = torch.matmul(all_y, weights)
+            # shape: (batch_size, D)
+            pareto_x = all_x[best_indices].float()
+            # shape: (batch_size)
+            pareto_scores = scalarized_scores[
+                torch.arange(batch_size, device=device), best_indices
+            ]
+            return pareto_x, pareto_scores
+        else:
+            raise ValueError("Invalid method for initializing the pareto set")
 
-                # Select the candidate with the best scalarized score
-                best_index = torch.argmax(scalarized_scores)
-                best_x = all_x[best_index]
-                best_score = scalarized_scores[best_index]
+    @classmethod
+    def get_hv_archives(cls, classifiers, pareto_x, n_populations):
+        """
+        classifiers: a PackedProxyEnsemble, or a list of classifiers
+        pareto_x: the initial pareto set of the populations, shape: (batch_size, D)
+        return: a HypervolumeArchive of the predicted objectives (minimization) for each
+        population, starting from its initial pareto set. The reference point is the
+        worst initial value of each objective, moved away by a tenth of their range
+        """
+        with torch.no_grad():
+            # shape: (batch_size, len(classifiers))
+            objectives = -FlowMatching.predict_scores(classifiers, pareto_x.float())
+        objectives = objectives.cpu().numpy().astype(np.float64)
+        archives = []
+        for population_objectives in np.split(objectives, n_populations):
+            worst = population_objectives.max(axis=0)
+            margin = np.maximum(0.1 * (worst - population_objectives.min(axis=0)), 1e-6)
+            archives.append(HypervolumeArchive(worst + margin, population_objectives))
+        return archives
 
-                # Add to Pareto set
-                pareto_set.append((best_x, best_score))
+    @classmethod
+    def update_pareto_set(cls, pareto_x, pareto_scores, candidates_x, candidate_scores):
+        """
+        pareto_x: the solutions in the pareto set, shape: (batch_size, D)
+        pareto_scores: the weighted scores of the solutions in the pareto set, shape: (batch_size)
+        candidates_x: the best new candidate for each weight, shape: (batch_size, D)
+        candidate_scores: the weighted scores of the candidates, shape: (batch_size)
+        return: the updated pareto set as a tuple of (solutions, scores)
+        """
+        # Replace the i-th solution only if the new candidate is strictly better,
+        # done with a single mask so that no per-solution device sync is needed
+        # shape: (batch_size)
+        improved = candidate_scores > pareto_scores
+        pareto_scores = torch.where(
+            improved, candidate_scores.to(pareto_scores.dtype), pareto_scores
+        )
+        # shape: (batch_size, D)
+        pareto_x = torch.where(
+            improved.unsqueeze(1), candidates_x.to(pareto_x.dtype), pareto_x
+        )
+        return pareto_x, pareto_scores
 
-                # Remove the selected candidate from consideration
-                mask = torch.ones(all_x.size(0), dtype=torch.bool).to(device)
-                mask[best_index] = False
-                all_x = all_x[mask]
-                all_y = all_y[mask]
-                remaining_indices = remaining_indices[mask]
+    @classmethod
+    def pairwise_neighborhood_indices(cls, objectives_weights, K, distance="cosine"):
+        """
+        objectives_weights: the weights for each objective, shape: (batch_size, len(classifiers))
+        K: the number of samples we want to include in the neighborhood
+        distance: the distance metric, either cosine or euclidean
+        return: the indices of the K nearest neighbors of every weight, shape: (batch_size, K)
+        """
+        if distance == "cosine":
+            # shape: (batch_size, batch_size)
+            cos_similarities = nn.functional.cosine_similarity(
+                objectives_weights.unsqueeze(1), objectives_weights.unsqueeze(0), dim=-1
+            )
+            # shape: (batch_size, K)
+            _, indices = torch.topk(cos_similarities, K, dim=1, largest=True)
+            return indices
 
-            return pareto_set
-        else:
-            raise ValueError("Invalid method for initializing the pareto set")
+        if distance == "euclidean":
+            # shape: (batch_size, batch_size)
+            distances = torch.norm(
+                objectives_weights.unsqueeze(0) - objectives_weights.unsqueeze(1),
+                dim=-1,
+            )
+            # shape: (batch_size, K)
+            _, indices = torch.topk(distances, K, dim=1, largest=False)
+            return indices
 
     @classmethod
     def all_neighborhood_indices(
         cls, batch_size, objectives_weights, K, distance="cosine"
     ):
-        # Calculate the neighborhood of the diverse samples
-        neighborhood_indices = []
-        for i in range(batch_size):
-            neighborhood_indices.append(
-                cls.get_neighborhood_indices(
-                    objectives_weights[i],
-                    objectives_weights,
-                    K,
-                    distance=distance,
-                )
-            )
+        """
+        batch_size: the number of weights, i.e. the number of samples we generate
+        objectives_weights: the weights for each objective, shape: (batch_size, len(classifiers))
+        K: the number of samples we want to include in the neighborhood
+        distance: the distance metric to use
+        return: the indices of the neighborhood of each weight, shape: (batch_size, K)
+        """
+        # The uniform reference directions only depend on (M, n_partitions), and batch_size
+        # identifies n_partitions for a given M, so the neighborhoods can be reused across runs
+        key = (objectives_weights.shape[1], batch_size, K, distance)
+        cached = cls._neighborhood_cache.get(key)
+        if (
+            cached is not None
+            and cached[0].device == objectives_weights.device
+            and torch.equal(cached[0], objectives_weights)
+        ):
+            return cached[1]
+
+        # Calculate the neighborhood of all the weights at once
         # shape: (batch_size, K)
-        neighborhood_indices = torch.stack(neighborhood_indices, dim=0)
+        neighborhood_indices = cls.pairwise_neighborhood_indices(
+            objectives_weights, K, distance=distance
+        )
+        cls._neighborhood_cache[key] = (
+            objectives_weights.clone(),
+            neighborhood_indices,
+        )
         return neighborhood_indices
 
     def calculate_scores(
         self, batch_size, t, O, classifiers, batch_diverse_samples, **kwargs
     ):
         """
-        classifiers: a list of classifiers, each is a function that takes x
-        and returns the score on the i-th objective
+        classifiers: a PackedProxyEnsemble, or a list of classifiers, each is a function
+        that takes x and returns the score on the i-th objective
         merged_samples_x_1: the samples to predict the scores
         return: the scores for the samples, merged_samples_x_1, shape: (batch_size * O, D)
         """
         # Predict the scores for the diverse samples
-        scores = []  # shape: (batch_size, O, len(classifiers))
         # shape: (batch_size * O, D)
         merged_samples = batch_diverse_samples.view(-1, self.D)
         with torch.no_grad():
             # Since the classifiers are trained for x_1, we need to convert the samples
             # to x_1 first
-            # shape: (batch_size * O, D)
-            time_embedding = self.time_embedding(
-                torch.Tensor([t]).to(merged_samples.device)
-            ).repeat(batch_size * O, 1)
+            # shape: (1, D), broadcast over the samples
+            time_embedding = self.embed_time(t, merged_samples.device)
             # shape: (batch_size * O, D)
             merged_samples_with_time_embedding = merged_samples + time_embedding
             # shape: (batch_size * O, D)
@@ -449,11 +714,9 @@ class FlowMatching(nn.Module):
                 xl = kwargs["xl"]
                 xu = kwargs["xu"]
                 merged_samples_x_1 = torch.clip(merged_samples_x_1, xl, xu)
-            for classifier in classifiers:
-                scores.append(-1 * classifier(merged_samples_x_1))
+            # shape: (batch_size * O, len(classifiers))
+            scores = FlowMatching.predict_scores(classifiers, merged_samples_x_1)
 
-        # shape: (batch_size * O, len(classifiers))
-        scores = torch.stack(scores, dim=1)
         # shape: (batch_size, O, len(classifiers))
         scores = scores.view(batch_size, O, len(classifiers))
         # shape: (batch_size, O, len(classifiers))
@@ -470,12 +733,10 @@ class FlowMatching(nn.Module):
         """
         # shape: (batch_size, K * O, 1)
         angle_filter_mask = angles <= (1 / 2 * phi.unsqueeze(1))
-        # # Set mask to all False
-        # angle_filter_mask[:] = False
         # If there is no sample that satisfies the condition, we keep the sample with the smallest angle
-        # shape: (batch_size, 1)
-        for i in range(batch_size):
-            angle_filter_mask[i, torch.argmin(angles[i])] = True
+        # shape: (batch_size, 1, 1)
+        min_angle_indices = torch.argmin(angles, dim=1, keepdim=True)
+        angle_filter_mask = angle_filter_mask.scatter(1, min_angle_indices, True)
         # If the angle is smaller than phi_i, we keep the sample, otherwise we set the score to -inf
         return angle_filter_mask
 
@@ -492,9 +753,8 @@ class FlowMatching(nn.Module):
         # Calculate the lower bound and upper bound at time t
         # shape: (batch_size * O, D), get u_t first
         with torch.no_grad():
-            time_embedding = self.time_embedding(
-                torch.Tensor([t]).to(solutions.device)
-            ).repeat(solutions.shape[0], 1)
+            # shape: (1, D), broadcast over the solutions
+            time_embedding = self.embed_time(t, solutions.device)
             solutions_with_time_embedding = solutions + time_embedding
             u_t = self.vnet(solutions_with_time_embedding)
 
@@ -508,29 +768,106 @@ class FlowMatching(nn.Module):
 
         return x_t
 
+    @classmethod
+    def close_pairs(cls, solutions, atol=1e-3, rtol=1e-5, max_pairs=2**22):
+        """
+        solutions: the solutions to be checked, shape: (n, D)
+        atol, rtol: the tolerances of torch.allclose
+        max_pairs: the number of candidate pairs compared at once
+        return: the indices i and j, i > j, of all pairs with
+        torch.allclose(solutions[i], solutions[j]), shape: (n_pairs) and (n_pairs)
+        """
+        n = solutions.shape[0]
+        empty = torch.empty(0, dtype=torch.long, device=solutions.device)
+        if n < 2 or solutions.numel() == 0:
+            return empty, empty
+        # Two close solutions are close on every coordinate, so after sorting the
+        # solutions along the coordinate with the largest spread, only the solutions
+        # inside a window of that coordinate need to be compared
+        spread = solutions.max(dim=0).values - solutions.min(dim=0).values
+        key = solutions[:, torch.argmax(torch.nan_to_num(spread, nan=-1.0))]
+        sorted_key, order = torch.sort(key, stable=True)
+        # Twice the largest tolerance, so that rounding never drops a close pair
+        finite = solutions[torch.isfinite(solutions)]
+        max_abs = finite.abs().max() if finite.numel() > 0 else 0.0
+        window = 2 * (atol + rtol * max_abs)
+        # shape: (n), the end of the window of each sorted solution
+        window_end = torch.searchsorted(sorted_key, sorted_key + window, right=True)
+        positions = torch.arange(n, device=solutions.device)
+        counts = (window_end - positions - 1).clamp(min=0)
+
+        close_i, close_j = [], []
+        start = 0
+        cumulative_counts = torch.cumsum(counts, dim=0).tolist()
+        while start < n:
+            # The largest chunk of sorted solutions with at most max_pairs pairs
+            offset = cumulative_counts[start - 1] if start > 0 else 0
+            end = int(
+                np.searchsorted(cumulative_counts, offset + max_pairs, side="right")
+            )
+            end = min(max(end, start + 1), n)
+            chunk_counts = counts[start:end]
+            n_pairs = int(chunk_counts.sum())
+            if n_pairs > 0:
+                # shape: (n_pairs), the sorted positions of the pairs
+                first = torch.repeat_interleave(positions[start:end], chunk_counts)
+                pair_starts = torch.cumsum(chunk_counts, dim=0) - chunk_counts
+                second = (
+                    first
+                    + 1
+                    + torch.arange(n_pairs, device=solutions.device)
+                    - torch.repeat_interleave(pair_starts, chunk_counts)
+                )
+                a, b = order[first], order[second]
+                i, j = torch.maximum(a, b), torch.minimum(a, b)
+                # Same test as torch.allclose(solutions[i], solutions[j])
+                is_close = torch.isclose(
+                    solutions[i], solutions[j], rtol=rtol, atol=atol
+                ).all(dim=-1)
+                close_i.append(i[is_close])
+                close_j.append(j[is_close])
+            start = end
+        if not close_i:
+            return empty, empty
+        return torch.cat(close_i), torch.cat(close_j)
+
+    @classmethod
+    def unique_solutions_mask(cls, solutions, atol=1e-3):
+        """
+        solutions: the solutions to be checked, shape: (n, D)
+        atol: the absolute tolerance of torch.allclose
+        return: a mask of the solutions that are kept when every solution is compared
+        with the solutions kept before it, shape: (n)
+        """
+        n = solutions.shape[0]
+        close_i, close_j = FlowMatching.close_pairs(solutions, atol=atol)
+        keep = np.ones(n, dtype=bool)
+        if len(close_i) > 0:
+            close_i, close_j = close_i.cpu().numpy(), close_j.cpu().numpy()
+            order = np.lexsort((close_j, close_i))
+            close_i, close_j = close_i[order], close_j[order]
+            # Only the solutions close to an earlier one need the sequential pass,
+            # a solution is dropped if any of its earlier close solutions is kept
+            group_starts = np.flatnonzero(np.diff(close_i, prepend=-1))
+            group_ends = np.append(group_starts[1:], len(close_i))
+            for group_start, group_end in zip(group_starts, group_ends):
+                if keep[close_j[group_start:group_end]].any():
+                    keep[close_i[group_start]] = False
+        return torch.from_numpy(keep).to(solutions.device)
+
     @classmethod
     def check_duplicates(cls, pareto_set):
         """
         pareto_set: the pareto set to be checked. Tuple of (solution, score), solution is a tensor, score is a float
         return: the number of duplicates in the pareto set
         """
+        if len(pareto_set) == 0:
+            return 0
         # Get all solutions, change dtype to float tensor
-        solutions = [solution[0].float() for solution in pareto_set]
+        solutions = torch.stack([solution[0].float() for solution in pareto_set])
         # Check duplicates, if the two tensors are close enough, we consider them as duplicates
-        unique_solutions = []
-        for solution in solutions:
-            if unique_solutions == []:
-                unique_solutions.append(solution)
-                continue
-            else:
-                is_duplicate = False
-                for unique_solution in unique_solutions:
-                    if torch.allclose(solution, unique_solution, atol=1e-3):
-                        is_duplicate = True
-                        break
-                if not is_duplicate:
-                    unique_solutions.append(solution)
-        return len(solutions) - len(unique_solutions)
+        unique_mask = FlowMatching.unique_solutions_mask(solutions, atol=1e-3)
+        return len(solutions) - int(unique_mask.sum())
 
     @classmethod
     def remove_duplicates(cls, pareto_set):
@@ -539,29 +876,34 @@ class FlowMatching(nn.Module):
         return: the pareto set without duplicates
         """
         pareto_set = [solution.float() for solution in pareto_set]
-        unique_solutions = []
-        for solution in pareto_set:
-            if unique_solutions == []:
-                unique_solutions.append(solution)
-                continue
-            else:
-                is_duplicate = False
-                for unique_solution in unique_solutions:
-                    if torch.allclose(solution, unique_solution, atol=1e-3):
-                        is_duplicate = True
-                        break
-                if not is_duplicate:
-                    unique_solutions.append(solution)
-        return unique_solutions
+        if len(pareto_set) == 0:
+            return pareto_set
+        unique_mask = FlowMatching.unique_solutions_mask(
+            torch.stack(pareto_set), atol=1e-3
+        )
+        return [
+            solution
+            for solution, is_unique in zip(pareto_set, unique_mask.tolist())
+            if is_unique
+        ]
 
     @classmethod
     def get_N_non_dominated_solutions(cls, res_x, res_y, N, classifiers):
-        predicted_scores = []
+        """
+        res_x: the candidate solutions, shape: (n, D)
+        res_y: the scores of the candidates, shape: (n, n_obj)
+        N: the number of solutions to keep
+        classifiers: the proxies that rank the candidates
+        return: the N best candidates and their scores by non-dominated sorting of the
+        predictions, shape: (N, D) and (N, n_obj)
+        """
+        # res_x is decoded back to numpy by the caller
         with torch.no_grad():
-            for classifier in classifiers:
-                predicted_scores.append(-1 * classifier(res_x))
-        predicted_res_y = torch.stack(predicted_scores, dim=1).squeeze()
-        fronts = NonDominatedSorting().do(predicted_res_y)
+            predicted_res_y = FlowMatching.predict_scores(
+                classifiers, torch.as_tensor(res_x, dtype=torch.float32, device=device)
+            )
+        predicted_res_y = predicted_res_y.cpu().numpy().astype(np.float64)
+        fronts = FrontIndex(predicted_res_y).fronts
         N_best_indices = get_N_nondominated_indices(
             Y=predicted_res_y, num_ret=N, fronts=fronts
         )
@@ -577,15 +919,22 @@ class FlowMatching(nn.Module):
         distance="cosine",
         g_t=0.1,
         init_method="d_best",
+        init_assignment="greedy",
         task=None,
         task_name=None,
         t_threshold=0.8,
         adaptive=False,
         gamma=2.0,
+        solver="euler",
+        n_populations=1,
+        hv_method="exact",
+        init_candidates=None,
+        hv_trace=False,
+        seeds=None,
     ):
         """
-        classifiers: a list of classifiers, each is a function that takes x
-        and returns the score on the i-th objective
+        classifiers: a PackedProxyEnsemble, or a list of classifiers, each is a function
+        that takes x and returns the score on the i-th objective
         T: the number of steps to run the algorithm
         O: the number of offspring to generate at each step
         K: the number of neighborhoods to consider
@@ -593,10 +942,34 @@ class FlowMatching(nn.Module):
         distance: the distance metric to use
         g_t: the step size for the stochastic Euler method
         init_method: the method to initialize the pareto set
+        init_assignment: how d_best assigns the offline solutions to the weights,
+        greedy or hungarian
         t_threshold: the threshold for the time step
         adaptive: whether to use the adaptive time step
         gamma: the gamma parameter for the weighted sum of the scores
+        solver: the name of the integrator, or an instance from gfmo_solvers.
+        The classifier guidance is applied in the vector field every integrator calls
+        n_populations: the number of independent populations sampled together. They are
+        stacked along the batch axis so that the vector field and the proxies run once per
+        step for all of them. g_t and gamma can be given as one value per population.
+        With an adaptive solver, every population is integrated with its own copy of the
+        solver, so that its sub-steps only depend on its own error
+        hv_method: how the hypervolume results are computed, exact, mc (a quasi
+        Monte-Carlo estimate with its standard error) or auto
+        init_candidates: the normalized offline solutions and scores of the d_best
+        initialization, e.g., from an InferenceBundle, taken from the task if None
+        hv_trace: whether to monitor the hypervolume of the predicted objectives of the
+        selected candidates at every guided step, see get_hv_archives. It is returned
+        as sampling/hv_trace in the hypervolume results
+        seeds: one seed per population. Every population draws its base samples and its
+        noise from its own generators, see get_population_generators, the global
+        generators are used if None
+        return: the pareto set and the hypervolume results, or a list of them for each
+        population if n_populations > 1
         """
+        solver = get_solver(solver)
+        solver.reset()
+
         # Obtain objectives weights and the number of samples we want to generate
         # shape: (batch_size, len(classifiers))
         objectives_weights, batch_size = FlowMatching.calculate_objectives_weights(
@@ -604,12 +977,14 @@ class FlowMatching(nn.Module):
         )
 
         # the pareto set of the generated samples
-        # shape: (batch_size, D)
-        pareto_set = self.initialize_pareto_set(
+        # shape: (batch_size, D) and (batch_size)
+        pareto_x, pareto_scores = self.initialize_pareto_set(
             batch_size,
             objectives_weights=objectives_weights,
             task=task,
             methods=init_method,
+            assignment=init_assignment,
+            candidates=init_candidates,
         )
 
         # Calculate the neighborhood of the diverse samples
@@ -640,6 +1015,60 @@ class FlowMatching(nn.Module):
         # because the angle with itself is 0
         phi = 2 * m_closest_angles.sum(dim=1) / len(classifiers)
 
+        # Stack the populations along the batch axis. Every population has its own copy of
+        # the objectives weights and of the pareto set, and its neighborhoods are offset so
+        # that they never reach into another population
+        population_size = batch_size
+        if n_populations > 1:
+            batch_size = population_size * n_populations
+            # shape: (batch_size)
+            offsets = (
+                torch.arange(n_populations, device=neighborhood_indices.device)
+                * population_size
+            ).repeat_interleave(population_size)
+            # shape: (batch_size, K)
+            neighborhood_indices = neighborhood_indices.repeat(
+                n_populations, 1
+            ) + offsets.unsqueeze(1)
+            # shape: (batch_size, len(classifiers))
+            objectives_weights = objectives_weights.repeat(n_populations, 1)
+            # shape: (batch_size, 1)
+            phi = phi.repeat(n_populations, 1)
+            # shape: (batch_size, D) and (batch_size)
+            pareto_x = pareto_x.repeat(n_populations, 1)
+            pareto_scores = pareto_scores.repeat(n_populations)
+        # shape: (batch_size, 1) if one value is given per population
+        gamma = FlowMatching.stack_population_values(
+            gamma, n_populations, population_size
+        )
+        g_t = FlowMatching.stack_population_values(g_t, n_populations, population_size)
+        if torch.is_tensor(g_t):
+            # shape: (batch_size, 1, 1), to broadcast over the offspring
+            g_t = g_t.unsqueeze(-1)
+
+        # The generators of the populations
+        generators = None
+        if seeds is not None:
+            assert (
+                len(seeds) == n_populations
+            ), "Error: One seed per population should be given"
+            generators = FlowMatching.get_population_generators(seeds, device)
+
+        # One hypervolume archive per population for the monitoring
+        hv_archives = None
+        hv_traces = [None] * n_populations
+        if hv_trace:
+            hv_archives = FlowMatching.get_hv_archives(
+                classifiers, pareto_x, n_populations
+            )
+            hv_traces = [[] for _ in range(n_populations)]
+
+        # The sub-steps of an adaptive solver depend on the error of the samples it
+        # integrates, so every population gets its own solver and is integrated apart
+        population_solvers = None
+        if n_populations > 1 and solver.adaptive:
+            population_solvers = [copy.deepcopy(solver) for _ in range(n_populations)]
+
         # Algorithm 1 in the paper
         # go step-by-step to x_1 (data)
         ts, delta_t = FlowMatching.get_ts_and_delta_t(
@@ -695,26 +1124,73 @@ class FlowMatching(nn.Module):
             need_repair = False
 
         # use tqdm for progress bar
-        with tqdm(total=T, desc="Conditional Sampling", unit="step") as pbar:
+        # The vector field is evaluated at the start of every interval of the schedule,
+        # the scores and the repair at its end
+        schedule = [t - delta_t(t) for t in ts[1:]] + list(ts[1:])
+        with self.cached_time_embeddings(schedule), tqdm(
+            total=T, desc="Conditional Sampling", unit="step"
+        ) as pbar:
             # sample x_0 first, offspring
             # shape: (batch_size, D)
-            x_t = self.sample_base(torch.empty(batch_size, self.D)).to(device)
+            if generators is None:
+                x_t = self.sample_base(torch.empty(batch_size, self.D)).to(device)
+            else:
+                x_t = torch.cat(
+                    [
+                        self.sample_base(
+                            torch.empty(population_size, self.D), generator=base
+                        )
+                        for base, _ in generators
+                    ],
+                    dim=0,
+                ).to(device)
 
             # Euler method
             count = 0
             for t in ts[1:]:
                 count += 1
-                # this is x_t + v(x_t, t, y) * delta_t
+                # this is x_t + v(x_t, t, y) * delta_t for the Euler method
                 # shape: (batch_size, D)
-                x_t = x_t + self.weighted_conditional_vnet(
-                    x_t,
-                    t - delta_t(t),
-                    classifiers,
-                    weights=objectives_weights,
-                    gamma=gamma,
-                    t_threshold=t_threshold,
-                    delta_t=delta_t(t),
-                ) * delta_t(t)
+                d_t = delta_t(t)
+                if population_solvers is None:
+                    x_t = solver.step(
+                        lambda x, s: self.weighted_conditional_vnet(
+                            x,
+                            s,
+                            classifiers,
+                            weights=objectives_weights,
+                            gamma=gamma,
+                            t_threshold=t_threshold,
+                            delta_t=d_t,
+                        ),
+                        x_t,
+                        t - d_t,
+                        d_t,
+                    )
+                else:
+                    population_x_t = []
+                    for i, population_solver in enumerate(population_solvers):
+                        rows = slice(i * population_size, (i + 1) * population_size)
+                        population_x_t.append(
+                            population_solver.step(
+                                lambda x, s, rows=rows: self.weighted_conditional_vnet(
+                                    x,
+                                    s,
+                                    classifiers,
+                                    weights=objectives_weights[rows],
+                                    gamma=(
+                                        gamma[rows] if torch.is_tensor(gamma) else gamma
+                                    ),
+                                    t_threshold=t_threshold,
+                                    delta_t=d_t,
+                                ),
+                                x_t[rows],
+                                t - d_t,
+                                d_t,
+                            )
+                        )
+                    # shape: (batch_size, D)
+                    x_t = torch.cat(population_x_t, dim=0)
                 if t < t_threshold:
                     if need_repair:
                         x_t = self.repair_boundary(
@@ -730,9 +1206,25 @@ class FlowMatching(nn.Module):
                 # shape: (batch_size, O, D)
                 batch_diverse_samples = x_t.unsqueeze(1).repeat(1, O, 1)
                 # shape: (batch_size, O, D)
-                batch_diverse_samples = batch_diverse_samples + g_t * torch.randn_like(
-                    batch_diverse_samples
-                ) * torch.sqrt(delta_t(t))
+                if generators is None:
+                    noise = torch.randn_like(batch_diverse_samples)
+                else:
+                    noise = torch.cat(
+                        [
+                            FlowMatching.randn_like(
+                                population_samples, generator=generator
+                            )
+                            for population_samples, (_, generator) in zip(
+                                batch_diverse_samples.split(population_size, dim=0),
+                                generators,
+                            )
+                        ],
+                        dim=0,
+                    )
+                # shape: (batch_size, O, D)
+                batch_diverse_samples = (
+                    batch_diverse_samples + g_t * noise * torch.sqrt(delta_t(t))
+                )
 
                 # Repair the boundary of the samples
                 if need_repair:
@@ -800,42 +1292,99 @@ class FlowMatching(nn.Module):
                 weighted_scores[~angle_filter_mask] = float("-inf")
                 # Choose the sample with the highest score as the next offspring
                 # shape: (batch_size)
-                index = torch.argmax(weighted_scores.squeeze(), dim=1)
+                best_scores, index = torch.max(weighted_scores.squeeze(-1), dim=1)
 
-                # shape: (batch_size, K, O, D)
-                neighborhood_designs = batch_diverse_samples[neighborhood_indices]
-                # shape: (batch_size, K * O, D)
-                neighborhood_designs = neighborhood_designs.view(
-                    batch_size, K * O, self.D
-                )
+                # Map the index within the neighborhood back to (weight, offspring) indices,
+                # so that only the selected designs are gathered
+                # shape: (batch_size)
+                arange = torch.arange(batch_size, device=index.device)
+                neighbor_index = neighborhood_indices[arange, index // O]
+                offspring_index = index % O
                 # Use the index to get the next offspring
                 # shape: (batch_size, D)
-                next_offspring = neighborhood_designs[torch.arange(batch_size), index]
+                next_offspring = batch_diverse_samples[neighbor_index, offspring_index]
 
                 # Update the pareto set. If the new offspring is better than the i-th solution in the pareto set,
                 # replace the i-th solution with the new offspring
-                for i in range(batch_size):
-                    if weighted_scores[i, index[i]] > pareto_set[i][1]:
-                        # shape: (K, O, D)
-                        candidates = merged_samples_x_1[neighborhood_indices[i]]
-                        # shape: (K * O, D)
-                        candidates = candidates.view(K * O, self.D)
-                        # shape: (D)
-                        pareto_set[i] = (
-                            candidates[index[i]].squeeze(),
-                            weighted_scores[i, index[i]],
-                        )
+                pareto_x, pareto_scores = FlowMatching.update_pareto_set(
+                    pareto_x,
+                    pareto_scores,
+                    merged_samples_x_1[neighbor_index, offspring_index],
+                    best_scores,
+                )
+                if hv_archives is not None:
+                    # The predicted objectives of the selected candidates
+                    # shape: (batch_size, len(classifiers))
+                    candidate_objectives = (
+                        -scores[neighbor_index, offspring_index].cpu().numpy()
+                    )
+                    for archive, trace, population_objectives in zip(
+                        hv_archives,
+                        hv_traces,
+                        np.split(candidate_objectives, n_populations),
+                    ):
+                        for objectives in population_objectives:
+                            archive.add(objectives)
+                        trace.append(archive.value)
                 # Update x_t
                 x_t = next_offspring
                 pbar.update(1)
 
-        temp_pareto_set = [pareto_set[i][0] for i in range(batch_size)]
+        if n_populations == 1:
+            return self.finalize_pareto_set(
+                pareto_x,
+                classifiers,
+                num_solutions,
+                task,
+                task_name,
+                solver,
+                hv_method=hv_method,
+                hv_trace=hv_traces[0],
+            )
+        # Every population is filtered and evaluated on its own
+        if population_solvers is None:
+            population_solvers = [solver] * n_populations
+        return [
+            self.finalize_pareto_set(
+                population_x,
+                classifiers,
+                num_solutions,
+                task,
+                task_name,
+                population_solver,
+                hv_method=hv_method,
+                hv_trace=population_trace,
+            )
+            for population_x, population_solver, population_trace in zip(
+                pareto_x.split(population_size, dim=0), population_solvers, hv_traces
+            )
+        ]
+
+    def finalize_pareto_set(
+        self,
+        pareto_x,
+        classifiers,
+        num_solutions,
+        task,
+        task_name,
+        solver,
+        hv_method="exact",
+        hv_trace=None,
+    ):
+        """
+        pareto_x: the pareto set of one population, shape: (batch_size, D)
+        hv_trace: the hypervolume at every guided step, see gfmo_sample
+        return: the pareto set as a numpy array and the hypervolume results
+        """
+        temp_pareto_set = pareto_x.float()
         # Remove duplicates in the pareto set, because they are not contributing to the hypervolume
-        temp_pareto_set = FlowMatching.remove_duplicates(temp_pareto_set)
+        temp_pareto_set = temp_pareto_set[
+            FlowMatching.unique_solutions_mask(temp_pareto_set, atol=1e-3)
+        ]
         assert (
             len(temp_pareto_set) >= num_solutions
         ), "Error: The number of solutions in the pareto set is less than the number of solutions we want to keep"
-        temp_pareto_set = torch.stack(temp_pareto_set, dim=0).squeeze()
+        temp_pareto_set = temp_pareto_set.squeeze()
         temp_pareto_set = task.denormalize_x(temp_pareto_set.cpu().detach().numpy())
         if task.is_discrete:
             temp_pareto_set = temp_pareto_set.reshape(
@@ -844,8 +1393,6 @@ class FlowMatching(nn.Module):
             temp_pareto_set = task.to_integers(temp_pareto_set)
         if task.is_sequence:
             temp_pareto_set = task.to_integers(temp_pareto_set)
-        nadir_point = task.nadir_point
-        # For calculating hypervolume, we use the min-max normalization
         res_x = temp_pareto_set
         res_y = task.predict(res_x)
         # Do a non-dominated sorting to get the pareto set
@@ -863,83 +1410,71 @@ class FlowMatching(nn.Module):
         res_x = res_x[np.where(visible_masks == 1)[0]]
         res_y = res_y[np.where(visible_masks == 1)[0]]
 
-        res_y_75_percent = get_quantile_solutions(res_y, 0.75)
-        res_y_50_percent = get_quantile_solutions(res_y, 0.50)
         # To calculate hypervolume, we use the min-max normalization as suggested by the benchmark
-        res_y = task.normalize_y(res_y, normalization_method="min-max")
-        nadir_point = task.normalize_y(nadir_point, normalization_method="min-max")
-        res_y_50_percent = task.normalize_y(
-            res_y_50_percent, normalization_method="min-max"
-        )
-        res_y_75_percent = task.normalize_y(
-            res_y_75_percent, normalization_method="min-max"
-        )
-
-        _, d_best = task.get_N_non_dominated_solutions(
-            N=256, return_x=False, return_y=True
-        )
-
-        d_best = task.normalize_y(d_best, normalization_method="min-max")
-
-        d_best_hv = hv(nadir_point, d_best, task_name)
-        hv_value = hv(nadir_point, res_y, task_name)
-        hv_value_50_percentile = hv(nadir_point, res_y_50_percent, task_name)
-        hv_value_75_percentile = hv(nadir_point, res_y_75_percent, task_name)
-
-        # print(f"Pareto Set: {pareto_set}")
-        print(f"Hypervolume (100th): {hv_value:4f}")
-        print(f"Hypervolume (75th): {hv_value_75_percentile:4f}")
-        print(f"Hypervolume (50th): {hv_value_50_percentile:4f}")
-        print(f"Hypervolume (D(best)): {d_best_hv:4f}")
-        # Save the results
-        hv_results = {
-            "hypervolume/D(best)": d_best_hv,
-            "hypervolume/100th": hv_value,
-            "hypervolume/75th": hv_value_75_percentile,
-            "hypervolume/50th": hv_value_50_percentile,
-        }
-        pareto_set = [
-            pareto_set[i][0] for i in range(batch_size)
-        ]  # shape: (batch_size, D)
-        pareto_set = torch.stack(pareto_set, dim=0).squeeze()  # shape: (batch_size, D)
+        hv_results = get_hv_results(task, task_name, res_y, method=hv_method)
+        print(f"Number of function evaluations ({solver.name}): {solver.nfe}")
+        hv_results["sampling/nfe"] = solver.nfe
+        if hv_trace is not None:
+            hv_results["sampling/hv_trace"] = hv_trace
+        pareto_set = pareto_x.squeeze()  # shape: (batch_size, D)
         # convert to numpy array
         pareto_set = pareto_set.cpu().detach().numpy()
         # We return all the pareto set and save them to the file
         # Filter samples later during evaluation if needed
         return pareto_set, hv_results
 
-    def log_prob(self, x_1, reduction="mean"):
+    @classmethod
+    def hutchinson_probe(cls, x, probe="gaussian"):
+        """
+        x: the samples at which the divergence is estimated, shape: (batch_size, D)
+        probe: gaussian draws a new epsilon ~ Normal(0, I) for every sample, rademacher
+        uses one fixed +-1 vector shared by the whole batch and by every call, so that
+        the validation scores of different epochs are comparable
+        return: the probe, shape: (batch_size, D) or (1, D)
+        """
+        if probe == "gaussian":
+            return torch.randn_like(x)
+        if probe == "rademacher":
+            generator = torch.Generator().manual_seed(0)
+            e = torch.randint(0, 2, (1, x.shape[1]), generator=generator) * 2 - 1
+            return e.to(device=x.device, dtype=x.dtype)
+        raise ValueError(f"Unknown probe: {probe}")
+
+    def log_prob(self, x_1, reduction="mean", steps=None, probe="gaussian"):
+        """
+        x_1: the samples to evaluate, shape: (batch_size, D)
+        steps: the number of backward Euler steps, self.T if None
+        probe: the probe of the Hutchinson trace estimator, gaussian or rademacher
+        return: the log-likelihood of x_1, it is used for validation and carries no gradients
+        """
         # backward Euler (see Appendix C in Lipman's paper)
-        ts = torch.linspace(1.0, 0.0, self.T)
+        ts = torch.linspace(1.0, 0.0, self.T if steps is None else steps)
         delta_t = ts[1] - ts[0]
 
-        for t in ts:
-            if t == 1.0:
-                x_t = x_1 * 1.0
-                f_t = 0.0
-            else:
+        # Only the divergence at the end of the trajectory enters the log-likelihood,
+        # so the trajectory is integrated without building a computation graph
+        x_t = x_1 * 1.0
+        with self.cached_time_embeddings(ts[1:]), torch.no_grad():
+            for t in ts[1:]:
                 # Calculate phi_t
-                t_embedding = self.time_embedding(torch.Tensor([t]).to(x_1.device))
+                t_embedding = self.embed_time(t, x_1.device)
                 x_t = x_t - self.vnet(x_t + t_embedding) * delta_t
 
-                # Calculate f_t
-                # approximate the divergence using the Hutchinson trace estimator and the autograd
-                self.vnet.eval()  # set the vector field net to evaluation
-
-                x = torch.tensor(
-                    x_t.data, device=x_1.device
-                )  # copy the original data (it doesn't require grads!)
-                x.requires_grad = True
+        # Calculate f_t
+        # approximate the divergence using the Hutchinson trace estimator and the autograd
+        self.vnet.eval()  # set the vector field net to evaluation
 
-                e = torch.randn_like(x).to(x_1.device)  # epsilon ~ Normal(0, I)
+        with torch.enable_grad():
+            x = (
+                x_t.detach().clone()
+            )  # copy the original data (it doesn't require grads!)
+            x.requires_grad = True
 
-                e_grad = torch.autograd.grad(self.vnet(x).sum(), x, create_graph=True)[
-                    0
-                ]
-                e_grad_e = e_grad * e
-                f_t = e_grad_e.view(x.shape[0], -1).sum(dim=1)
+            e = FlowMatching.hutchinson_probe(x, probe=probe)
 
-                self.vnet.eval()  # set the vector field net to train again
+            e_grad = torch.autograd.grad(self.vnet(x).sum(), x)[0]
+        e_grad_e = e_grad * e
+        f_t = e_grad_e.view(x.shape[0], -1).sum(dim=1)
 
         log_p_1 = self.log_p_base(x_t, reduction="sum") - f_t
 
@@ -0,0 +1,341 @@
+"""This module contains the sampling service of GFMO, a long-lived process that keeps the
+task, the models and the offline solutions of the d_best initialization in memory and
+samples on request, so that a request only pays for the sampling itself.
+
+The requests are JSON objects, one per line, read from stdin or from the connections of
+a Unix socket. A request overrides the sampling arguments listed in SERVICE_PARAMETERS,
+e.g., {"id": 1, "seed": 0, "fm_gamma": 2.0, "fm_O": 5}, and {"command": "shutdown"}
+stops the service. Every request gets one JSON line back with its id, the solutions,
+their scores and the hypervolume results, or an error. The requests queued together
+that only differ in SERVICE_POPULATION_PARAMETERS are sampled in one call of gfmo_sample
+as independent populations, each one drawing its samples from the seed of its request,
+which is echoed in the response. On stdin, stdout only carries the responses, the logs
+are written to stderr."""
+
+import argparse
+import contextlib
+import json
+import os
+import queue
+import socketserver
+import sys
+import threading
+from collections import deque
+from time import perf_counter
+
+import numpy as np
+
+import offline_moo.off_moo_bench as ob
+from gfmo_experiments import (
+    get_fm_K,
+    get_sampling_results,
+    load_sampling_models,
+    sample_populations,
+)
+from gfmo_nets import FlowMatching
+from gfmo_utils import ALLTASKSDICT, get_dataset_state, set_dataset_state
+from offline_moo.utils import set_seed
+
+# The arguments a request can override
+SERVICE_PARAMETERS = [
+    "seed",
+    "fm_gamma",
+    "fm_gt",
+    "fm_O",
+    "fm_K",
+    "fm_num_solutions",
+    "fm_sampling_steps",
+    "fm_threshold",
+    "fm_adaptive",
+    "fm_distance_metrics",
+    "fm_init_method",
+    "fm_init_assignment",
+    "fm_solver",
+    "fm_rtol",
+    "fm_atol",
+    "hv_method",
+]
+# The arguments that can differ between the requests of a batch, one value per population
+SERVICE_POPULATION_PARAMETERS = ["seed", "fm_gamma", "fm_gt"]
+
+
+class SamplingService:
+    """
+    Samples the requests of a queue with resident models, see the module docstring
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.max_batch = args.serve_max_batch
+
+        set_seed(args.seed)
+        self.task_name = ALLTASKSDICT[args.task_name]
+        self.task = ob.make(self.task_name)
+        print(f"Task: {self.task_name}")
+        self.model, self.classifiers, init_candidates = load_sampling_models(
+            args, self.task, self.task_name
+        )
+
+        # The reference directions and the offline solutions of the d_best initialization
+        # only depend on the number of objectives, they are computed once
+        _, batch_size = FlowMatching.calculate_objectives_weights(
+            len(self.classifiers), args.fm_num_solutions
+        )
+        if init_candidates is None:
+            init_candidates = FlowMatching.get_init_candidates(self.task, batch_size)
+        self.init_candidates = init_candidates
+        # Every batch starts from the statistics of the preprocessed data
+        self.dataset_state = get_dataset_state(self.task)
+
+        self.queue = queue.Queue()
+        self.pending = deque()
+        print(f"Sampling service ready for {self.task_name}")
+
+    def submit(self, request, respond):
+        """
+        request: the decoded JSON request
+        respond: a function called with the JSON response of the request
+        """
+        self.queue.put((request, respond))
+
+    def close(self):
+        """
+        Stop the service once the requests submitted so far are answered
+        """
+        self.queue.put(None)
+
+    def get_request_args(self, request):
+        """
+        return: the sampling arguments of a request
+        """
+        unknown = set(request) - set(SERVICE_PARAMETERS) - {"id"}
+        if unknown:
+            raise ValueError(f"Unknown request parameters: {sorted(unknown)}")
+        request_args = argparse.Namespace(**vars(self.args))
+        for key in SERVICE_PARAMETERS:
+            if key in request:
+                setattr(request_args, key, request[key])
+        return request_args
+
+    @classmethod
+    def get_batch_key(cls, request_args):
+        """
+        return: the arguments that the requests of a batch should share
+        """
+        return tuple(
+            getattr(request_args, key)
+            for key in SERVICE_PARAMETERS
+            if key not in SERVICE_POPULATION_PARAMETERS
+        )
+
+    def next_batch(self):
+        """
+        return: the oldest request and the queued requests compatible with it, as a list
+        of (request, request arguments, respond), None once the service is closed
+        """
+        if not self.pending:
+            item = self.queue.get()
+            if item is None:
+                return None
+            self.pending.append(item)
+        # Decode the requests that are already queued, without waiting for new ones
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self.queue.put(None)
+                break
+            self.pending.append(item)
+
+        batch = []
+        key = None
+        remaining = deque()
+        while self.pending:
+            request, respond = self.pending.popleft()
+            try:
+                request_args = self.get_request_args(request)
+            except Exception as error:
+                respond({"id": request.get("id"), "error": str(error)})
+                continue
+            if key is None:
+                key = self.get_batch_key(request_args)
+            if len(batch) < self.max_batch and self.get_batch_key(request_args) == key:
+                batch.append((request, request_args, respond))
+            else:
+                remaining.append((request, respond))
+        self.pending = remaining
+        return batch
+
+    def run_batch(self, batch):
+        """
+        Sample the requests of a batch together and answer each of them
+        """
+        start = perf_counter()
+        args = batch[0][1]
+        seeds = [request_args.seed for _, request_args, _ in batch]
+        # A single request is sampled exactly as by the sampling mode
+        g_t = [request_args.fm_gt for _, request_args, _ in batch]
+        gamma = [request_args.fm_gamma for _, request_args, _ in batch]
+        if len(batch) == 1:
+            g_t, gamma = g_t[0], gamma[0]
+        try:
+            set_dataset_state(self.task, self.dataset_state)
+            samples = sample_populations(
+                args,
+                seeds,
+                self.task,
+                self.task_name,
+                self.model,
+                self.classifiers,
+                get_fm_K(args, len(self.classifiers)),
+                init_candidates=self.init_candidates,
+                g_t=g_t,
+                gamma=gamma,
+            )
+        except Exception as error:
+            for request, _, respond in batch:
+                respond({"id": request.get("id"), "error": str(error)})
+            return
+
+        elapsed = perf_counter() - start
+        for (request, request_args, respond), (x_samples, hv_results) in zip(
+            batch, samples
+        ):
+            try:
+                res_x, res_y = get_sampling_results(request_args, self.task, x_samples)
+            except Exception as error:
+                respond({"id": request.get("id"), "error": str(error)})
+                continue
+            respond(
+                {
+                    "id": request.get("id"),
+                    "x": np.asarray(res_x).tolist(),
+                    "y": np.asarray(res_y).tolist(),
+                    "hv_results": hv_results,
+                    "seed": request_args.seed,
+                    "batch_size": len(batch),
+                    "time": elapsed,
+                }
+            )
+
+    def run(self):
+        """
+        Answer the requests until the service is closed
+        """
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            if batch:
+                self.run_batch(batch)
+
+
+def encode_response(response):
+    """
+    return: the JSON line of a response, or of an error response if it cannot be encoded
+    """
+    try:
+        return json.dumps(response) + "\n"
+    except (TypeError, ValueError) as error:
+        return json.dumps({"id": response.get("id"), "error": str(error)}) + "\n"
+
+
+def read_requests(lines, submit, respond):
+    """
+    Submit the JSON requests of lines, one per line, with submit(request, respond)
+    return: False if a shutdown command was read
+    """
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("A request should be a JSON object")
+        except ValueError as error:
+            respond({"id": None, "error": str(error)})
+            continue
+        if request.get("command") == "shutdown":
+            return False
+        submit(request, respond)
+    return True
+
+
+def serve(args):
+    """
+    Run the sampling service on stdin and stdout, or on the Unix socket args.serve_socket
+    """
+    if args.serve_socket is None:
+        # stdout only carries the responses, the logs of the sampling go to stderr
+        responses = sys.stdout
+        sys.stdout = sys.stderr
+    service = SamplingService(args)
+
+    if args.serve_socket is None:
+        lock = threading.Lock()
+
+        def respond(response):
+            line = encode_response(response)
+            with lock, contextlib.suppress(OSError):
+                responses.write(line)
+                responses.flush()
+
+        def read_stdin():
+            read_requests(sys.stdin, service.submit, respond)
+            service.close()
+
+        threading.Thread(target=read_stdin, daemon=True).start()
+        service.run()
+        return
+
+    class RequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            lock = threading.Lock()
+            answered = threading.Condition(lock)
+            # The requests submitted to the service and not answered yet, the requests
+            # that cannot be decoded are answered right away and are not counted
+            counts = {"pending": 0}
+
+            def write(response):
+                line = encode_response(response)
+                with lock, contextlib.suppress(OSError):
+                    self.wfile.write(line.encode())
+                    self.wfile.flush()
+
+            def respond(response):
+                write(response)
+                with answered:
+                    counts["pending"] -= 1
+                    answered.notify_all()
+
+            def submit(request, write):
+                # the service answers with respond, which counts the answer
+                with answered:
+                    counts["pending"] += 1
+                service.submit(request, respond)
+
+            lines = (line.decode() for line in self.rfile)
+            keep_running = read_requests(lines, submit, write)
+            # Answer all the requests of the connection before closing it
+            with answered:
+                answered.wait_for(lambda: counts["pending"] == 0)
+            if not keep_running:
+                service.close()
+
+    if os.path.exists(args.serve_socket):
+        os.remove(args.serve_socket)
+    server = socketserver.ThreadingUnixStreamServer(args.serve_socket, RequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Listening on {args.serve_socket}")
+    try:
+        service.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+        os.remove(args.serve_socket)
@@ -0,0 +1,204 @@
+"""This module contains the ODE integrators used to sample from the flow matching model.
+
+Every integrator advances the samples over one interval of the time grid with
+step(f, x, t, dt), where f(x, t) is the (guided) vector field. The classifier
+guidance therefore lives in the callback, and all the integrators share it.
+
+The fixed-step integrators treat every sample independently, so samples stacked along
+the batch axis give the same result as sampled apart. The adaptive integrators choose
+their sub-steps from the error of the whole batch, so independent groups of samples
+should be stepped with one integrator each.
+"""
+
+import torch
+
+
+class ODESolver:
+    """
+    Base class of the integrators, it counts the number of function evaluations (NFE)
+    """
+
+    name = None
+    # Whether the sub-steps depend on the samples, see the module docstring
+    adaptive = False
+
+    def __init__(self):
+        self.nfe = 0
+
+    def reset(self):
+        self.nfe = 0
+
+    def evaluate(self, f, x, t):
+        """
+        f: the vector field, a function that takes x and t and returns the velocity
+        x: the samples, shape: (batch_size, D)
+        t: the time
+        return: the velocity at (x, t), shape: (batch_size, D)
+        """
+        self.nfe += 1
+        return f(x, t)
+
+    def step(self, f, x, t, dt):
+        """
+        f: the vector field, a function that takes x and t and returns the velocity
+        x: the samples at time t, shape: (batch_size, D)
+        t: the start of the interval
+        dt: the length of the interval
+        return: the samples at time t + dt, shape: (batch_size, D)
+        """
+        raise NotImplementedError
+
+
+class EulerSolver(ODESolver):
+    name = "euler"
+
+    def step(self, f, x, t, dt):
+        return x + self.evaluate(f, x, t) * dt
+
+
+class HeunSolver(ODESolver):
+    name = "heun"
+
+    def step(self, f, x, t, dt):
+        k1 = self.evaluate(f, x, t)
+        k2 = self.evaluate(f, x + k1 * dt, t + dt)
+        return x + (k1 + k2) * (dt / 2)
+
+
+class MidpointSolver(ODESolver):
+    name = "midpoint"
+
+    def step(self, f, x, t, dt):
+        k1 = self.evaluate(f, x, t)
+        k2 = self.evaluate(f, x + k1 * (dt / 2), t + dt / 2)
+        return x + k2 * dt
+
+
+class RK4Solver(ODESolver):
+    name = "rk4"
+
+    def step(self, f, x, t, dt):
+        k1 = self.evaluate(f, x, t)
+        k2 = self.evaluate(f, x + k1 * (dt / 2), t + dt / 2)
+        k3 = self.evaluate(f, x + k2 * (dt / 2), t + dt / 2)
+        k4 = self.evaluate(f, x + k3 * dt, t + dt)
+        return x + (k1 + 2 * k2 + 2 * k3 + k4) * (dt / 6)
+
+
+class DormandPrinceSolver(ODESolver):
+    """
+    Adaptive Dormand-Prince 5(4) integrator. Each interval of the time grid is covered
+    with as many accepted sub-steps as the error tolerances require, so a coarse grid
+    can be used while the guided dynamics stay accurate.
+    """
+
+    name = "dopri5"
+    adaptive = True
+
+    # Butcher tableau of the Dormand-Prince method
+    C = [0.0, 1 / 5, 3 / 10, 4 / 5, 8 / 9, 1.0, 1.0]
+    A = [
+        [],
+        [1 / 5],
+        [3 / 40, 9 / 40],
+        [44 / 45, -56 / 15, 32 / 9],
+        [19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729],
+        [9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656],
+        [35 / 384, 0.0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84],
+    ]
+    # 5th order solution (same as the last row of A) minus the embedded 4th order solution
+    E = [
+        35 / 384 - 5179 / 57600,
+        0.0,
+        500 / 1113 - 7571 / 16695,
+        125 / 192 - 393 / 640,
+        -2187 / 6784 + 92097 / 339200,
+        11 / 84 - 187 / 2100,
+        -1 / 40,
+    ]
+
+    def __init__(self, rtol=1e-3, atol=1e-4, max_substeps=100):
+        super(DormandPrinceSolver, self).__init__()
+        self.rtol = rtol
+        self.atol = atol
+        self.max_substeps = max_substeps
+        # The accepted step size is carried over to the next interval
+        self.h = None
+
+    def reset(self):
+        super(DormandPrinceSolver, self).reset()
+        self.h = None
+
+    def substep(self, f, x, t, h):
+        """
+        return: the 5th order solution at t + h and the local error estimate
+        """
+        ks = []
+        for c, a in zip(self.C, self.A):
+            x_stage = x
+            for a_j, k_j in zip(a, ks):
+                if a_j != 0.0:
+                    x_stage = x_stage + k_j * (a_j * h)
+            ks.append(self.evaluate(f, x_stage, t + c * h))
+        # The last stage is evaluated at the 5th order solution
+        x_next = x_stage
+        error = sum(k * (e * h) for e, k in zip(self.E, ks) if e != 0.0)
+        return x_next, error
+
+    def step(self, f, x, t, dt):
+        t = float(t)
+        t_end = t + float(dt)
+        h = float(dt) if self.h is None else min(self.h, float(dt))
+        for i in range(self.max_substeps):
+            # The last sub-step always lands exactly on the end of the interval
+            last = t + h >= t_end or i == self.max_substeps - 1
+            h_free = h
+            if last:
+                h = t_end - t
+            x_next, error = self.substep(f, x, t, h)
+            scale = self.atol + self.rtol * torch.maximum(x.abs(), x_next.abs())
+            # RMS error of the worst sample in the batch
+            error_norm = (
+                (error / scale).pow(2).mean(dim=-1).sqrt().max().item()
+                if error.numel() > 0
+                else 0.0
+            )
+            factor = 5.0 if error_norm == 0.0 else 0.9 * error_norm ** (-1 / 5)
+            factor = min(5.0, max(0.2, factor))
+            if error_norm <= 1.0 or i == self.max_substeps - 1:
+                t = t + h
+                x = x_next
+                if last:
+                    # Do not let the truncated last sub-step shrink the next interval
+                    self.h = max(h * factor, h_free) if error_norm <= 1.0 else h
+                    break
+            h = h * factor
+        return x
+
+
+SOLVERS = {
+    solver.name: solver
+    for solver in [
+        EulerSolver,
+        HeunSolver,
+        MidpointSolver,
+        RK4Solver,
+        DormandPrinceSolver,
+    ]
+}
+
+
+def get_solver(name, rtol=1e-3, atol=1e-4):
+    """
+    name: the name of the integrator, one of SOLVERS
+    rtol: the relative tolerance of the adaptive integrator
+    atol: the absolute tolerance of the adaptive integrator
+    return: an instance of the integrator
+    """
+    if isinstance(name, ODESolver):
+        return name
+    if name not in SOLVERS:
+        raise ValueError(f"Unknown solver: {name}, choose from {list(SOLVERS)}")
+    if name == DormandPrinceSolver.name:
+        return DormandPrinceSolver(rtol=rtol, atol=atol)
+    return SOLVERS[name]()
@@ -1,4 +1,9 @@
+import hashlib
+import json
 import os
+import queue
+import shutil
+import threading
 
 import numpy as np
 import torch
@@ -7,8 +12,11 @@ from torch.optim import Adam
 from torch.utils.data import DataLoader, Dataset, TensorDataset, random_split
 from tqdm import tqdm
 
+import offline_moo.off_moo_bench as ob
 from gfmo_reference_directions import UniformReferenceDirectionFactory
 from offline_moo.off_moo_baselines.data import spearman_correlation
+from offline_moo.off_moo_bench.disk_resource import DiskResource
+from offline_moo.off_moo_bench.task import import_name
 
 tkwargs = {
     "device": torch.device("cuda" if torch.cuda.is_available() else "cpu"),
@@ -31,86 +39,262 @@ def get_reference_directions(name, *args, **kwargs):
     return REF[name](*args, **kwargs)()
 
 
-def evaluation(test_loader, name=None, model_best=None, epoch=None):
+class CheckpointWriter:
+    """
+    Writes checkpoints on a background thread, so that the training loop does not wait
+    for the disk. save only snapshots the tensors of the checkpoint into host memory,
+    without waiting for the copies from the device. Each file is written to a temporary
+    path and renamed, so that readers never see a partial checkpoint. With keep > 1, the
+    keep - 1 previous versions of a path are kept as path.1, path.2, ..., newest first.
+    """
+
+    def __init__(self, keep=1):
+        assert keep >= 1, "Error: At least one checkpoint should be kept"
+        self.keep = keep
+        self.error = None
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def snapshot(cls, value):
+        """
+        value: a tensor, or a dict, list or tuple of them
+        return: a copy of value with the tensors copied to the host
+        """
+        if isinstance(value, torch.Tensor):
+            value = value.detach()
+            if value.is_cuda:
+                # A pinned buffer lets the copy run asynchronously
+                copy = torch.empty(value.shape, dtype=value.dtype, pin_memory=True)
+                return copy.copy_(value, non_blocking=True)
+            return value.clone()
+        if isinstance(value, dict):
+            copy = type(value)((key, cls.snapshot(item)) for key, item in value.items())
+            # The state dicts carry the versions of the modules
+            if hasattr(value, "_metadata"):
+                copy._metadata = value._metadata
+            return copy
+        if isinstance(value, (list, tuple)):
+            return type(value)(cls.snapshot(item) for item in value)
+        return value
+
+    @staticmethod
+    def write(checkpoint, path, keep=1):
+        """
+        Write a snapshot to path and rotate the previous versions
+        """
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        torch.save(checkpoint, temporary_path)
+        if keep > 1 and os.path.exists(path):
+            for k in range(keep - 1, 1, -1):
+                if os.path.exists(f"{path}.{k - 1}"):
+                    os.replace(f"{path}.{k - 1}", f"{path}.{k}")
+            if os.path.exists(f"{path}.1"):
+                os.remove(f"{path}.1")
+            # The current version stays readable at path until the rename below
+            try:
+                os.link(path, f"{path}.1")
+            except OSError:
+                shutil.copyfile(path, f"{path}.1")
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def save_now(cls, checkpoint, path, keep=1):
+        """
+        Write a checkpoint before returning, the tensors are still copied to the host
+        """
+        checkpoint = cls.snapshot(checkpoint)
+        if torch.cuda.is_available():
+            torch.cuda.current_stream().synchronize()
+        cls.write(checkpoint, path, keep=keep)
+
+    def save(self, checkpoint, path):
+        """
+        checkpoint: a dict of tensors and python values, e.g., a state dict
+        path: the file to write
+        """
+        self.raise_error()
+        checkpoint = self.snapshot(checkpoint)
+        event = None
+        if torch.cuda.is_available():
+            # The copies are done once the work queued so far on the stream is done
+            event = torch.cuda.Event()
+            event.record()
+        self.queue.put((checkpoint, path, event))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                checkpoint, path, event = item
+                if event is not None:
+                    event.synchronize()
+                self.write(checkpoint, path, keep=self.keep)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def flush(self):
+        """
+        Wait until all the checkpoints saved so far are written
+        """
+        self.queue.join()
+        self.raise_error()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.raise_error()
+
+
+def evaluation(
+    test_loader,
+    name=None,
+    model_best=None,
+    epoch=None,
+    metric="nll",
+    steps=None,
+    probe="gaussian",
+    seed=None,
+):
+    """
+    metric: nll scores the model with the negative log-likelihood, fm_loss with the
+    flow matching loss, which needs a single forward pass per batch
+    steps: the number of integration steps of the log-likelihood, model_best.T if None
+    probe: the probe of the Hutchinson trace estimator, gaussian or rademacher
+    seed: the seed of the random times, noises and probes of the validation, so that
+    the losses of different epochs are comparable. The random state of the caller is
+    left untouched. The global random state is used if None
+    """
     # EVALUATION
     if model_best is None:
         # load best performing model
-        model_best = torch.load(name + ".model")
+        from gfmo_nets import FlowMatching
+
+        model_best = FlowMatching.load(name + ".model", map_location=device)
 
     model_best.eval()
     loss = 0.0
     N = 0.0
-    # use tqdm for progress bar
-    with tqdm(total=len(test_loader), desc="Validation", unit="batch") as pbar:
-        for indx_batch, test_batch in enumerate(test_loader):
-            test_batch = test_batch.float()
-            test_batch = test_batch.to(device)
-            loss_t = -model_best.log_prob(test_batch, reduction="sum")
-            loss = loss + loss_t.item()
-            N = N + test_batch.shape[0]
-            pbar.update(1)
+    rng_devices = [torch.cuda.current_device()] if device.type == "cuda" else []
+    with torch.random.fork_rng(devices=rng_devices, enabled=seed is not None):
+        if seed is not None:
+            torch.manual_seed(seed)
+        # use tqdm for progress bar
+        with tqdm(total=len(test_loader), desc="Validation", unit="batch") as pbar:
+            for indx_batch, test_batch in enumerate(test_loader):
+                test_batch = test_batch.float()
+                test_batch = test_batch.to(device)
+                if metric == "nll":
+                    loss_t = -model_best.log_prob(
+                        test_batch, reduction="sum", steps=steps, probe=probe
+                    )
+                elif metric == "fm_loss":
+                    with torch.no_grad():
+                        loss_t = model_best(test_batch, reduction="sum")
+                else:
+                    raise ValueError(f"Unknown validation metric: {metric}")
+                loss = loss + loss_t.item()
+                N = N + test_batch.shape[0]
+                pbar.update(1)
 
     loss = loss / N
 
     if epoch is None:
-        print(f"FINAL LOSS: nll={loss}")
+        print(f"FINAL LOSS: {metric}={loss}")
     else:
-        print(f"Epoch: {epoch}, val nll={loss}")
+        print(f"Epoch: {epoch}, val {metric}={loss}")
 
     return loss
 
 
 def training(
-    name, max_patience, num_epochs, model, optimizer, training_loader, val_loader
+    name,
+    max_patience,
+    num_epochs,
+    model,
+    optimizer,
+    training_loader,
+    val_loader,
+    val_every=1,
+    val_metric="nll",
+    val_steps=None,
+    val_probe="gaussian",
+    val_seed=0,
+    ckpt_keep=1,
 ):
+    """
+    val_every: validate every val_every epochs, the patience is still counted in epochs
+    since the best epoch
+    val_metric, val_steps, val_probe: see evaluation
+    val_seed: the seed of every validation, see evaluation
+    ckpt_keep: the number of best checkpoints to keep, they are written in the background
+    """
     nll_val = []
     best_nll = float("inf")
-    patience = 0
-
-    # Main loop
-    for e in range(num_epochs):
-        # TRAINING
-        model.train()
-        # use tqdm for progress bar
-        epoch_loss = 0
-        with tqdm(
-            total=len(training_loader),
-            desc=f"Training {e + 1}/{num_epochs}",
-            unit="batch",
-        ) as pbar:
-            for indx_batch, batch in enumerate(training_loader):
-                batch = batch.float()
-                batch = batch.to(device)
-                loss = model(batch)
-                optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
-                epoch_loss = epoch_loss + loss.item()
-                pbar.set_postfix({"loss": epoch_loss / (indx_batch + 1)})
-                pbar.update(1)
-        print(f"Epoch: {e}, train nll={epoch_loss / len(training_loader)}")
-
-        # Validation
-        loss_val = evaluation(val_loader, model_best=model, epoch=e)
-        nll_val.append(loss_val)  # save for plotting
+    best_epoch = 0
+    checkpoint_writer = CheckpointWriter(keep=ckpt_keep)
+
+    try:
+        # Main loop
+        for e in range(num_epochs):
+            # TRAINING
+            model.train()
+            # use tqdm for progress bar
+            epoch_loss = 0
+            with tqdm(
+                total=len(training_loader),
+                desc=f"Training {e + 1}/{num_epochs}",
+                unit="batch",
+            ) as pbar:
+                for indx_batch, batch in enumerate(training_loader):
+                    batch = batch.float()
+                    batch = batch.to(device)
+                    loss = model(batch)
+                    optimizer.zero_grad()
+                    loss.backward()
+                    optimizer.step()
+                    epoch_loss = epoch_loss + loss.item()
+                    pbar.set_postfix({"loss": epoch_loss / (indx_batch + 1)})
+                    pbar.update(1)
+            print(f"Epoch: {e}, train nll={epoch_loss / len(training_loader)}")
+
+            # Validation, always on the first and the last epoch
+            if e != 0 and e != num_epochs - 1 and (e + 1) % val_every != 0:
+                continue
+            loss_val = evaluation(
+                val_loader,
+                model_best=model,
+                epoch=e,
+                metric=val_metric,
+                steps=val_steps,
+                probe=val_probe,
+                seed=val_seed,
+            )
+            nll_val.append(loss_val)  # save for plotting
 
-        if e == 0:
-            print("saved!")
-            torch.save(model, name + ".model")
-            best_nll = loss_val
-        else:
-            if loss_val < best_nll:
+            if e == 0 or loss_val < best_nll:
                 print("saved!")
-                torch.save(model, name + ".model")
+                checkpoint_writer.save(model.get_checkpoint(), name + ".model")
                 best_nll = loss_val
-                patience = 0
-            else:
-                patience = patience + 1
-
-        if patience > max_patience:
-            print(f"Early stopping at epoch {e + 1}!")
-            break
-
+                best_epoch = e
+
+            if e - best_epoch > max_patience:
+                print(f"Early stopping at epoch {e + 1}!")
+                break
+    finally:
+        # the thread stops and the queued checkpoints are written even on errors
+        checkpoint_writer.close()
     nll_val = np.asarray(nll_val)
 
     return nll_val
@@ -246,6 +430,102 @@ SEQUENCETASKS = MONASSequence + ScientificDesignSequence
 all_task_names = list(ALLTASKSDICT.keys())
 
 
+class ProxyMetrics:
+    """
+    Streaming MSE, PCC and rank correlation of the predictions of the proxies, one value
+    for each objective. The moments are kept as running sums and the predictions are
+    written into preallocated buffers for the rank correlation, so that collecting the
+    metrics of an epoch never concatenates tensors.
+    """
+
+    def __init__(self, n_obj, capacity=0):
+        self.n_obj = n_obj
+        self.outputs = torch.empty((capacity, n_obj), **tkwargs)
+        self.labels = torch.empty((capacity, n_obj), **tkwargs)
+        self.reset()
+
+    @classmethod
+    def for_loader(cls, loader, n_obj):
+        """
+        return: the metrics with buffers sized for one pass over the loader
+        """
+        dataset = getattr(loader, "dataset", None)
+        return cls(n_obj, capacity=len(dataset) if dataset is not None else 0)
+
+    def reset(self):
+        self.count = 0
+        # The sums of x, y, x^2, y^2, x * y and (x - y)^2, shape: (6, n_obj)
+        self.sums = torch.zeros(
+            (6, self.n_obj), dtype=torch.float64, device=tkwargs["device"]
+        )
+
+    def update(self, outputs, labels):
+        """
+        outputs: the predictions of a batch, shape: (batch_size, n_obj)
+        labels: the labels of the batch, shape: (batch_size, n_obj)
+        """
+        outputs = outputs.detach()
+        labels = labels.detach()
+        end = self.count + outputs.shape[0]
+        if end > self.outputs.shape[0]:
+            # Only when the size of the loader is unknown
+            capacity = max(end, 2 * self.outputs.shape[0])
+            self.outputs = torch.cat(
+                [
+                    self.outputs[: self.count],
+                    outputs.new_empty(capacity - self.count, self.n_obj),
+                ]
+            )
+            self.labels = torch.cat(
+                [
+                    self.labels[: self.count],
+                    labels.new_empty(capacity - self.count, self.n_obj),
+                ]
+            )
+        self.outputs[self.count : end] = outputs
+        self.labels[self.count : end] = labels
+        self.count = end
+
+        x = outputs.double()
+        y = labels.double()
+        self.sums += torch.stack(
+            [
+                x.sum(0),
+                y.sum(0),
+                (x * x).sum(0),
+                (y * y).sum(0),
+                (x * y).sum(0),
+                ((x - y) ** 2).sum(0),
+            ]
+        )
+
+    def mse(self):
+        """
+        return: the mean squared error of each objective, shape: (n_obj)
+        """
+        return self.sums[5] / self.count
+
+    def pcc(self):
+        """
+        return: the Pearson correlation of each objective, shape: (n_obj)
+        """
+        sum_x, sum_y, sum_xx, sum_yy, sum_xy, _ = self.sums
+        covariance = sum_xy - sum_x * sum_y / self.count
+        variance_x = (sum_xx - sum_x**2 / self.count).clamp(min=0.0)
+        variance_y = (sum_yy - sum_y**2 / self.count).clamp(min=0.0)
+        return covariance / (
+            torch.sqrt(variance_x + 1e-12) * torch.sqrt(variance_y + 1e-12)
+        )
+
+    def rank_corr(self):
+        """
+        return: the Spearman correlation of each objective, shape: (n_obj)
+        """
+        return spearman_correlation(
+            self.outputs[: self.count], self.labels[: self.count]
+        )
+
+
 class SingleModelBaseTrainer(nn.Module):
 
     def __init__(self, model, which_obj, args):
@@ -255,6 +535,7 @@ class SingleModelBaseTrainer(nn.Module):
         self.forward_lr = args.proxies_lr
         self.forward_lr_decay = args.proxies_lr_decay
         self.n_epochs = args.proxies_epochs
+        self.eval_every = args.proxies_eval_every
 
         self.model = model
 
@@ -264,55 +545,36 @@ class SingleModelBaseTrainer(nn.Module):
         self.train_criterion = lambda yhat, y: (
             torch.sum(torch.mean((yhat - y) ** 2, dim=1))
         )
-        self.mse_criterion = nn.MSELoss()
 
     def _evaluate_performance(self, statistics, epoch, train_loader, val_loader):
-        self.model.eval()
-        with torch.no_grad():
-            y_all = torch.zeros((0, self.n_obj)).to(**tkwargs)
-            outputs_all = torch.zeros((0, self.n_obj)).to(**tkwargs)
-            for (
-                batch_x,
-                batch_y,
-            ) in train_loader:
-                batch_x = batch_x.to(**tkwargs)
-                batch_y = batch_y.to(**tkwargs)
-
-                y_all = torch.cat((y_all, batch_y), dim=0)
-                outputs = self.model(batch_x)
-                outputs_all = torch.cat((outputs_all, outputs), dim=0)
+        # The training metrics were collected during the training pass of the epoch
+        train_mse = self.train_metrics.mse()
+        train_corr = self.train_metrics.rank_corr()
+        train_pcc = self.train_metrics.pcc()
 
-            train_mse = self.mse_criterion(outputs_all, y_all)
-            train_corr = spearman_correlation(outputs_all, y_all)
-            train_pcc = self.compute_pcc(outputs_all, y_all)
+        statistics[f"model_{self.which_obj}/train/mse"] = train_mse.item()
+        for i in range(self.n_obj):
+            statistics[f"model_{self.which_obj}/train/rank_corr_{i + 1}"] = train_corr[
+                i
+            ].item()
 
-            statistics[f"model_{self.which_obj}/train/mse"] = train_mse.item()
-            for i in range(self.n_obj):
-                statistics[f"model_{self.which_obj}/train/rank_corr_{i + 1}"] = (
-                    train_corr[i].item()
-                )
-
-            print(
-                "Epoch [{}/{}], MSE: {:}, PCC: {:}".format(
-                    epoch + 1, self.n_epochs, train_mse.item(), train_pcc.item()
-                )
+        print(
+            "Epoch [{}/{}], MSE: {:}, PCC: {:}".format(
+                epoch + 1, self.n_epochs, train_mse.item(), train_pcc.item()
             )
+        )
 
+        self.model.eval()
         with torch.no_grad():
-            y_all = torch.zeros((0, self.n_obj)).to(**tkwargs)
-            outputs_all = torch.zeros((0, self.n_obj)).to(**tkwargs)
-
+            self.val_metrics.reset()
             for batch_x, batch_y in val_loader:
                 batch_x = batch_x.to(**tkwargs)
                 batch_y = batch_y.to(**tkwargs)
+                self.val_metrics.update(self.model(batch_x), batch_y)
 
-                y_all = torch.cat((y_all, batch_y), dim=0)
-                outputs = self.model(batch_x)
-                outputs_all = torch.cat((outputs_all, outputs))
-
-            val_mse = self.mse_criterion(outputs_all, y_all)
-            val_corr = spearman_correlation(outputs_all, y_all)
-            val_pcc = self.compute_pcc(outputs_all, y_all)
+            val_mse = self.val_metrics.mse()
+            val_corr = self.val_metrics.rank_corr()
+            val_pcc = self.val_metrics.pcc()
 
             statistics[f"model_{self.which_obj}/valid/mse"] = val_mse.item()
             for i in range(self.n_obj):
@@ -327,7 +589,7 @@ class SingleModelBaseTrainer(nn.Module):
             if val_pcc.item() > self.min_pcc:
                 print("🌸 New best epoch! 🌸")
                 self.min_pcc = val_pcc.item()
-                self.model.save(val_pcc=self.min_pcc)
+                self.model.save(val_pcc=self.min_pcc, writer=self.checkpoint_writer)
         return statistics
 
     def launch(
@@ -352,40 +614,63 @@ class SingleModelBaseTrainer(nn.Module):
         self.min_pcc = -1.0
         statistics = {}
 
-        for epoch in range(self.n_epochs):
-            self.model.train()
-
-            losses = []
-            for batch_x, batch_y in train_loader:
-                batch_x = batch_x.to(**tkwargs)
-                batch_y = batch_y.to(**tkwargs)
-                if self.n_obj is None:
-                    self.n_obj = batch_y.shape[1]
-
-                self.forward_opt.zero_grad()
-                outputs = self.model(batch_x)
-                loss = self.train_criterion(outputs, batch_y)
-                losses.append(loss.item() / batch_x.size(0))
-                loss.backward()
-                self.forward_opt.step()
-
-            statistics[f"model_{self.which_obj}/train/loss/mean"] = np.array(
-                losses
-            ).mean()
-            statistics[f"model_{self.which_obj}/train/loss/std"] = np.array(
-                losses
-            ).std()
-            statistics[f"model_{self.which_obj}/train/loss/max"] = np.array(
-                losses
-            ).max()
-
-            self._evaluate_performance(statistics, epoch, train_loader, val_loader)
-
-            statistics[f"model_{self.which_obj}/train/lr"] = self.forward_lr
-            self.forward_lr *= self.forward_lr_decay
-            update_lr(self.forward_opt, self.forward_lr)
-
-    def compute_pcc(self, valid_preds, valid_labels):
+        # The writer is only started once the proxies are trained, and always closed so
+        # that its thread stops and the queued checkpoints are written
+        self.checkpoint_writer = CheckpointWriter(keep=self.args.ckpt_keep)
+        try:
+            for epoch in range(self.n_epochs):
+                self.model.train()
+                # The metrics are computed every eval_every epochs and at the last epoch
+                evaluate = (
+                    epoch + 1
+                ) % self.eval_every == 0 or epoch == self.n_epochs - 1
+
+                losses = []
+                for batch_x, batch_y in train_loader:
+                    batch_x = batch_x.to(**tkwargs)
+                    batch_y = batch_y.to(**tkwargs)
+                    if self.n_obj is None:
+                        self.n_obj = batch_y.shape[1]
+                        self.train_metrics = ProxyMetrics.for_loader(
+                            train_loader, self.n_obj
+                        )
+                        self.val_metrics = ProxyMetrics.for_loader(
+                            val_loader, self.n_obj
+                        )
+
+                    self.forward_opt.zero_grad()
+                    outputs = self.model(batch_x)
+                    loss = self.train_criterion(outputs, batch_y)
+                    losses.append(loss.item() / batch_x.size(0))
+                    loss.backward()
+                    self.forward_opt.step()
+                    if evaluate:
+                        self.train_metrics.update(outputs, batch_y)
+
+                statistics[f"model_{self.which_obj}/train/loss/mean"] = np.array(
+                    losses
+                ).mean()
+                statistics[f"model_{self.which_obj}/train/loss/std"] = np.array(
+                    losses
+                ).std()
+                statistics[f"model_{self.which_obj}/train/loss/max"] = np.array(
+                    losses
+                ).max()
+
+                if evaluate:
+                    self._evaluate_performance(
+                        statistics, epoch, train_loader, val_loader
+                    )
+                    self.train_metrics.reset()
+
+                statistics[f"model_{self.which_obj}/train/lr"] = self.forward_lr
+                self.forward_lr *= self.forward_lr_decay
+                update_lr(self.forward_opt, self.forward_lr)
+        finally:
+            self.checkpoint_writer.close()
+
+    @staticmethod
+    def compute_pcc(valid_preds, valid_labels):
         vx = valid_preds - torch.mean(valid_preds)
         vy = valid_labels - torch.mean(valid_labels)
         pcc = torch.sum(vx * vy) / (
@@ -483,22 +768,29 @@ class SingleModel(nn.Module):
             save_path = self.save_path
         return os.path.exists(save_path)
 
-    def save(self, val_pcc=None, save_path=None):
+    def save(self, val_pcc=None, save_path=None, state_dict=None, writer=None):
+        """
+        state_dict: the weights to save, the weights of the model if None
+        writer: a CheckpointWriter that writes the checkpoint in the background,
+        the checkpoint is written before returning if None
+        """
         assert (
             self.save_path is not None or save_path is not None
         ), "save path should be specified"
         if save_path is None:
             save_path = self.save_path
 
-        self = self.to("cpu")
+        # The tensors are copied to the host, the model stays on its device
         checkpoint = {
-            "model_state_dict": self.state_dict(),
+            "model_state_dict": self.state_dict() if state_dict is None else state_dict,
         }
         if val_pcc is not None:
             checkpoint["valid_pcc"] = val_pcc
 
-        torch.save(checkpoint, save_path)
-        self = self.to(**tkwargs)
+        if writer is None:
+            CheckpointWriter.save_now(checkpoint, save_path)
+        else:
+            writer.save(checkpoint, save_path)
 
     def load(self, save_path=None):
         assert (
@@ -516,6 +808,331 @@ class SingleModel(nn.Module):
         )
 
 
+class PackedProxyEnsemble(nn.Module):
+    """
+    All the per-objective SingleModel proxies packed into one module. The weights
+    of each layer of every proxy are stacked along a leading objective dimension,
+    so that all objective scores are computed with one batched matmul per layer
+    instead of n_obj separate forward passes.
+    """
+
+    def __init__(self, input_size, hidden_size, n_obj, save_dir=None, save_prefix=None):
+        super(PackedProxyEnsemble, self).__init__()
+        self.n_dim = input_size
+        self.n_obj = n_obj
+        self.hidden_size = hidden_size
+        self.save_dir = save_dir
+        self.save_prefix = save_prefix
+
+        # The input is shared by all the proxies, so the first layer is stored as
+        # (n_dim, n_obj, hidden_size[0]) and applied with a single matmul
+        self.input_weight = nn.Parameter(torch.empty(input_size, n_obj, hidden_size[0]))
+        self.input_bias = nn.Parameter(torch.empty(n_obj, 1, hidden_size[0]))
+
+        # The remaining layers are stored as (n_obj, in, out) and applied with bmm
+        sizes = list(hidden_size) + [1]
+        self.weights = nn.ParameterList(
+            [
+                nn.Parameter(torch.empty(n_obj, sizes[i], sizes[i + 1]))
+                for i in range(len(sizes) - 1)
+            ]
+        )
+        self.biases = nn.ParameterList(
+            [
+                nn.Parameter(torch.empty(n_obj, 1, sizes[i + 1]))
+                for i in range(len(sizes) - 1)
+            ]
+        )
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # Same initialization as nn.Linear, done separately for each objective
+        for which_obj in range(self.n_obj):
+            state_dict = SingleModel(
+                self.n_dim, self.hidden_size, which_obj, save_dir=""
+            ).state_dict()
+            self.load_single_state_dict(which_obj, state_dict)
+
+    def __len__(self):
+        return self.n_obj
+
+    def get_save_path(self, which_obj):
+        return os.path.join(self.save_dir, f"{self.save_prefix}-{which_obj}.pt")
+
+    def forward(self, x):
+        """
+        x: the designs, shape: (batch_size, n_dim)
+        return: the predictions of all the proxies, shape: (batch_size, n_obj)
+        """
+        batch_size = x.shape[0]
+        # shape: (n_obj, batch_size, hidden_size[0])
+        x = x @ self.input_weight.view(self.n_dim, -1)
+        x = x.view(batch_size, self.n_obj, -1).transpose(0, 1) + self.input_bias
+        for weight, bias in zip(self.weights, self.biases):
+            x = nn.functional.leaky_relu(x)
+            # shape: (n_obj, batch_size, out)
+            x = torch.baddbmm(bias, x, weight)
+        # shape: (batch_size, n_obj)
+        return x.squeeze(-1).T.contiguous()
+
+    def load_single_models(self, models):
+        """
+        models: a list of SingleModel, one for each objective
+        """
+        assert len(models) == self.n_obj, "Error: Need one model for each objective"
+        for which_obj, model in enumerate(models):
+            self.load_single_state_dict(which_obj, model.state_dict())
+
+    def load_single_state_dict(self, which_obj, state_dict):
+        """
+        Copy the state dict of a SingleModel into the slot of the which_obj-th proxy
+        """
+        with torch.no_grad():
+            self.input_weight[:, which_obj].copy_(state_dict["layers.0.weight"].T)
+            self.input_bias[which_obj, 0].copy_(state_dict["layers.0.bias"])
+            for i in range(len(self.weights)):
+                self.weights[i][which_obj].copy_(state_dict[f"layers.{i + 1}.weight"].T)
+                self.biases[i][which_obj, 0].copy_(state_dict[f"layers.{i + 1}.bias"])
+
+    def get_single_state_dict(self, which_obj):
+        """
+        return: the state dict of the which_obj-th proxy in the format of SingleModel,
+        the tensors are views of the packed weights
+        """
+        state_dict = {
+            "layers.0.weight": self.input_weight[:, which_obj].T,
+            "layers.0.bias": self.input_bias[which_obj, 0],
+        }
+        for i in range(len(self.weights)):
+            state_dict[f"layers.{i + 1}.weight"] = self.weights[i][which_obj].T
+            state_dict[f"layers.{i + 1}.bias"] = self.biases[i][which_obj, 0]
+        return {key: value.detach() for key, value in state_dict.items()}
+
+    def load(self):
+        """
+        Load the weights from the MultipleModels checkpoints saved by SingleModel.save
+        """
+        for which_obj in range(self.n_obj):
+            save_path = self.get_save_path(which_obj)
+            checkpoint = torch.load(save_path, map_location="cpu")
+            self.load_single_state_dict(which_obj, checkpoint["model_state_dict"])
+            print(
+                f"Successfully load trained model from {save_path} "
+                f"with valid PCC = {checkpoint['valid_pcc']}"
+            )
+
+
+class PackedProxyTrainer(nn.Module):
+    """
+    Trains the per-objective SingleModel proxies together as a PackedProxyEnsemble,
+    with one forward and backward pass per batch of a shared dataloader. Adam updates
+    every parameter on its own and each proxy only receives the gradient of its own
+    loss, so the proxies are still trained independently. The losses, the best epochs
+    and the checkpoints are kept for each objective, the checkpoints are written by
+    SingleModel.save so that SingleModel.load and PackedProxyEnsemble.load read them.
+    """
+
+    def __init__(self, models, args):
+        super(PackedProxyTrainer, self).__init__()
+        self.args = args
+
+        self.forward_lr = args.proxies_lr
+        self.forward_lr_decay = args.proxies_lr_decay
+        self.n_epochs = args.proxies_epochs
+        self.eval_every = args.proxies_eval_every
+
+        self.models = models
+        self.n_obj = len(models)
+
+        # Packing copies the weights of the models, keep the random state untouched
+        # so that the shuffling does not depend on how the proxies are trained
+        with torch.random.fork_rng(devices=[]):
+            self.model = PackedProxyEnsemble(
+                models[0].n_dim, models[0].hidden_size, self.n_obj
+            )
+        self.model.load_single_models(models)
+        self.model.to(**tkwargs)
+
+        self.forward_opt = Adam(self.model.parameters(), lr=args.proxies_lr)
+        # The squared errors summed over the batch, one loss for each objective
+        self.train_criterion = lambda yhat, y: torch.sum((yhat - y) ** 2, dim=0)
+
+    def _evaluate_performance(self, statistics, epoch, train_loader, val_loader):
+        # The training metrics were collected during the training pass of the epoch
+        self.model.eval()
+        with torch.no_grad():
+            self.val_metrics.reset()
+            for batch_x, batch_y in val_loader:
+                batch_x = batch_x.to(**tkwargs)
+                batch_y = batch_y.to(**tkwargs)
+                self.val_metrics.update(self.model(batch_x), batch_y)
+
+        for split, metrics in [
+            ("train", self.train_metrics),
+            ("valid", self.val_metrics),
+        ]:
+            mse = metrics.mse()
+            corr = metrics.rank_corr()
+            pcc = metrics.pcc()
+            for which_obj in range(self.n_obj):
+                statistics[f"model_{which_obj}/{split}/mse"] = mse[which_obj].item()
+                statistics[f"model_{which_obj}/{split}/rank_corr_1"] = corr[
+                    which_obj
+                ].item()
+
+                if split == "train":
+                    print(
+                        "Epoch [{}/{}], Objective {}, MSE: {:}, PCC: {:}".format(
+                            epoch + 1,
+                            self.n_epochs,
+                            which_obj,
+                            mse[which_obj].item(),
+                            pcc[which_obj].item(),
+                        )
+                    )
+                    continue
+
+                print(
+                    "Objective {}, Valid MSE: {:}, Valid PCC: {:}".format(
+                        which_obj, mse[which_obj].item(), pcc[which_obj].item()
+                    )
+                )
+                if pcc[which_obj].item() > self.min_pcc[which_obj]:
+                    print(f"🌸 New best epoch of objective {which_obj}! 🌸")
+                    self.min_pcc[which_obj] = pcc[which_obj].item()
+                    self.models[which_obj].save(
+                        val_pcc=self.min_pcc[which_obj],
+                        state_dict=self.model.get_single_state_dict(which_obj),
+                        writer=self.checkpoint_writer,
+                    )
+        return statistics
+
+    def launch(
+        self,
+        train_loader=None,
+        val_loader=None,
+        retrain_model: bool = True,
+    ):
+
+        def update_lr(optimizer, lr):
+            for param_group in optimizer.param_groups:
+                param_group["lr"] = lr
+
+        if not retrain_model and all(
+            os.path.exists(model.save_path) for model in self.models
+        ):
+            for model in self.models:
+                model.load()
+            return
+
+        assert train_loader is not None
+        assert val_loader is not None
+
+        self.min_pcc = [-1.0] * self.n_obj
+        self.train_metrics = ProxyMetrics.for_loader(train_loader, self.n_obj)
+        self.val_metrics = ProxyMetrics.for_loader(val_loader, self.n_obj)
+        statistics = {}
+
+        # The checkpoints of the best epochs, see SingleModelBaseTrainer.launch
+        self.checkpoint_writer = CheckpointWriter(keep=self.args.ckpt_keep)
+        try:
+            for epoch in range(self.n_epochs):
+                self.model.train()
+                # The metrics are computed every eval_every epochs and at the last epoch
+                evaluate = (
+                    epoch + 1
+                ) % self.eval_every == 0 or epoch == self.n_epochs - 1
+
+                losses = []
+                for batch_x, batch_y in train_loader:
+                    batch_x = batch_x.to(**tkwargs)
+                    batch_y = batch_y.to(**tkwargs)
+
+                    self.forward_opt.zero_grad()
+                    outputs = self.model(batch_x)
+                    # shape: (n_obj)
+                    loss = self.train_criterion(outputs, batch_y)
+                    losses.append(loss.detach().cpu().numpy() / batch_x.size(0))
+                    loss.sum().backward()
+                    self.forward_opt.step()
+                    if evaluate:
+                        self.train_metrics.update(outputs, batch_y)
+
+                losses = np.array(losses)
+                for which_obj in range(self.n_obj):
+                    statistics[f"model_{which_obj}/train/loss/mean"] = losses[
+                        :, which_obj
+                    ].mean()
+                    statistics[f"model_{which_obj}/train/loss/std"] = losses[
+                        :, which_obj
+                    ].std()
+                    statistics[f"model_{which_obj}/train/loss/max"] = losses[
+                        :, which_obj
+                    ].max()
+
+                if evaluate:
+                    self._evaluate_performance(
+                        statistics, epoch, train_loader, val_loader
+                    )
+                    self.train_metrics.reset()
+
+                for which_obj in range(self.n_obj):
+                    statistics[f"model_{which_obj}/train/lr"] = self.forward_lr
+                self.forward_lr *= self.forward_lr_decay
+                update_lr(self.forward_opt, self.forward_lr)
+        finally:
+            self.checkpoint_writer.close()
+
+
+def compile_module(module, example_input, backends=("compile", "trace")):
+    """
+    module: the module whose forward should be compiled in place
+    example_input: an input used to compile and check the module, shape: (batch_size, ...)
+    backends: the backends to try in order, compile for torch.compile and trace for
+    torch.jit.trace. The module is left in eager mode if all of them fail
+    return: the name of the backend in use
+
+    Only the forward is replaced, so the module keeps its class, its parameters and
+    everything else that the samplers rely on, e.g., isinstance checks and len().
+    """
+    eager_forward = module.forward
+    # Check with a second batch size as well, since the batch size changes during sampling
+    inputs = [example_input, example_input[: max(1, example_input.shape[0] // 2)]]
+    for backend in backends:
+        try:
+            if backend == "compile":
+                if not hasattr(torch, "compile"):
+                    continue
+                compiled_forward = torch.compile(eager_forward, dynamic=True)
+            elif backend == "trace":
+                compiled_forward = torch.jit.trace(
+                    module, example_input, check_trace=False
+                )
+            else:
+                raise ValueError(f"Unknown backend: {backend}")
+            # Bypass nn.Module.__setattr__ so that the compiled forward is not
+            # registered as a submodule
+            module.__dict__["forward"] = compiled_forward
+
+            # Warm up, including a backward pass for the guidance, and check the outputs
+            for x in inputs:
+                with torch.no_grad():
+                    expected = eager_forward(x)
+                    output = module(x)
+                if not torch.allclose(output, expected, rtol=1e-4, atol=1e-5):
+                    raise RuntimeError("outputs do not match the eager module")
+                x = x.detach().clone().requires_grad_(True)
+                module(x).sum().backward()
+            module.zero_grad(set_to_none=True)
+            print(f"Compiled {type(module).__name__} with {backend}")
+            return backend
+        except Exception as e:
+            module.__dict__.pop("forward", None)
+            module.zero_grad(set_to_none=True)
+            print(f"Failed to compile {type(module).__name__} with {backend}: {e}")
+    return "eager"
+
+
 def get_dataloader(
     X: np.ndarray,
     y: np.ndarray,
@@ -544,3 +1161,227 @@ def get_dataloader(
     )
 
     return train_loader, val_loader
+
+
+# Bump this when the preprocessing below changes, so that stale caches are rebuilt
+DATA_CACHE_VERSION = 1
+# The normalization statistics of the dataset that the later stages rely on
+DATA_STATISTICS = [
+    "x_mean",
+    "x_standard_dev",
+    "y_mean",
+    "y_standard_dev",
+    "x_min",
+    "x_max",
+    "y_min",
+    "y_max",
+]
+
+
+def get_dataset_state(task):
+    """
+    task: the task whose dataset statistics should be saved
+    return: a copy of the normalization statistics and methods of the dataset
+    """
+    state = {
+        stat: np.copy(getattr(task.dataset, stat))
+        for stat in DATA_STATISTICS
+        if getattr(task.dataset, stat, None) is not None
+    }
+    state["x_normalize_method"] = task.dataset.x_normalize_method
+    state["y_normalize_method"] = task.dataset.y_normalize_method
+    return state
+
+
+def set_dataset_state(task, state):
+    """
+    task: the task whose dataset statistics should be restored
+    state: the state returned by get_dataset_state
+    """
+    for stat in DATA_STATISTICS:
+        setattr(task.dataset, stat, np.copy(state[stat]) if stat in state else None)
+    task.dataset.x_normalize_method = state["x_normalize_method"]
+    task.dataset.y_normalize_method = state["y_normalize_method"]
+
+
+def get_dataset_version(task_name):
+    """
+    task_name: the name of a registered task
+    return: a hash of the registered dataset, computed from the stats of its shard files
+    and its arguments without building it, None if its shards are not all on the disk
+    """
+    spec = ob.spec(task_name)
+    dataset_class = (
+        import_name(spec.dataset) if isinstance(spec.dataset, str) else spec.dataset
+    )
+    if not isinstance(dataset_class, type):
+        return None
+
+    version = hashlib.sha1()
+    version.update(f"{DATA_CACHE_VERSION}-{dataset_class.__name__}".encode())
+    version.update(
+        json.dumps(spec.dataset_kwargs, sort_keys=True, default=str).encode()
+    )
+    shards = list(dataset_class.register_x_shards()) + list(
+        dataset_class.register_y_shards()
+    )
+    for shard in shards:
+        if not isinstance(shard, DiskResource) or not shard.is_downloaded:
+            return None
+        stat = os.stat(shard.disk_target)
+        version.update(
+            f"{shard.disk_target}-{stat.st_size}-{stat.st_mtime_ns}".encode()
+        )
+    return version.hexdigest()
+
+
+def get_data_fingerprint(task):
+    """
+    task: the task whose dataset should be identified
+    return: a hash of the dataset shards, it changes whenever a shard file is rewritten,
+    the in-memory shards are hashed once per dataset
+    """
+    dataset = task.dataset
+    shards = list(dataset.x_shards) + list(dataset.y_shards)
+    # The hash of the in-memory shards is kept until the shards are replaced
+    shard_ids = tuple(id(shard) for shard in shards)
+    memo = getattr(dataset, "_data_fingerprint", None)
+    if memo is not None and memo[0] == shard_ids:
+        return memo[1]
+
+    fingerprint = hashlib.sha1()
+    fingerprint.update(f"{DATA_CACHE_VERSION}-{type(dataset).__name__}".encode())
+    in_memory = False
+    for shard in shards:
+        if isinstance(shard, np.ndarray):
+            in_memory = True
+            fingerprint.update(np.ascontiguousarray(shard).tobytes())
+        else:
+            stat = os.stat(shard.disk_target)
+            fingerprint.update(
+                f"{shard.disk_target}-{stat.st_size}-{stat.st_mtime_ns}".encode()
+            )
+    fingerprint.update(
+        f"{dataset.dataset_size}-{dataset.dataset_min_percentile}"
+        f"-{dataset.dataset_max_percentile}".encode()
+    )
+    fingerprint = fingerprint.hexdigest()
+    if in_memory:
+        dataset._data_fingerprint = (shard_ids, fingerprint)
+    return fingerprint
+
+
+def get_data_cache_path(cache_dir, task_name, normalization=True):
+    return os.path.join(cache_dir, f"{task_name}-normalization={normalization}.npz")
+
+
+def read_data_cache(cache_path, fingerprint):
+    """
+    return: the preprocessed X and y and the dataset state saved in cache_path, None if
+    the cache does not exist or was written for another fingerprint
+    """
+    if fingerprint is None or not os.path.exists(cache_path):
+        return None
+    with np.load(cache_path, allow_pickle=False) as data:
+        if str(data["fingerprint"]) != fingerprint:
+            return None
+        state = {
+            stat: data[f"stat_{stat}"]
+            for stat in DATA_STATISTICS
+            if f"stat_{stat}" in data
+        }
+        state["x_normalize_method"] = str(data["x_normalize_method"])
+        state["y_normalize_method"] = str(data["y_normalize_method"])
+        return data["X"], data["y"], state
+
+
+def load_cached_task_data(task_name, normalization=True, cache_dir=None):
+    """
+    task_name: the name of a registered task
+    return: the preprocessed X and y and the dataset state cached for the task, without
+    building the task, None if the cache is missing or stale
+    """
+    if not cache_dir:
+        return None
+    cache_path = get_data_cache_path(cache_dir, task_name, normalization)
+    cached = read_data_cache(cache_path, get_dataset_version(task_name))
+    if cached is not None:
+        print(f"Loaded the preprocessed data from {cache_path}")
+    return cached
+
+
+def preprocess_task_data(task, normalization=True):
+    """
+    task: the task to get the data from
+    normalization: whether to normalize the inputs and outputs with z-score normalization
+    return: the preprocessed X and y, X is flattened to logits for discrete tasks
+    """
+    X = task.x.copy()
+    y = task.y.copy()
+
+    if task.is_discrete:
+        X = task.to_logits(X)
+        data_size, n_dim, n_classes = tuple(X.shape)
+        X = X.reshape(-1, n_dim * n_classes)
+    if task.is_sequence:
+        X = task.to_logits(X)
+
+    # For usual cases, we normalize the inputs and outputs with z-score normalization
+    if normalization:
+        X = task.normalize_x(X)
+        y = task.normalize_y(y)
+
+    return X, y
+
+
+def load_task_data(task, task_name, normalization=True, cache_dir=None):
+    """
+    task: the task to get the data from
+    task_name: the name of the task, used to name the cache file
+    normalization: whether to normalize the inputs and outputs with z-score normalization
+    cache_dir: the folder of the cache, the data is preprocessed from scratch if empty
+    return: the preprocessed X and y
+
+    The cache holds the preprocessed data and the normalization statistics of the dataset,
+    the statistics are restored into task.dataset so that task.normalize_x, task.denormalize_x,
+    etc. behave exactly as after preprocessing from scratch.
+    """
+    if not cache_dir:
+        return preprocess_task_data(task, normalization=normalization)
+
+    cache_path = get_data_cache_path(cache_dir, task_name, normalization)
+    # The registered datasets are identified without reading their shards, the same
+    # version lets load_cached_task_data skip building the task
+    fingerprint = get_dataset_version(task_name)
+    if fingerprint is None:
+        fingerprint = get_data_fingerprint(task)
+    cached = read_data_cache(cache_path, fingerprint)
+    if cached is not None:
+        X, y, state = cached
+        set_dataset_state(task, state)
+        print(f"Loaded the preprocessed data from {cache_path}")
+        return X, y
+
+    X, y = preprocess_task_data(task, normalization=normalization)
+
+    arrays = {
+        "X": X,
+        "y": y,
+        "fingerprint": np.asarray(fingerprint),
+        "x_normalize_method": np.asarray(task.dataset.x_normalize_method),
+        "y_normalize_method": np.asarray(task.dataset.y_normalize_method),
+    }
+    for stat in DATA_STATISTICS:
+        value = getattr(task.dataset, stat, None)
+        if value is not None:
+            arrays[f"stat_{stat}"] = np.asarray(value)
+
+    # Write to a temporary file first, so that a concurrent stage never reads a partial cache
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, cache_path)
+    print(f"Saved the preprocessed data to {cache_path}")
+
+    return X, y
@@ -1,14 +1,67 @@
 import abc
+import json
 import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from typing import Optional, Union
 
 import numpy as np
-from pymoo.util.nds.non_dominated_sorting import NonDominatedSorting
 
 from offline_moo.off_moo_bench.disk_resource import DiskResource
+from offline_moo.off_moo_bench.front_index import FrontIndex, get_fronts
 from offline_moo.off_moo_bench.utils import get_N_nondominated_indices
 
 
+def compute_statistics(values):
+    # size, mean, sum of squared deviations, min and max of one shard
+    # computed in float64 with a single vectorized call each
+    mean = np.mean(values, axis=0, dtype=np.float64)
+    return dict(
+        size=values.shape[0],
+        mean=mean,
+        m2=np.sum(np.square(values - mean), axis=0, dtype=np.float64),
+        min=np.min(values, axis=0),
+        max=np.max(values, axis=0),
+        dtype=values.dtype,
+    )
+
+
+def merge_statistics(statistics, other_statistics):
+    # merge the statistics of two disjoint sets of samples (Chan et al.)
+    if statistics is None or statistics["size"] == 0:
+        return other_statistics
+    if other_statistics is None or other_statistics["size"] == 0:
+        return statistics
+
+    size = statistics["size"] + other_statistics["size"]
+    delta = other_statistics["mean"] - statistics["mean"]
+    return dict(
+        size=size,
+        mean=statistics["mean"] + delta * (other_statistics["size"] / size),
+        m2=statistics["m2"]
+        + other_statistics["m2"]
+        + np.square(delta) * (statistics["size"] * other_statistics["size"] / size),
+        min=np.minimum(statistics["min"], other_statistics["min"]),
+        max=np.maximum(statistics["max"], other_statistics["max"]),
+        dtype=np.result_type(statistics["dtype"], other_statistics["dtype"]),
+    )
+
+
+def relabel_shard(relabel_function, x_shard_data, y_shard_data, batch_size):
+    # new predictions of one shard, computed in batches of batch_size samples
+    if y_shard_data.shape[0] == 0:
+        return y_shard_data[:0].copy()
+    batch_size = batch_size if batch_size else y_shard_data.shape[0]
+    y_batches = [
+        relabel_function(
+            x_shard_data[position : position + batch_size],
+            y_shard_data[position : position + batch_size],
+        )
+        for position in range(0, y_shard_data.shape[0], batch_size)
+    ]
+    return np.concatenate(y_batches, axis=0)
+
+
 class DatasetBuilder(abc.ABC):
 
     @property
@@ -51,12 +104,20 @@ class DatasetBuilder(abc.ABC):
         max_samples: Optional[Union[int, None]] = None,
         max_percentile: Optional[float] = 100.0,
         min_percentile: Optional[float] = 0.0,
+        mmap_mode: Optional[str] = None,
     ) -> None:
 
         assert x_normalize_method in ["min-max", "z-score"]
         assert y_normalize_method in ["min-max", "z-score"]
         assert 0.0 <= min_percentile <= max_percentile <= 100.0
 
+        # materialized x, y, x_test and y_test with the state they were built in
+        self._materialized = {}
+
+        # memory-map the shards stored on disk instead of reading them to memory,
+        # None keeps the mode of each DiskResource
+        self.mmap_mode = mmap_mode
+
         self.x_shards = (
             (x_shards,)
             if isinstance(x_shards, np.ndarray) or isinstance(x_shards, DiskResource)
@@ -131,6 +192,7 @@ class DatasetBuilder(abc.ABC):
         self._disable_subsample = True
 
         self.fronts = None
+        self.front_index = None
         self.top_k_solutions = None
 
         for x, y in self.iterate_samples():
@@ -142,11 +204,15 @@ class DatasetBuilder(abc.ABC):
             self.output_dtype = y.dtype
             break
 
+        # the size of the dataset only depends on the shapes of the shards
         self.dataset_size = 0
-        for i, y in enumerate(self.iterate_samples(return_x=False)):
-            self.dataset_size += 1
-            if i == 0 and y.shape[0] != self.output_size:
+        for shard_id in range(self.get_num_shards()):
+            y_shard_data = self.get_shard_y(shard_id)
+            if shard_id == 0 and int(np.prod(y_shard_data.shape[1:])) != (
+                self.output_size
+            ):
                 raise ValueError(f"Predictions must have shape [N, n_obj]")
+            self.dataset_size += y_shard_data.shape[0]
 
         (self.x_min, self.x_max, self.y_min, self.y_max) = self.get_xy_min_max()
 
@@ -178,7 +244,7 @@ class DatasetBuilder(abc.ABC):
             return self.x_shards[shard_id]
 
         elif isinstance(self.x_shards[shard_id], DiskResource):
-            return np.load(self.x_shards[shard_id].disk_target)
+            return self.x_shards[shard_id].load(mmap_mode=self.mmap_mode)
 
     def get_shard_y(self, shard_id):
         if 0 < shard_id >= self.get_num_shards():
@@ -188,7 +254,7 @@ class DatasetBuilder(abc.ABC):
             return self.y_shards[shard_id]
 
         elif isinstance(self.y_shards[shard_id], DiskResource):
-            return np.load(self.y_shards[shard_id].disk_target)
+            return self.y_shards[shard_id].load(mmap_mode=self.mmap_mode)
 
     def set_shard_x(
         self, shard_id, shard_data, to_disk=None, disk_target=None, is_absolute=None
@@ -219,7 +285,9 @@ class DatasetBuilder(abc.ABC):
 
         # possibly write shard to an existing file on disk
         if isinstance(self.x_shards[shard_id], DiskResource):
-            np.save(self.x_shards[shard_id].disk_target, shard_data)
+            self.x_shards[shard_id].save(shard_data)
+
+        self.invalidate_materialized()
 
     def set_shard_y(
         self, shard_id, shard_data, to_disk=None, disk_target=None, is_absolute=None
@@ -249,7 +317,9 @@ class DatasetBuilder(abc.ABC):
 
         # possibly write shard to an existing file on disk
         if isinstance(self.y_shards[shard_id], DiskResource):
-            np.save(self.y_shards[shard_id].disk_target, shard_data)
+            self.y_shards[shard_id].save(shard_data)
+
+        self.invalidate_materialized()
 
     def get_shard_x_test(self, shard_id):
         if 0 < shard_id >= self.get_num_test_shards():
@@ -259,7 +329,7 @@ class DatasetBuilder(abc.ABC):
             return self.x_test_shards[shard_id]
 
         elif isinstance(self.x_test_shards[shard_id], DiskResource):
-            return np.load(self.x_test_shards[shard_id].disk_target)
+            return self.x_test_shards[shard_id].load(mmap_mode=self.mmap_mode)
 
     def get_shard_y_test(self, shard_id):
         if 0 < shard_id >= self.get_num_test_shards():
@@ -269,7 +339,7 @@ class DatasetBuilder(abc.ABC):
             return self.y_test_shards[shard_id]
 
         elif isinstance(self.y_test_shards[shard_id], DiskResource):
-            return np.load(self.y_test_shards[shard_id].disk_target)
+            return self.y_test_shards[shard_id].load(mmap_mode=self.mmap_mode)
 
     def set_shard_x_test(
         self, shard_id, shard_data, to_disk=None, disk_target=None, is_absolute=None
@@ -302,7 +372,9 @@ class DatasetBuilder(abc.ABC):
 
         # possibly write shard to an existing file on disk
         if isinstance(self.x_test_shards[shard_id], DiskResource):
-            np.save(self.x_test_shards[shard_id].disk_target, shard_data)
+            self.x_test_shards[shard_id].save(shard_data)
+
+        self.invalidate_materialized()
 
     def set_shard_y_test(
         self, shard_id, shard_data, to_disk=None, disk_target=None, is_absolute=None
@@ -334,7 +406,9 @@ class DatasetBuilder(abc.ABC):
 
         # possibly write shard to an existing file on disk
         if isinstance(self.y_test_shards[shard_id], DiskResource):
-            np.save(self.y_test_shards[shard_id].disk_target, shard_data)
+            self.y_test_shards[shard_id].save(shard_data)
+
+        self.invalidate_materialized()
 
     def batch_transform(self, x_batch, y_batch, return_x=True, return_y=True):
         if not self.forbidden_normalize_x and self.is_normalized_x and return_x:
@@ -517,30 +591,80 @@ class DatasetBuilder(abc.ABC):
                 for i in range(batch.shape[0]):
                     yield batch[i]
 
-    def get_xy_min_max(self):
-        x_min = None
-        x_max = None
-        y_min = None
-        y_max = None
-        for x, y in self.iterate_samples():
-            if x_min is None:
-                x_min = x.copy()
-                x_max = x.copy()
-                y_min = y.copy()
-                y_max = y.copy()
-            else:
-                x_min = np.minimum(x_min, x)
-                x_max = np.maximum(x_max, x)
-                y_min = np.minimum(y_min, y)
-                y_max = np.maximum(y_max, y)
+    def iterate_shards(self, return_x=True, return_y=True, test=False):
+        # same samples and transforms as iterate_batches, one shard at a time
+        if not return_x and not return_y:
+            raise ValueError("Invalid arguments passed to shard generator")
+
+        get_num_shards = self.get_num_test_shards if test else self.get_num_shards
+        get_shard_x = self.get_shard_x_test if test else self.get_shard_x
+        get_shard_y = self.get_shard_y_test if test else self.get_shard_y
+
+        sample_id = 0
+        for shard_id in range(get_num_shards()):
+            x_shard_data = get_shard_x(shard_id) if return_x else None
+            y_shard_data = get_shard_y(shard_id)
+            samples_read = y_shard_data.shape[0]
+
+            if not self._disable_subsample:
+                indices = np.where(
+                    self.dataset_visible_mask[sample_id : sample_id + samples_read]
+                )[0]
+
+                x_shard_data = x_shard_data[indices] if return_x else None
+                y_shard_data = y_shard_data[indices]
+
+            if not self._disable_transform:
+                x_shard_data, y_shard_data = self.batch_transform(
+                    x_shard_data, y_shard_data, return_x=return_x, return_y=return_y
+                )
+
+            sample_id += samples_read
+            yield (
+                x_shard_data if return_x else None,
+                y_shard_data if return_y else None,
+            )
+
+    def get_statistics(self, return_x=True, return_y=True, test=False):
+        # statistics of the visible samples, computed per shard and merged
+        x_statistics = None
+        y_statistics = None
+        for x_shard_data, y_shard_data in self.iterate_shards(
+            return_x=return_x, return_y=return_y, test=test
+        ):
+            if return_x and x_shard_data.shape[0] > 0:
+                x_statistics = merge_statistics(
+                    x_statistics, compute_statistics(x_shard_data)
+                )
+            if return_y and y_shard_data.shape[0] > 0:
+                y_statistics = merge_statistics(
+                    y_statistics, compute_statistics(y_shard_data)
+                )
+        return x_statistics, y_statistics
+
+    def get_xy_min_max(self, train_statistics=None):
+        if train_statistics is None:
+            train_statistics = self.get_statistics()
+        test_statistics = self.get_statistics(test=True)
+
+        x_statistics = merge_statistics(train_statistics[0], test_statistics[0])
+        y_statistics = merge_statistics(train_statistics[1], test_statistics[1])
 
-        for x, y in self.iterate_test_samples():
-            x_min = np.minimum(x_min, x)
-            x_max = np.maximum(x_max, x)
-            y_min = np.minimum(y_min, y)
-            y_max = np.maximum(y_max, y)
+        return (
+            x_statistics["min"],
+            x_statistics["max"],
+            y_statistics["min"],
+            y_statistics["max"],
+        )
 
-        return x_min, x_max, y_min, y_max
+    @staticmethod
+    def get_mean_standard_dev(statistics):
+        # the mean and the population standard deviation in the shape and dtype
+        # of the samples with a leading batch axis
+        dtype = np.result_type(statistics["dtype"], np.float32)
+        mean = statistics["mean"].astype(dtype)[np.newaxis]
+        standard_dev = np.sqrt(statistics["m2"] / statistics["size"]).astype(dtype)
+        return mean, standard_dev[np.newaxis]
 
     def __iter__(self):
         for x_batch, y_batch in self.iterate_batches(self.internal_batch_size):
@@ -556,38 +680,20 @@ class DatasetBuilder(abc.ABC):
         original_is_normalized_x = self.is_normalized_x
         self.is_normalized_x = False
 
-        samples = x_mean = 0
-        for x_batch in self.iterate_batches(self.internal_batch_size, return_y=False):
-            # calculate how many samples are actually in the current batch
-            batch_size = np.array(x_batch.shape[0], dtype=np.float32)
-
-            # update x_statistics using dynamic programming
-            x_mean = x_mean * (samples / (samples + batch_size)) + np.sum(
-                x_batch, axis=0, keepdims=True
-            ) / (samples + batch_size)
-
-            samples += batch_size
-
-        samples = x_variance = 0
-        for x_batch in self.iterate_batches(self.internal_batch_size, return_y=False):
-
-            batch_size = np.array(x_batch.shape[0], dtype=np.float32)
-
-            x_variance = x_variance * (samples / (samples + batch_size)) + np.sum(
-                np.square(x_batch - x_mean), axis=0, keepdims=True
-            ) / (samples + batch_size)
-
-            samples += batch_size
-
-        self.x_mean = x_mean
-        self.x_standard_dev = np.sqrt(x_variance)
+        # a single pass over the shards gives both the moments and the bounds
+        train_statistics = self.get_statistics()
+        self.x_mean, self.x_standard_dev = self.get_mean_standard_dev(
+            train_statistics[0]
+        )
 
         # remove zero standard deviations to prevent singularities
         self.x_standard_dev = np.where(
             self.x_standard_dev == 0.0, 1.0, self.x_standard_dev
         )
 
-        (self.x_min, self.x_max, self.y_min, self.y_max) = self.get_xy_min_max()
+        (self.x_min, self.x_max, self.y_min, self.y_max) = self.get_xy_min_max(
+            train_statistics
+        )
 
         # reset the normalized state to what it originally was
         self.is_normalized_x = original_is_normalized_x
@@ -599,37 +705,20 @@ class DatasetBuilder(abc.ABC):
         original_is_normalized_y = self.is_normalized_y
         self.is_normalized_y = False
 
-        samples = y_mean = 0
-        for y_batch in self.iterate_batches(self.internal_batch_size, return_x=False):
-            # calculate how many samples are actually in the current batch
-            batch_size = np.array(y_batch.shape[0], dtype=np.float32)
-
-            # update x_statistics using dynamic programming
-            y_mean = y_mean * (samples / (samples + batch_size)) + np.sum(
-                y_batch, axis=0, keepdims=True
-            ) / (samples + batch_size)
-
-            samples += batch_size
-
-        samples = y_variance = 0
-        for y_batch in self.iterate_batches(self.internal_batch_size, return_x=False):
-            batch_size = np.array(y_batch.shape[0], dtype=np.float32)
-
-            y_variance = y_variance * (samples / (samples + batch_size)) + np.sum(
-                np.square(y_batch - y_mean), axis=0, keepdims=True
-            ) / (samples + batch_size)
-
-            samples += batch_size
-
-        self.y_mean = y_mean
-        self.y_standard_dev = np.sqrt(y_variance)
+        # a single pass over the shards gives both the moments and the bounds
+        train_statistics = self.get_statistics()
+        self.y_mean, self.y_standard_dev = self.get_mean_standard_dev(
+            train_statistics[1]
+        )
 
         # remove zero standard deviations to prevent singularities
         self.y_standard_dev = np.where(
             self.y_standard_dev == 0.0, 1.0, self.y_standard_dev
         )
 
-        (self.x_min, self.x_max, self.y_min, self.y_max) = self.get_xy_min_max()
+        (self.x_min, self.x_max, self.y_min, self.y_max) = self.get_xy_min_max(
+            train_statistics
+        )
 
         # reset the normalized state to what it originally was
         self.is_normalized_y = original_is_normalized_y
@@ -648,6 +737,10 @@ class DatasetBuilder(abc.ABC):
         if min_percentile > max_percentile:
             raise ValueError("invalid arguments provided")
 
+        # remember the percentiles, so that relabel can sample the dataset again
+        self.dataset_min_percentile = min_percentile
+        self.dataset_max_percentile = max_percentile
+
         # convert the original prediction generator to a numpy tensor
         self._disable_subsample = True
         self._disable_transform = True
@@ -655,7 +748,7 @@ class DatasetBuilder(abc.ABC):
         y = np.concatenate(
             list(self.iterate_batches(self.internal_batch_size, return_x=False)), axis=0
         )
-        fronts = self.regain_fronts(y)
+        fronts = self.regain_fronts(y, path=self.get_front_index_path())
 
         self._disable_subsample = False
         self._disable_transform = False
@@ -663,10 +756,10 @@ class DatasetBuilder(abc.ABC):
         if min_percentile != 0.0 or max_percentile != 100.0:
 
             best_min_percentile_indices = get_N_nondominated_indices(
-                Y=y, num_ret=y.shape[0] * min_percentile, fronts=fronts
+                Y=y, num_ret=int(y.shape[0] * min_percentile / 100.0), fronts=fronts
             )
             best_max_percentile_indices = get_N_nondominated_indices(
-                Y=y, num_ret=y.shape[0] * max_percentile, fronts=fronts
+                Y=y, num_ret=int(y.shape[0] * max_percentile / 100.0), fronts=fronts
             )
 
             visible_mask = np.full([y.shape[0]], False, dtype=np.bool_)
@@ -674,12 +767,9 @@ class DatasetBuilder(abc.ABC):
             visible_mask[best_min_percentile_indices] = False
 
             self.dataset_visible_mask = visible_mask
-            self.dataset_size = len(best_max_percentile_indices) - len(
-                best_min_percentile_indices
-            )
-
-        else:
-            self.fronts = fronts
+            # the best min_percentile samples are not always among the best
+            # max_percentile ones when a front is cut, so the mask is counted
+            self.dataset_size = int(visible_mask.sum())
 
         if not self.forbidden_normalize_x and self.is_normalized_x:
             self.update_x_statistics()
@@ -687,8 +777,36 @@ class DatasetBuilder(abc.ABC):
         if self.is_normalized_y:
             self.update_y_statistics()
 
-    def regain_fronts(self, y):
-        return NonDominatedSorting().do(y)
+        # the fronts of the visible samples
+        self.fronts = self.get_visible_fronts()
+
+    def get_front_index_path(self):
+        # the front index of the full dataset is saved next to its first y shard
+        if len(self.y_shards) == 0 or not all(
+            isinstance(shard, DiskResource) for shard in self.y_shards
+        ):
+            return None
+        return f"{self.y_shards[0].disk_target}-fronts.npz"
+
+    def regain_fronts(self, y, path=None):
+        # the index is loaded from path when it was built for the same y,
+        # and new points can be inserted later with self.front_index.add
+        self.front_index = FrontIndex.cached(y, path)
+        return self.front_index.fronts
+
+    def get_visible_fronts(self):
+        # the fronts of the visible samples self.y. When the best samples are the
+        # visible ones, removing the others does not change their ranks, so the
+        # fronts are taken from the index of the full dataset. Otherwise, the
+        # visible samples are sorted apart and self.front_index is kept
+        visible_mask = self.dataset_visible_mask
+        if (
+            self.front_index is not None
+            and len(self.front_index) == visible_mask.shape[0]
+            and self.dataset_min_percentile == 0.0
+        ):
+            return get_fronts(self.front_index.ranks[visible_mask])
+        return FrontIndex(self.y).fronts
 
     def get_N_non_dominated_solutions(
         self, N: int, return_x=True, return_y=True, regain_fronts=False
@@ -696,7 +814,7 @@ class DatasetBuilder(abc.ABC):
         assert return_x or return_y, "invalid parameter setting."
 
         if regain_fronts or self.fronts is None:
-            self.fronts = self.regain_fronts(self.y)
+            self.fronts = self.get_visible_fronts()
 
         N_best_indexes = get_N_nondominated_indices(
             Y=self.y, num_ret=N, fronts=self.fronts
@@ -707,47 +825,114 @@ class DatasetBuilder(abc.ABC):
             self.y[N_best_indexes] if return_y else None,
         )
 
+    def get_materialization_state(self):
+        # everything the content of x, y, x_test and y_test depends on, arrays
+        # and shards are compared by identity and everything else by value
+        return (
+            tuple(self.x_shards),
+            tuple(self.y_shards),
+            tuple(self.x_test_shards),
+            tuple(self.y_test_shards),
+            self.dataset_visible_mask,
+            self._disable_subsample,
+            self._disable_transform,
+            self.forbidden_normalize_x,
+            self.is_normalized_x,
+            self.is_normalized_y,
+            self.x_normalize_method,
+            self.y_normalize_method,
+            self.x_mean,
+            self.x_standard_dev,
+            self.y_mean,
+            self.y_standard_dev,
+            self.x_min,
+            self.x_max,
+            self.y_min,
+            self.y_max,
+        )
+
+    @staticmethod
+    def is_same_materialization_state(state, other_state):
+        if len(state) != len(other_state):
+            return False
+        for value, other_value in zip(state, other_state):
+            if isinstance(value, tuple) and isinstance(other_value, tuple):
+                if len(value) != len(other_value) or any(
+                    a is not b for a, b in zip(value, other_value)
+                ):
+                    return False
+            elif value is other_value:
+                continue
+            elif (
+                isinstance(value, (np.ndarray, DiskResource))
+                or isinstance(other_value, (np.ndarray, DiskResource))
+                or value != other_value
+            ):
+                return False
+        return True
+
+    def invalidate_materialized(self):
+        self._materialized = {}
+
+    def get_materialized(self, name, iterate_batches):
+        # the state is recorded before iterating, so that a transform that
+        # updates the statistics while iterating invalidates the result
+        state = self.get_materialization_state()
+        if name in self._materialized:
+            cached_state, array = self._materialized[name]
+            if self.is_same_materialization_state(cached_state, state):
+                return array.view()
+
+        array = np.concatenate(list(iterate_batches()), axis=0)
+
+        # hand out read-only views, so that callers cannot corrupt the cache
+        array.flags.writeable = False
+        self._materialized[name] = (state, array)
+        return array.view()
+
     @property
     def x(self) -> np.ndarray:
-        return np.concatenate(
-            [x for x in self.iterate_batches(self.internal_batch_size, return_y=False)],
-            axis=0,
+        return self.get_materialized(
+            "x",
+            lambda: self.iterate_batches(self.internal_batch_size, return_y=False),
         )
 
     @property
     def y(self) -> np.ndarray:
-        return np.concatenate(
-            [y for y in self.iterate_batches(self.internal_batch_size, return_x=False)],
-            axis=0,
+        return self.get_materialized(
+            "y",
+            lambda: self.iterate_batches(self.internal_batch_size, return_x=False),
         )
 
     @property
     def x_test(self) -> np.ndarray:
-        return np.concatenate(
-            [
-                x
-                for x in self.iterate_test_batches(
-                    self.internal_batch_size, return_y=False
-                )
-            ],
-            axis=0,
+        return self.get_materialized(
+            "x_test",
+            lambda: self.iterate_test_batches(self.internal_batch_size, return_y=False),
         )
 
     @property
     def y_test(self) -> np.ndarray:
-        return np.concatenate(
-            [
-                y
-                for y in self.iterate_test_batches(
-                    self.internal_batch_size, return_x=False
-                )
-            ],
-            axis=0,
+        return self.get_materialized(
+            "y_test",
+            lambda: self.iterate_test_batches(self.internal_batch_size, return_x=False),
         )
 
     def relabel(
-        self, relabel_function, to_disk=None, disk_target=None, is_absolute=None
+        self,
+        relabel_function,
+        to_disk=None,
+        disk_target=None,
+        is_absolute=None,
+        batch_size=None,
+        num_workers=0,
     ):
+        # batch_size is the number of samples given to relabel_function at once,
+        # None uses internal_batch_size and 0 gives whole shards to vectorized
+        # oracles. num_workers > 0 relabels the shards in a process pool, so the
+        # relabel_function must be picklable. When the shards are written to a new
+        # disk_target, the finished shards are recorded in a progress file and an
+        # interrupted relabel resumes from there
 
         # check that statistics are not frozen for this dataset
         if self.freeze_statistics:
@@ -761,81 +946,150 @@ class DatasetBuilder(abc.ABC):
         ):
             raise ValueError("must specify location when saving to disk")
 
-        # prevent the data set for being sub-sampled or normalized
-        self._disable_subsample = True
-        examples = self.y.shape[0]
-        examples_processed = 0
-
-        # track a list of incomplete batches between shards
-        y_shard = []
-        y_shard_size = 0
-
-        # calculate the appropriate size of the first shard
-        shard_id = 0
-        shard = self.get_shard_y(shard_id)
-        shard_size = shard.shape[0]
-
-        # relabel the prediction values of the internal data set
-        for x_batch, y_batch in self.iterate_batches(self.internal_batch_size):
-
-            # calculate the new prediction values to be stored as shards
-            y_batch = relabel_function(x_batch, y_batch)
-            read_position = 0
-
-            # remove potential normalization on the predictions
-            if self.is_normalized_y:
-                y_batch = self.denormalize_y(y_batch)
-
-            # loop once per batch contained in the shard
-            while read_position < y_batch.shape[0]:
-
-                # calculate the intended number of samples to serialize
-                target_size = shard_size - y_shard_size
+        batch_size = self.internal_batch_size if batch_size is None else batch_size
+
+        # shards are replaced one at a time
+        self.y_shards = list(self.y_shards)
+
+        # resume from the shards that an interrupted relabel already wrote
+        progress_target = None
+        completed_shards = set()
+        shard_sizes = [
+            int(self.get_shard_y(shard_id).shape[0])
+            for shard_id in range(self.get_num_shards())
+        ]
+        if to_disk:
+            progress_target = DiskResource(
+                f"{disk_target}-relabel-progress.json", is_absolute=is_absolute
+            ).disk_target
+            completed_shards = self.load_relabel_progress(
+                progress_target, shard_sizes, disk_target, is_absolute
+            )
 
-                # slice out a component of the current shard
-                y_slice = y_batch[read_position : read_position + target_size]
-                samples_read = y_slice.shape[0]
+        # prevent the data set for being sub-sampled
+        self._disable_subsample = True
+        try:
+            shards = (
+                (shard_id, x_shard_data, y_shard_data)
+                for shard_id, (x_shard_data, y_shard_data) in enumerate(
+                    self.iterate_shards()
+                )
+                if shard_id not in completed_shards
+            )
 
-                # increment the read position in the prediction tensor
-                # and update the number of shards and examples processed
-                read_position += target_size
-                examples_processed += samples_read
+            # the shards in flight, in shard order
+            pending = deque()
+            if num_workers > 0:
+                executor = ProcessPoolExecutor(max_workers=num_workers)
+
+                def parallel_results():
+                    # keep a bounded number of shards in flight, in shard order
+                    for shard_id, x_shard_data, y_shard_data in shards:
+                        future = executor.submit(
+                            relabel_shard,
+                            relabel_function,
+                            x_shard_data,
+                            y_shard_data,
+                            batch_size,
+                        )
+                        pending.append((shard_id, future))
+                        if len(pending) >= 2 * num_workers:
+                            shard_id, future = pending.popleft()
+                            yield shard_id, future.result()
+                    while pending:
+                        shard_id, future = pending.popleft()
+                        yield shard_id, future.result()
+
+                results = parallel_results()
+            else:
+                executor = None
+                results = (
+                    (
+                        shard_id,
+                        relabel_shard(
+                            relabel_function, x_shard_data, y_shard_data, batch_size
+                        ),
+                    )
+                    for shard_id, x_shard_data, y_shard_data in shards
+                )
 
-                # update the current shard to be serialized
-                y_shard.append(y_slice)
-                y_shard_size += samples_read
+            try:
+                for shard_id, y_shard_data in results:
 
-                # yield the current batch when enough samples are loaded
-                if y_shard_size >= shard_size or examples_processed >= examples:
+                    # remove potential normalization on the predictions
+                    if self.is_normalized_y:
+                        y_shard_data = self.denormalize_y(y_shard_data)
 
                     # serialize the value of the new shard data
                     self.set_shard_y(
                         shard_id,
-                        np.concatenate(y_shard, axis=0),
+                        y_shard_data,
                         to_disk=to_disk,
                         disk_target=disk_target,
                         is_absolute=is_absolute,
                     )
 
-                    # reset the buffer for incomplete batches
-                    y_shard = []
-                    y_shard_size = 0
-
-                    # calculate the appropriate size for the next shard
-                    if not examples_processed >= examples:
-                        shard_id += 1
-                        shard = self.get_shard_y(shard_id)
-                        shard_size = shard.shape[0]
+                    if progress_target is not None:
+                        completed_shards.add(shard_id)
+                        self.save_relabel_progress(
+                            progress_target, shard_sizes, completed_shards
+                        )
+            finally:
+                if executor is not None:
+                    # the shards that did not start are dropped, python 3.8 has no
+                    # cancel_futures in shutdown
+                    for _, future in pending:
+                        future.cancel()
+                    executor.shutdown(wait=True)
+        finally:
+            self._disable_subsample = False
+
+        # the relabel is complete, a later relabel starts from scratch
+        if progress_target is not None and os.path.exists(progress_target):
+            os.remove(progress_target)
 
         # re-sample the data set and recalculate statistics
-        self._disable_subsample = False
         self.subsample(
             max_samples=self.dataset_size,
-            distribution=self.dataset_distribution,
             max_percentile=self.dataset_max_percentile,
             min_percentile=self.dataset_min_percentile,
         )
 
+    def load_relabel_progress(
+        self, progress_target, shard_sizes, disk_target, is_absolute
+    ):
+        # the shards recorded in the progress file whose files are complete
+        if not os.path.exists(progress_target):
+            return set()
+        with open(progress_target, "r") as f:
+            progress = json.load(f)
+
+        # the progress belongs to another dataset
+        if progress.get("shard_sizes") != shard_sizes:
+            return set()
+
+        completed_shards = set()
+        for shard_id in progress.get("completed", []):
+            shard = DiskResource(
+                f"{disk_target}-y-{shard_id}.npy", is_absolute=is_absolute
+            )
+            if shard.is_downloaded and shard.load().shape[0] == shard_sizes[shard_id]:
+                self.y_shards[shard_id] = shard
+                completed_shards.add(shard_id)
+        if completed_shards:
+            self.invalidate_materialized()
+        return completed_shards
+
+    @staticmethod
+    def save_relabel_progress(progress_target, shard_sizes, completed_shards):
+        # replace the progress file atomically, like the shards
+        temporary_target = f"{progress_target}.{os.getpid()}.tmp"
+        with open(temporary_target, "w") as f:
+            json.dump(
+                dict(shard_sizes=shard_sizes, completed=sorted(completed_shards)), f
+            )
+        os.replace(temporary_target, progress_target)
+
     def map_normalize_x(self):
 
         if self.forbidden_normalize_x:
@@ -44,6 +44,14 @@ class DiscreteDataset(DatasetBuilder):
         # initialize the dataset using the method in the base class
         super(DiscreteDataset, self).__init__(*args, **kwargs)
 
+    def get_materialization_state(self):
+        # the design values also depend on whether they are mapped to logits
+        return super(DiscreteDataset, self).get_materialization_state() + (
+            self.is_logits,
+            self.num_classes,
+            self.soft_interpolation,
+        )
+
     def batch_transform(self, x_batch, y_batch, return_x=True, return_y=True):
 
         # convert the design values from integers to logits
@@ -135,12 +143,27 @@ class DiscreteDataset(DatasetBuilder):
             raise ValueError("Unknown normalization method")
         return x
 
+    def get_logits_table(self):
+        # the logits of every class, shape: (num_classes, num_classes - 1), built
+        # with the full one hot computation so that the values are the same
+        key = (self.num_classes, self.soft_interpolation)
+        if getattr(self, "_logits_table", (None, None))[0] != key:
+            classes = np.arange(self.num_classes, dtype=np.int32)[np.newaxis]
+            self._logits_table = (key, self.one_hot_to_logits(classes)[0])
+        return self._logits_table[1]
+
     def to_logits(self, x):
 
         # check that the input format is correct
         if not np.issubdtype(x.dtype, np.integer):
             raise ValueError("cannot convert non-integers to logits")
 
+        # every design value only takes one of num_classes logit vectors, so a
+        # lookup avoids the one hot and log temporaries of the whole batch
+        return np.take(self.get_logits_table(), x, axis=0)
+
+    def one_hot_to_logits(self, x):
+
         # convert the integers to one hot vectors
         one_hot_x = one_hot(x, self.num_classes)
 
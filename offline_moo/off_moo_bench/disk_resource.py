@@ -1,9 +1,44 @@
 import os
+from collections import OrderedDict
 
 import numpy as np
 
 DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
 
+# the shards that were loaded last, shared by all datasets in the process,
+# evicted in least recently used order once either bound is exceeded
+SHARD_CACHE_SIZE = 8
+SHARD_CACHE_BYTES = 2**30
+_shard_cache = OrderedDict()
+
+
+def set_shard_cache_size(size=SHARD_CACHE_SIZE, max_bytes=SHARD_CACHE_BYTES):
+    global SHARD_CACHE_SIZE, SHARD_CACHE_BYTES
+    SHARD_CACHE_SIZE = size
+    SHARD_CACHE_BYTES = max_bytes
+    evict_shards()
+
+
+def evict_shards(disk_target=None):
+    # drop the cached copies of one shard, or shrink the cache to its bounds
+    if disk_target is not None:
+        for key in [key for key in _shard_cache if key[0] == disk_target]:
+            del _shard_cache[key]
+        return
+
+    def cached_bytes():
+        # memory-mapped shards live in the page cache, not in the process
+        return sum(
+            data.nbytes
+            for _, data in _shard_cache.values()
+            if not isinstance(data, np.memmap)
+        )
+
+    while len(_shard_cache) > SHARD_CACHE_SIZE or (
+        len(_shard_cache) > 1 and cached_bytes() > SHARD_CACHE_BYTES
+    ):
+        _shard_cache.popitem(last=False)
+
 
 class DiskResource:
 
@@ -11,14 +46,46 @@ class DiskResource:
     def get_data_path(file_path):
         return os.path.join(DATA_DIR, file_path)
 
-    def __init__(self, disk_target, is_absolute=True):
+    def __init__(self, disk_target, is_absolute=True, mmap_mode=None):
         self.disk_target = (
             os.path.abspath(disk_target)
             if is_absolute
             else DiskResource.get_data_path(disk_target)
         )
+        self.mmap_mode = mmap_mode
         os.makedirs(os.path.dirname(self.disk_target), exist_ok=True)
 
     @property
     def is_downloaded(self):
         return os.path.exists(self.disk_target)
+
+    def load(self, mmap_mode=None):
+        # the size and modification time identify the version of the file,
+        # so that a shard rewritten by another process is read again
+        mmap_mode = self.mmap_mode if mmap_mode is None else mmap_mode
+        stat = os.stat(self.disk_target)
+        key = (self.disk_target, mmap_mode)
+        version = (stat.st_size, stat.st_mtime_ns)
+
+        if key in _shard_cache and _shard_cache[key][0] == version:
+            _shard_cache.move_to_end(key)
+            return _shard_cache[key][1]
+
+        data = np.load(self.disk_target, mmap_mode=mmap_mode)
+
+        # the cached array is shared by every reader of the shard
+        if not isinstance(data, np.memmap):
+            data.flags.writeable = False
+
+        if SHARD_CACHE_SIZE > 0:
+            _shard_cache[key] = (version, data)
+            evict_shards()
+        return data
+
+    def save(self, data):
+        # write a temporary file first, so that readers never see a partial shard
+        temporary_target = f"{self.disk_target}.{os.getpid()}.tmp"
+        with open(temporary_target, "wb") as f:
+            np.save(f, data)
+        os.replace(temporary_target, self.disk_target)
+        evict_shards(self.disk_target)
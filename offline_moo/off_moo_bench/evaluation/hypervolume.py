@@ -0,0 +1,210 @@
+from bisect import bisect_left, bisect_right
+
+import numpy as np
+from scipy.stats import qmc
+
+# upper bound on the number of comparisons done at once by the Monte-Carlo estimator
+MAX_COMPARISONS = 2**24
+
+
+def get_non_dominated(Y):
+    # the distinct points of Y that no other point weakly dominates (minimization).
+    # A dominating point has a smaller sum and comes first lexicographically, so the
+    # first remaining point in that order is always non-dominated
+    Y = np.asarray(Y, dtype=np.float64)
+    n_obj = Y.shape[1]
+    Y = Y[np.lexsort(tuple(Y.T[::-1]) + (Y.sum(axis=1),))]
+    non_dominated = []
+    while Y.shape[0] > 0:
+        non_dominated.append(Y[0])
+        Y = Y[1:][~np.all(Y[1:] >= Y[0], axis=1)]
+    return np.array(non_dominated).reshape(-1, n_obj)
+
+
+def hypervolume_2d(Y, ref_point):
+    # sweep along the first objective, each point adds the strip between the best
+    # second objective before it and its own
+    Y = Y[np.lexsort((Y[:, 1], Y[:, 0]))]
+    best = np.minimum.accumulate(Y[:, 1])
+    previous_best = np.concatenate([ref_point[1:2], best[:-1]])
+    return float(np.sum((ref_point[0] - Y[:, 0]) * (previous_best - best)))
+
+
+def hypervolume_3d(Y, ref_point):
+    # sweep along the last objective, the area dominated on the first two objectives
+    # is kept on a staircase where the first objective increases and the second one
+    # decreases, so each point only updates the steps around it
+    Y = Y[np.argsort(Y[:, 2], kind="stable")]
+    ref_1, ref_2 = float(ref_point[0]), float(ref_point[1])
+    steps_1, steps_2 = [], []
+    area = 0.0
+    volume = 0.0
+    heights = np.append(Y[1:, 2], ref_point[2]) - Y[:, 2]
+
+    for (value_1, value_2, _), height in zip(Y.tolist(), heights.tolist()):
+        j = bisect_right(steps_1, value_1)
+        if j == 0 or steps_2[j - 1] > value_2:
+            # the point is not dominated on the first two objectives
+            j = bisect_left(steps_1, value_1)
+            end = j
+            # the second objective the area is bounded by, right before each step
+            bound_2 = steps_2[j - 1] if j > 0 else ref_2
+            start_1 = value_1
+            while end < len(steps_1) and steps_2[end] >= value_2:
+                area += (steps_1[end] - start_1) * (bound_2 - value_2)
+                start_1, bound_2 = steps_1[end], steps_2[end]
+                end += 1
+            next_1 = steps_1[end] if end < len(steps_1) else ref_1
+            area += (next_1 - start_1) * (bound_2 - value_2)
+            steps_1[j:end] = [value_1]
+            steps_2[j:end] = [value_2]
+        volume += area * height
+    return volume
+
+
+def hypervolume_wfg(Y, ref_point):
+    # WFG with slicing on the last objective: the points are visited from the worst
+    # to the best last objective, so the limit set of each point lies in the slice
+    # of the point and its exclusive volume reduces to one objective less
+    Y = get_non_dominated(Y)
+    Y = Y[np.argsort(-Y[:, -1], kind="stable")]
+    volume = 0.0
+    for k in range(Y.shape[0]):
+        exclusive = np.prod(ref_point[:-1] - Y[k, :-1])
+        if k + 1 < Y.shape[0]:
+            limit_set = np.maximum(Y[k + 1 :, :-1], Y[k, :-1])
+            exclusive -= hypervolume(get_non_dominated(limit_set), ref_point[:-1])
+        volume += (ref_point[-1] - Y[k, -1]) * exclusive
+    return float(volume)
+
+
+def hypervolume(Y, ref_point):
+    # exact hypervolume of Y (minimization) with respect to ref_point,
+    # the points that do not strictly dominate ref_point add no volume
+    ref_point = np.asarray(ref_point, dtype=np.float64).reshape(-1)
+    Y = np.atleast_2d(np.asarray(Y, dtype=np.float64))
+    Y = Y[np.all(Y < ref_point, axis=1)]
+    if Y.shape[0] == 0:
+        return 0.0
+
+    n_obj = Y.shape[1]
+    if n_obj == 1:
+        return float(ref_point[0] - Y[:, 0].min())
+    if n_obj == 2:
+        return hypervolume_2d(Y, ref_point)
+    if n_obj == 3:
+        return hypervolume_3d(Y, ref_point)
+    return hypervolume_wfg(Y, ref_point)
+
+
+def count_dominated(Y, samples):
+    # the number of samples weakly dominated by a point of Y, the samples are
+    # compared in chunks so that the memory does not grow with their number
+    chunk_size = max(1, MAX_COMPARISONS // Y.shape[0])
+    count = 0
+    for start in range(0, samples.shape[0], chunk_size):
+        block = samples[start : start + chunk_size]
+        is_dominated = Y[None, :, 0] <= block[:, None, 0]
+        for m in range(1, Y.shape[1]):
+            is_dominated &= Y[None, :, m] <= block[:, None, m]
+        count += int(np.count_nonzero(is_dominated.any(axis=1)))
+    return count
+
+
+def hypervolume_mc(
+    Y,
+    ref_point,
+    target_se=1e-3,
+    max_samples=2**21,
+    n_replicates=8,
+    batch_size=2**10,
+    seed=0,
+):
+    # quasi Monte-Carlo estimate of the hypervolume and of its standard error.
+    # Independent scrambled Sobol sequences sample the box between the ideal point
+    # of Y and ref_point, their number of samples doubles until the standard error
+    # relative to the estimate is below target_se or max_samples are drawn in total
+    ref_point = np.asarray(ref_point, dtype=np.float64).reshape(-1)
+    Y = np.atleast_2d(np.asarray(Y, dtype=np.float64))
+    Y = Y[np.all(Y < ref_point, axis=1)]
+    if Y.shape[0] == 0:
+        return 0.0, 0.0
+    Y = get_non_dominated(Y)
+
+    ideal_point = Y.min(axis=0)
+    box_volume = float(np.prod(ref_point - ideal_point))
+    engines = [
+        qmc.Sobol(d=Y.shape[1], scramble=True, seed=np.random.default_rng(child))
+        for child in np.random.SeedSequence(seed).spawn(n_replicates)
+    ]
+    counts = np.zeros(n_replicates)
+    n_samples = 0
+    while True:
+        # the number of samples of each sequence stays a power of two
+        for r, engine in enumerate(engines):
+            samples = qmc.scale(engine.random(batch_size), ideal_point, ref_point)
+            counts[r] += count_dominated(Y, samples)
+        n_samples += batch_size
+        batch_size = n_samples
+
+        estimates = box_volume * counts / n_samples
+        value = float(estimates.mean())
+        standard_error = float(estimates.std(ddof=1) / np.sqrt(n_replicates))
+        if (
+            standard_error <= target_se * value
+            or 2 * n_samples * n_replicates > max_samples
+        ):
+            return value, standard_error
+
+
+class HypervolumeArchive:
+    # the non-dominated points added so far and their hypervolume, so that the gain
+    # of a candidate is one exclusive volume instead of two full hypervolumes
+
+    def __init__(self, ref_point, Y=None):
+        self.ref_point = np.asarray(ref_point, dtype=np.float64).reshape(-1)
+        self.points = np.zeros((0, self.ref_point.shape[0]))
+        self.value = 0.0
+        if Y is not None:
+            Y = np.atleast_2d(np.asarray(Y, dtype=np.float64))
+            self.points = get_non_dominated(Y[np.all(Y < self.ref_point, axis=1)])
+            self.value = hypervolume(self.points, self.ref_point)
+
+    def __len__(self):
+        return self.points.shape[0]
+
+    def exclusive_volume(self, y, points):
+        # the volume dominated by y and by none of points
+        y = np.asarray(y, dtype=np.float64).reshape(-1)
+        if np.any(y >= self.ref_point):
+            return 0.0
+        if np.any(np.all(points <= y, axis=1)):
+            return 0.0
+        volume = float(np.prod(self.ref_point - y))
+        if points.shape[0] > 0:
+            volume -= hypervolume(np.maximum(points, y), self.ref_point)
+        return volume
+
+    def contribution(self, y):
+        # the hypervolume gained by adding y to the archive
+        return self.exclusive_volume(y, self.points)
+
+    def contributions(self):
+        # the hypervolume lost by removing each point of the archive
+        return np.array(
+            [
+                self.exclusive_volume(point, np.delete(self.points, i, axis=0))
+                for i, point in enumerate(self.points)
+            ]
+        )
+
+    def add(self, y):
+        # add y if it increases the hypervolume, and return the gain
+        y = np.asarray(y, dtype=np.float64).reshape(-1)
+        gain = self.contribution(y)
+        if gain > 0.0:
+            self.points = np.concatenate(
+                [self.points[~np.all(self.points >= y, axis=1)], y[None, :]], axis=0
+            )
+            self.value += gain
+        return gain
@@ -1,17 +1,135 @@
 import numpy as np
-from pymoo.indicators.hv import Hypervolume
 from pymoo.indicators.igd import IGD
 
+from offline_moo.off_moo_bench.evaluation.hypervolume import hypervolume, hypervolume_mc
 from offline_moo.off_moo_bench.task_set import MORL
+from offline_moo.utils import get_quantile_solutions
 
+# the exact hypervolume grows exponentially with the number of objectives,
+# method="auto" switches to the Monte-Carlo estimate from this number on
+HV_MC_MIN_OBJECTIVES = 6
 
-def hv(nadir_point, y, task_name):
+# the y statistics of the dataset that the best offline solutions depend on
+D_BEST_STATISTICS = ["y_mean", "y_standard_dev", "y_min", "y_max"]
+
+
+def hv(nadir_point, y, task_name, method="exact", return_se=False):
+    # method: exact, mc (quasi Monte-Carlo estimate) or auto,
+    # the standard error is 0 for the exact hypervolume
     nadir_point = nadir_point * 2.2  # if task_name not in MORL \
     # else nadir_point * 4
     if task_name == "Molecule-Exact-v0":
         index_to_remove = np.all(y == [1.0, 1.0], axis=1)
         y = y[~index_to_remove]
-    return Hypervolume(ref_point=nadir_point).do(y)
+    if method == "auto":
+        method = "mc" if np.size(nadir_point) >= HV_MC_MIN_OBJECTIVES else "exact"
+    if method == "mc":
+        value, standard_error = hypervolume_mc(y, nadir_point)
+    elif method == "exact":
+        value, standard_error = hypervolume(y, nadir_point), 0.0
+    else:
+        raise ValueError(f"Unknown hypervolume method: {method}")
+    return (value, standard_error) if return_se else value
+
+
+def get_d_best_state(dataset):
+    # the y shards, the visible samples and their fronts are compared by identity,
+    # the normalization by value since it is often restored from a copy. The method
+    # only matters when y is normalized, task.normalize_y sets it on every call
+    objects = (tuple(dataset.y_shards), dataset.dataset_visible_mask, dataset.fronts)
+    y_normalize_method = dataset.y_normalize_method if dataset.is_normalized_y else None
+    values = (dataset.is_normalized_y, y_normalize_method) + tuple(
+        (
+            None
+            if getattr(dataset, stat, None) is None
+            else np.asarray(getattr(dataset, stat)).tobytes()
+        )
+        for stat in D_BEST_STATISTICS
+    )
+    return objects, values
+
+
+def is_same_d_best_state(state, other_state):
+    objects, values = state
+    other_objects, other_values = other_state
+    return (
+        len(objects[0]) == len(other_objects[0])
+        and all(a is b for a, b in zip(objects[0], other_objects[0]))
+        and all(a is b for a, b in zip(objects[1:], other_objects[1:]))
+        and values == other_values
+    )
+
+
+def d_best_hv(task, task_name, N=256, method="exact", return_se=False):
+    # the hypervolume of the N best offline solutions, with the min-max normalization,
+    # it is computed once per task and kept on the task until its dataset changes
+    cache = getattr(task, "_d_best_hv_cache", None)
+    if cache is None:
+        cache = task._d_best_hv_cache = {}
+    key = (task_name, N, method)
+    if key in cache and is_same_d_best_state(
+        cache[key][0], get_d_best_state(task.dataset)
+    ):
+        value, standard_error = cache[key][1]
+        return (value, standard_error) if return_se else value
+
+    _, d_best = task.get_N_non_dominated_solutions(N=N, return_x=False, return_y=True)
+    d_best = task.normalize_y(d_best, normalization_method="min-max")
+    nadir_point = task.normalize_y(task.nadir_point, normalization_method="min-max")
+    value, standard_error = hv(
+        nadir_point, d_best, task_name, method=method, return_se=True
+    )
+    # the fronts are known once the best solutions are selected
+    cache[key] = (get_d_best_state(task.dataset), (value, standard_error))
+    return (value, standard_error) if return_se else value
+
+
+def get_hv_results(task, task_name, res_y, method="exact"):
+    # the hypervolume of the solutions res_y, of their 75th and 50th percentiles and of
+    # the best offline solutions, with the min-max normalization suggested by the
+    # benchmark. The standard errors are only reported for the Monte-Carlo estimates
+    res_y_75_percent = get_quantile_solutions(res_y, 0.75)
+    res_y_50_percent = get_quantile_solutions(res_y, 0.50)
+    res_y = task.normalize_y(res_y, normalization_method="min-max")
+    nadir_point = task.normalize_y(task.nadir_point, normalization_method="min-max")
+    res_y_50_percent = task.normalize_y(
+        res_y_50_percent, normalization_method="min-max"
+    )
+    res_y_75_percent = task.normalize_y(
+        res_y_75_percent, normalization_method="min-max"
+    )
+
+    hv_kwargs = dict(method=method, return_se=True)
+    d_best_hv_value, d_best_hv_se = d_best_hv(task, task_name, N=256, **hv_kwargs)
+    hv_value, hv_se = hv(nadir_point, res_y, task_name, **hv_kwargs)
+    hv_value_50_percentile, hv_se_50_percentile = hv(
+        nadir_point, res_y_50_percent, task_name, **hv_kwargs
+    )
+    hv_value_75_percentile, hv_se_75_percentile = hv(
+        nadir_point, res_y_75_percent, task_name, **hv_kwargs
+    )
+
+    print(f"Hypervolume (100th): {hv_value:4f}")
+    print(f"Hypervolume (75th): {hv_value_75_percentile:4f}")
+    print(f"Hypervolume (50th): {hv_value_50_percentile:4f}")
+    print(f"Hypervolume (D(best)): {d_best_hv_value:4f}")
+
+    hv_results = {
+        "hypervolume/D(best)": d_best_hv_value,
+        "hypervolume/100th": hv_value,
+        "hypervolume/75th": hv_value_75_percentile,
+        "hypervolume/50th": hv_value_50_percentile,
+    }
+    if method != "exact":
+        hv_results.update(
+            {
+                "hypervolume/D(best)_se": d_best_hv_se,
+                "hypervolume/100th_se": hv_se,
+                "hypervolume/75th_se": hv_se_75_percentile,
+                "hypervolume/50th_se": hv_se_50_percentile,
+            }
+        )
+    return hv_results
 
 
 def igd(pareto_front, y):
@@ -0,0 +1,230 @@
+import hashlib
+import os
+from bisect import bisect_left, bisect_right
+
+import numpy as np
+from pymoo.util.nds.non_dominated_sorting import NonDominatedSorting
+
+
+def get_points_digest(Y):
+    # identifies the objective values an index was built for
+    Y = np.ascontiguousarray(Y, dtype=np.float64)
+    digest = hashlib.sha1(str(Y.shape).encode())
+    digest.update(Y.tobytes())
+    return digest.hexdigest()
+
+
+def unique_rows(Y):
+    # the distinct rows of Y in lexicographic order, and the position of every row
+    # among them, duplicates are identical points that never dominate each other
+    Y = np.asarray(Y, dtype=np.float64)
+    if Y.shape[0] == 0:
+        return Y, np.zeros(0, dtype=np.int64)
+    order = np.lexsort(Y.T[::-1])
+    sorted_Y = Y[order]
+    is_new = np.ones(Y.shape[0], dtype=np.bool_)
+    is_new[1:] = np.any(sorted_Y[1:] != sorted_Y[:-1], axis=1)
+    inverse = np.empty(Y.shape[0], dtype=np.int64)
+    inverse[order] = np.cumsum(is_new) - 1
+    return sorted_Y[is_new], inverse
+
+
+def get_fronts(ranks):
+    # the indices of the points of each rank, in the format of pymoo
+    # NonDominatedSorting().do
+    ranks = np.asarray(ranks, dtype=np.int64)
+    if ranks.shape[0] == 0:
+        return []
+    order = np.argsort(ranks, kind="stable")
+    splits = np.cumsum(np.bincount(ranks))[:-1]
+    return np.split(order, splits)
+
+
+def sweep_ranks_2d(points, ranks, start=0):
+    # points are distinct and sorted lexicographically, so every point can only be
+    # dominated by the points before it. The last point of each front has the smallest
+    # second objective of the front, and these values increase with the rank
+    tails = np.full(ranks[:start].max() + 1 if start > 0 else 0, np.inf)
+    np.minimum.at(tails, ranks[:start], points[:start, 1])
+    tails = tails.tolist()
+
+    for i, value in enumerate(points[start:, 1].tolist(), start):
+        # the first front whose last point does not dominate the point
+        rank = bisect_right(tails, value)
+        if rank == len(tails):
+            tails.append(value)
+        else:
+            tails[rank] = value
+        ranks[i] = rank
+
+
+def sweep_ranks_3d(points, ranks, start=0):
+    # points are distinct and sorted lexicographically. Each front keeps the staircase
+    # of its points on the last two objectives: the second objective increases while
+    # the third one decreases, the points dominated on both of them are dropped
+    stairs = []
+    for rank in range(ranks[:start].max() + 1 if start > 0 else 0):
+        front = points[:start][ranks[:start] == rank][:, 1:]
+        front = front[np.lexsort(front.T[::-1])]
+        best = np.minimum.accumulate(front[:, 1])
+        keep = np.ones(front.shape[0], dtype=np.bool_)
+        keep[1:] = front[1:, 1] < best[:-1]
+        stairs.append((front[keep, 0].tolist(), front[keep, 1].tolist()))
+
+    def is_dominated(stair, value_1, value_2):
+        # the last step at or before value_1 has the smallest value_2 of those steps
+        j = bisect_right(stair[0], value_1)
+        return j > 0 and stair[1][j - 1] <= value_2
+
+    for i, (value_1, value_2) in enumerate(points[start:, 1:].tolist(), start):
+        # if a front dominates the point, so does every front before it
+        low, high = 0, len(stairs)
+        while low < high:
+            middle = (low + high) // 2
+            if is_dominated(stairs[middle], value_1, value_2):
+                low = middle + 1
+            else:
+                high = middle
+        if low == len(stairs):
+            stairs.append(([], []))
+
+        # the point replaces the steps it dominates, which follow it on the staircase
+        steps_1, steps_2 = stairs[low]
+        j = bisect_left(steps_1, value_1)
+        end = j
+        while end < len(steps_1) and steps_2[end] >= value_2:
+            end += 1
+        steps_1[j:end] = [value_1]
+        steps_2[j:end] = [value_2]
+        ranks[i] = low
+
+
+def sweep_ranks(points, ranks, start=0):
+    # rank the points from start on, the ranks before start are already known
+    n_obj = points.shape[1]
+    if points.shape[0] == start:
+        return
+    if n_obj == 1:
+        ranks[start:] = np.arange(start, points.shape[0])
+    elif n_obj == 2:
+        sweep_ranks_2d(points, ranks, start)
+    elif n_obj == 3:
+        sweep_ranks_3d(points, ranks, start)
+    else:
+        # no sweep for many objectives, all the points are sorted again
+        _, ranks[:] = NonDominatedSorting().do(points, return_rank=True)
+
+
+class FrontIndex:
+    # non-dominated ranks (minimization) of a set of points that can grow,
+    # the fronts are given in the format of pymoo NonDominatedSorting().do,
+    # with the indices of each front in ascending order
+
+    def __init__(self, Y=None):
+        self.points = None
+        self.point_ranks = np.zeros(0, dtype=np.int64)
+        self.inverse = np.zeros(0, dtype=np.int64)
+        self._fronts = None
+        if Y is not None:
+            self.add(Y)
+
+    def __len__(self):
+        return self.inverse.shape[0]
+
+    @property
+    def n_obj(self):
+        return None if self.points is None else self.points.shape[1]
+
+    @property
+    def ranks(self):
+        return self.point_ranks[self.inverse]
+
+    @property
+    def digest(self):
+        return get_points_digest(self.points[self.inverse])
+
+    @property
+    def fronts(self):
+        if self._fronts is None:
+            self._fronts = get_fronts(self.ranks)
+        return self._fronts
+
+    def add(self, Y):
+        # insert new points and return their ranks, the points that come before the
+        # first new one in the sweep order keep their ranks, the rest are swept again
+        Y = np.asarray(Y, dtype=np.float64)
+        if Y.ndim != 2:
+            raise ValueError("the points should be a 2-D array")
+        if self.points is not None and Y.shape[1] != self.n_obj:
+            raise ValueError(
+                f"the index has {self.n_obj} objectives, got {Y.shape[1]} instead"
+            )
+
+        n_known = 0 if self.points is None else self.points.shape[0]
+        all_points = Y if n_known == 0 else np.concatenate([self.points, Y], axis=0)
+        points, inverse = unique_rows(all_points)
+
+        ranks = np.zeros(points.shape[0], dtype=np.int64)
+        is_known = np.zeros(points.shape[0], dtype=np.bool_)
+        is_known[inverse[:n_known]] = True
+        start = int(np.argmin(is_known)) if not is_known.all() else points.shape[0]
+        # the known points before start are the same points in the same order
+        if start > 0:
+            ranks[:start] = self.point_ranks[:start]
+        sweep_ranks(points, ranks, start)
+
+        old_inverse = self.inverse
+        self.points = points
+        self.point_ranks = ranks
+        self.inverse = np.concatenate(
+            [inverse[:n_known][old_inverse], inverse[n_known:]]
+        )
+        self._fronts = None
+        return ranks[inverse[n_known:]]
+
+    def get_front(self, rank=0):
+        fronts = self.fronts
+        return fronts[rank] if rank < len(fronts) else np.zeros(0, dtype=np.int64)
+
+    def save(self, path):
+        # write a temporary file first, so that readers never see a partial index
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, "wb") as f:
+            np.savez(
+                f,
+                points=self.points,
+                point_ranks=self.point_ranks,
+                inverse=self.inverse,
+                digest=np.asarray(self.digest),
+            )
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load(cls, path):
+        front_index = cls()
+        with np.load(path, allow_pickle=False) as data:
+            front_index.points = data["points"]
+            front_index.point_ranks = data["point_ranks"]
+            front_index.inverse = data["inverse"]
+        return front_index
+
+    @classmethod
+    def cached(cls, Y, path=None):
+        # reuse the index saved at path if it was built for the same points
+        if path is not None and os.path.exists(path):
+            try:
+                with np.load(path, allow_pickle=False) as data:
+                    is_same = str(data["digest"]) == get_points_digest(Y)
+                if is_same:
+                    return cls.load(path)
+            except (OSError, KeyError, ValueError):
+                pass
+
+        front_index = cls(Y)
+        if path is not None:
+            try:
+                front_index.save(path)
+            except OSError:
+                # e.g., a read-only data folder, the index is only kept in memory
+                pass
+        return front_index
@@ -39,6 +39,13 @@ class SyntheticProblem(BaseProblem):
     def get_func(self):
         raise NotImplementedError
 
+    def __getstate__(self):
+        # the objectives are closures that cannot be pickled, f rebuilds them
+        # with get_func, e.g., in the workers of DatasetBuilder.relabel
+        state = dict(super().__getstate__())
+        state["func"] = list()
+        return state
+
     def generate_x(self, size):
         return (
             (torch.rand(size, self.n_dim) * (self.ubound - self.lbound) + self.lbound)
@@ -1,3 +1,4 @@
+import functools
 import importlib
 import re
 from typing import Union
@@ -19,6 +20,12 @@ def import_name(name):
     return getattr(importlib.import_module("offline_moo." + mod_name), attr_name)
 
 
+def evaluate_problem(problem, x, y):
+    # relabel function of the datasets, a module level function so that it
+    # can be pickled for the relabel workers
+    return problem.evaluate(x)
+
+
 class Task(object):
 
     def __init__(
@@ -28,7 +35,11 @@ class Task(object):
         dataset_kwargs=None,
         problem_kwargs=None,
         relabel=False,
+        relabel_batch_size=0,
+        relabel_num_workers=0,
     ):
+        # relabel_batch_size and relabel_num_workers are given to dataset.relabel,
+        # 0 passes whole shards to the vectorized problems
 
         # use additional_kwargs to override self.kwargs
         kwargs = dataset_kwargs if dataset_kwargs else dict()
@@ -116,10 +127,12 @@ class Task(object):
 
             # relabel the dataset using the new oracle model
             dataset.relabel(
-                lambda x, y: problem.evaluate(x),
+                functools.partial(evaluate_problem, problem),
                 to_disk=name is not None,
                 is_absolute=False,
                 disk_target=name,
+                batch_size=relabel_batch_size,
+                num_workers=relabel_num_workers,
             )
 
         if isinstance(self.dataset, SequenceDataset):
@@ -707,9 +720,9 @@ class Task(object):
             elif not self.problem.requires_normalized_x and self.is_normalized_x:
                 x_batch = self.denormalize_x(x_batch, normalization_method="min-max")
 
+        # the conversion does not depend on the state of the dataset, so the
+        # dataset is not mapped to integers and back around every query
         if self.is_discrete and self.is_logits:
-            self.map_to_integers()
             x_batch = self.to_integers(x_batch)
-            self.map_to_logits()
 
         return self.problem.evaluate(x_batch, **kwargs)
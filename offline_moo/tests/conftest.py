@@ -0,0 +1,10 @@
+import numpy as np
+
+
+def get_points(n_samples, n_obj, seed, n_values=None):
+    # integer valued points when n_values is given, so that the points share
+    # coordinates and some of them are duplicates
+    rng = np.random.RandomState(seed)
+    if n_values is None:
+        return rng.rand(n_samples, n_obj)
+    return rng.randint(n_values, size=(n_samples, n_obj)).astype(np.float64)
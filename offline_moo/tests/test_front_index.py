@@ -0,0 +1,103 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+import numpy as np
+import pytest
+from conftest import get_points
+from pymoo.util.nds.non_dominated_sorting import NonDominatedSorting
+
+from offline_moo.off_moo_bench.datasets.continuous_dataset import ContinuousDataset
+from offline_moo.off_moo_bench.front_index import FrontIndex
+
+
+def get_pymoo_ranks(Y):
+    _, ranks = NonDominatedSorting().do(Y, return_rank=True)
+    return np.asarray(ranks, dtype=np.int64)
+
+
+def assert_same_fronts(fronts, Y):
+    pymoo_fronts = NonDominatedSorting().do(Y)
+    assert len(fronts) == len(pymoo_fronts)
+    for front, pymoo_front in zip(fronts, pymoo_fronts):
+        np.testing.assert_array_equal(front, np.sort(pymoo_front))
+
+
+@pytest.mark.parametrize("n_obj", [1, 2, 3, 4, 5])
+@pytest.mark.parametrize("n_values", [None, 3, 6])
+def test_ranks_match_pymoo(n_obj, n_values):
+    for seed in range(5):
+        Y = get_points(200, n_obj, seed, n_values=n_values)
+        front_index = FrontIndex(Y)
+        np.testing.assert_array_equal(front_index.ranks, get_pymoo_ranks(Y))
+        assert_same_fronts(front_index.fronts, Y)
+
+
+@pytest.mark.parametrize("n_obj", [1, 2, 3, 4, 5])
+@pytest.mark.parametrize("n_values", [None, 4])
+def test_add_matches_pymoo(n_obj, n_values):
+    for seed in range(5):
+        Y = get_points(240, n_obj, seed, n_values=n_values)
+        # copies of known points and points that dominate the known ones are added
+        # in the later batches
+        Y[150:170] = Y[:20]
+        Y[170:180] = Y[:10] - 1.0
+
+        front_index = FrontIndex()
+        for start, end in [(0, 100), (100, 101), (101, 180), (180, 180), (180, 240)]:
+            new_ranks = front_index.add(Y[start:end].reshape(-1, n_obj))
+            ranks = get_pymoo_ranks(Y[:end]) if end > 0 else np.zeros(0)
+            np.testing.assert_array_equal(front_index.ranks, ranks)
+            np.testing.assert_array_equal(new_ranks, ranks[start:end])
+        assert len(front_index) == Y.shape[0]
+        assert_same_fronts(front_index.fronts, Y)
+
+
+def test_add_checks_the_number_of_objectives():
+    front_index = FrontIndex(get_points(10, 2, 0))
+    with pytest.raises(ValueError):
+        front_index.add(get_points(10, 3, 0))
+
+
+def test_cached_index_is_reused(tmp_path):
+    Y = get_points(100, 3, 0, n_values=5)
+    path = str(tmp_path / "fronts.npz")
+    front_index = FrontIndex.cached(Y, path)
+    cached_index = FrontIndex.cached(Y, path)
+    np.testing.assert_array_equal(cached_index.ranks, front_index.ranks)
+
+    # an index saved for other points is rebuilt
+    other_Y = Y.copy()
+    other_Y[0] = -1.0
+    np.testing.assert_array_equal(
+        FrontIndex.cached(other_Y, path).ranks, get_pymoo_ranks(other_Y)
+    )
+
+
+@pytest.mark.parametrize("min_percentile", [0.0, 20.0])
+def test_dataset_visible_fronts(min_percentile):
+    rng = np.random.RandomState(0)
+    x = rng.rand(300, 4).astype(np.float32)
+    y = get_points(300, 2, 0, n_values=20)
+    dataset = ContinuousDataset(
+        x,
+        y,
+        x[:10],
+        y[:10],
+        is_normalized_y=True,
+        max_percentile=60.0,
+        min_percentile=min_percentile,
+    )
+    front_index = dataset.front_index
+    assert len(front_index) == y.shape[0]
+
+    _, best_y = dataset.get_N_non_dominated_solutions(
+        N=50, return_x=False, regain_fronts=True
+    )
+    # the index of the full dataset is kept, the fronts are the ones of the visible
+    # samples
+    assert dataset.front_index is front_index
+    assert_same_fronts(dataset.fronts, dataset.y)
+    assert dataset.y.shape[0] == dataset.dataset_size <= int(300 * 0.6)
+    assert best_y.shape == (50, 2)
@@ -0,0 +1,180 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+import numpy as np
+import pytest
+from conftest import get_points
+from pymoo.indicators.hv import Hypervolume
+
+from offline_moo.off_moo_bench.datasets.continuous_dataset import ContinuousDataset
+from offline_moo.off_moo_bench.evaluation import metrics
+from offline_moo.off_moo_bench.evaluation.hypervolume import (
+    HypervolumeArchive,
+    hypervolume,
+    hypervolume_2d,
+    hypervolume_3d,
+    hypervolume_mc,
+    hypervolume_wfg,
+)
+
+
+def get_pymoo_hv(Y, ref_point):
+    # pymoo only counts the points that strictly dominate the reference point
+    Y = Y[np.all(Y < ref_point, axis=1)]
+    if Y.shape[0] == 0:
+        return 0.0
+    return float(Hypervolume(ref_point=ref_point).do(Y))
+
+
+def get_ref_point(n_obj, n_values=None):
+    # some points are beyond the reference point
+    return np.full(n_obj, 0.9 if n_values is None else n_values - 1.0)
+
+
+@pytest.mark.parametrize("n_values", [None, 4])
+def test_hypervolume_2d_3d_match_pymoo(n_values):
+    for n_obj, hypervolume_fn in [(2, hypervolume_2d), (3, hypervolume_3d)]:
+        ref_point = get_ref_point(n_obj, n_values)
+        for seed in range(5):
+            Y = get_points(100, n_obj, seed, n_values=n_values)
+            Y = Y[np.all(Y < ref_point, axis=1)]
+            np.testing.assert_allclose(
+                hypervolume_fn(Y, ref_point), get_pymoo_hv(Y, ref_point)
+            )
+
+
+@pytest.mark.parametrize("n_obj", [2, 3, 4, 5])
+@pytest.mark.parametrize("n_values", [None, 4])
+def test_hypervolume_matches_pymoo(n_obj, n_values):
+    ref_point = get_ref_point(n_obj, n_values)
+    for seed in range(5):
+        Y = get_points(60, n_obj, seed, n_values=n_values)
+        expected = get_pymoo_hv(Y, ref_point)
+        np.testing.assert_allclose(hypervolume(Y, ref_point), expected)
+        inside = Y[np.all(Y < ref_point, axis=1)]
+        np.testing.assert_allclose(hypervolume_wfg(inside, ref_point), expected)
+
+
+def test_hypervolume_of_no_point():
+    ref_point = np.ones(3)
+    assert hypervolume(np.full((4, 3), 2.0), ref_point) == 0.0
+    assert hypervolume_mc(np.full((4, 3), 2.0), ref_point) == (0.0, 0.0)
+
+
+@pytest.mark.parametrize("n_obj", [2, 3, 4])
+@pytest.mark.parametrize("n_values", [None, 5])
+def test_archive_matches_pymoo(n_obj, n_values):
+    ref_point = get_ref_point(n_obj, n_values)
+    Y = get_points(80, n_obj, 0, n_values=n_values)
+    archive = HypervolumeArchive(ref_point, Y[:20])
+    np.testing.assert_allclose(archive.value, get_pymoo_hv(Y[:20], ref_point))
+
+    for end in range(21, Y.shape[0] + 1):
+        previous = get_pymoo_hv(Y[: end - 1], ref_point)
+        expected = get_pymoo_hv(Y[:end], ref_point)
+        np.testing.assert_allclose(
+            archive.add(Y[end - 1]), expected - previous, atol=1e-12
+        )
+        np.testing.assert_allclose(archive.value, expected)
+
+    # the contribution of a point is the hypervolume lost by removing it
+    total = get_pymoo_hv(archive.points, ref_point)
+    expected = [
+        total - get_pymoo_hv(np.delete(archive.points, i, axis=0), ref_point)
+        for i in range(len(archive))
+    ]
+    np.testing.assert_allclose(archive.contributions(), expected, atol=1e-12)
+
+
+@pytest.mark.parametrize("n_obj", [3, 6])
+def test_hypervolume_mc_within_standard_error(n_obj):
+    ref_point = np.full(n_obj, 1.1)
+    Y = get_points(30, n_obj, 0)
+    value, standard_error = hypervolume_mc(Y, ref_point, target_se=1e-3)
+    assert standard_error > 0.0
+    assert abs(value - get_pymoo_hv(Y, ref_point)) <= 4 * standard_error
+
+
+class DatasetTask:
+    # the parts of a task that d_best_hv uses
+    def __init__(self, dataset, nadir_point):
+        self.dataset = dataset
+        self.nadir_point = nadir_point
+
+    def get_N_non_dominated_solutions(self, *args, **kwargs):
+        return self.dataset.get_N_non_dominated_solutions(*args, **kwargs)
+
+    def normalize_y(self, y, normalization_method="z-score"):
+        self.dataset.y_normalize_method = normalization_method
+        return self.dataset.normalize_y(y)
+
+
+def test_d_best_hv_is_cached_per_task(monkeypatch):
+    calls = []
+    hv = metrics.hv
+
+    def counted_hv(*args, **kwargs):
+        calls.append(args)
+        return hv(*args, **kwargs)
+
+    monkeypatch.setattr(metrics, "hv", counted_hv)
+
+    rng = np.random.RandomState(0)
+    x = rng.rand(200, 4).astype(np.float32)
+    y = get_points(200, 2, 0)
+    dataset = ContinuousDataset(x, y, x[:10], y[:10])
+    task = DatasetTask(dataset, y.max(axis=0))
+
+    value = metrics.d_best_hv(task, "Test", N=32)
+    # the z-score normalization of a sampling run does not change the best solutions
+    task.normalize_y(y[:5])
+    assert metrics.d_best_hv(task, "Test", N=32) == value
+    assert len(calls) == 1
+
+    # another task with the same dataset computes its own value
+    other_task = DatasetTask(dataset, y.max(axis=0))
+    assert metrics.d_best_hv(other_task, "Test", N=32) == value
+    assert len(calls) == 2
+
+    # the value is computed again once the visible samples change
+    dataset.subsample(max_percentile=50.0)
+    metrics.d_best_hv(task, "Test", N=32)
+    assert len(calls) == 3
+    metrics.d_best_hv(task, "Test", N=16)
+    assert len(calls) == 4
+
+
+@pytest.mark.parametrize("method", ["exact", "mc"])
+def test_hv_results(method):
+    rng = np.random.RandomState(0)
+    x = rng.rand(200, 4).astype(np.float32)
+    y = get_points(200, 2, 0)
+    task = DatasetTask(ContinuousDataset(x, y, x[:10], y[:10]), y.max(axis=0))
+
+    res_y = get_points(40, 2, 1)
+    hv_results = metrics.get_hv_results(task, "Test", res_y, method=method)
+    names = ["D(best)", "100th", "75th", "50th"]
+    if method == "mc":
+        names += [f"{name}_se" for name in names]
+    assert list(hv_results) == [f"hypervolume/{name}" for name in names]
+
+    nadir_point = task.normalize_y(task.nadir_point, normalization_method="min-max")
+    expected = metrics.hv(
+        nadir_point,
+        task.normalize_y(res_y, normalization_method="min-max"),
+        "Test",
+        method=method,
+    )
+    assert hv_results["hypervolume/100th"] == expected
+    assert hv_results["hypervolume/D(best)"] == metrics.d_best_hv(
+        task, "Test", method=method
+    )
+    if method == "exact":
+        # the percentiles are subsets of the solutions
+        assert (
+            hv_results["hypervolume/100th"]
+            >= hv_results["hypervolume/75th"]
+            >= hv_results["hypervolume/50th"]
+        )